@@ -1,4 +1,4 @@
-# Copyright 2015-2018 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
 Provides CABFile, an extractor for the MSCAB format.
@@ -10,6 +10,7 @@ https://msdn.microsoft.com/en-us/library/bb417343.aspx.
 from bisect import bisect
 from collections import OrderedDict
 from calendar import timegm
+from threading import Lock
 
 from ..log import dbg
 from ..util.filelike.readonly import PosSavingReadOnlyFileLikeObject
@@ -19,6 +20,7 @@ from ..util.fslike.filecollection import FileCollection
 from ..util.math import INF
 from ..util.strings import try_decode
 from ..util.struct import NamedStruct, Flags
+from ..util.threading import concurrent_chain
 
 from .cabchecksum import mscab_csum
 
@@ -114,8 +116,28 @@ class CFFolder(NamedStruct):
     reserved        = None  # bytes object of size reserved_data.cbCFFolder
 
     comp_name       = None  # human-readable compression name
+    window_bits     = None  # LZX window size, for LZX folders
+    data_stream     = None  # CABFolderStream for the compressed data
     plain_stream    = None  # file-like object for decompressed folder.
 
+    def open_plain_stream(self):
+        """
+        Returns a new, sequential-only file-like object for the
+        decompressed folder.
+
+        In contrast to plain_stream, it keeps no decompressed data around,
+        and several of them can be read in parallel.
+        """
+        data_stream = self.data_stream.clone()
+
+        if self.window_bits is None:
+            return data_stream
+
+        from .lzxdstream import LZXDStream
+        return LZXDStream(data_stream,
+                          window_bits=self.window_bits,
+                          reset_interval=0)
+
 
 class CFFileAttributes(Flags):
     """
@@ -227,6 +249,9 @@ class CABFile(FileCollection):
     def __init__(self, cab):
         super().__init__()
 
+        # the folder streams of all folders share the cab file object
+        self.lock = Lock()
+
         # read header
         cab.seek(0)
         header = CFHeader.read(cab)
@@ -260,6 +285,9 @@ class CABFile(FileCollection):
 
         self.folders = tuple(self.read_folder_headers(cab))
 
+        # CFFile objects, in the order of the file headers
+        self.files = []
+
         # {filename: fileobj}, {subdirname: subdir}
         self.rootdir = OrderedDict(), OrderedDict()
 
@@ -284,9 +312,79 @@ class CABFile(FileCollection):
                 lambda fileobj=fileobj: fileobj.timestamp
             ))
 
+            self.files.append(fileobj)
+
     def __repr__(self):
         return "CABFile"
 
+    def extract(self, targetdir, jobs=None):
+        """
+        Extracts all files to the targetdir Path.
+
+        In contrast to opening the files one by one, every folder is
+        decompressed in a single sequential pass, and the data is written to
+        the member files as it is decompressed. The folders are processed
+        in parallel.
+
+        Yields the paths of the extracted files.
+        """
+        folder_files = OrderedDict((id(folder), []) for folder in self.folders)
+        for fileobj in self.files:
+            folder_files[id(fileobj.folder)].append(fileobj)
+
+        yield from concurrent_chain(
+            (self.extract_folder(folder, folder_files[id(folder)], targetdir)
+             for folder in self.folders if folder_files[id(folder)]),
+            jobs
+        )
+
+    @staticmethod
+    def extract_folder(folder, files, targetdir, chunksize=1048576):
+        """
+        Extracts the given files of folder to the targetdir Path,
+        decompressing the folder only once.
+
+        Yields the paths of the extracted files.
+        """
+        files = sorted(files, key=lambda fileobj: (fileobj.pos, fileobj.size))
+
+        with folder.open_plain_stream() as stream:
+            pos = 0
+
+            for fileobj in files:
+                path = targetdir.joinpath(fileobj.path)
+                path.parent.mkdirs()
+
+                if fileobj.pos < pos:
+                    # the file overlaps with a previous one.
+                    # that's legal, but rare: fall back to random access.
+                    with path.open("wb") as outfile:
+                        outfile.write(StreamFragment(folder.plain_stream,
+                                                     fileobj.pos,
+                                                     fileobj.size).read())
+                    yield path
+                    continue
+
+                # skip the gap to the file start
+                while pos < fileobj.pos:
+                    skipped = stream.read(min(fileobj.pos - pos, chunksize))
+                    if not skipped:
+                        raise EOFError("unexpected end of CAB folder")
+                    pos += len(skipped)
+
+                with path.open("wb") as outfile:
+                    remaining = fileobj.size
+                    while remaining > 0:
+                        data = stream.read(min(remaining, chunksize))
+                        if not data:
+                            raise EOFError("unexpected end of CAB folder")
+
+                        outfile.write(data)
+                        remaining -= len(data)
+
+                pos += fileobj.size
+                yield path
+
     def read_folder_headers(self, cab):
         """
         Called during the constructor run.
@@ -310,7 +408,9 @@ class CABFile(FileCollection):
                 cab,
                 folder.coffCabStart,
                 folder.cCFData,
-                self.header.reserved_data.cbCFData)
+                self.header.reserved_data.cbCFData,
+                self.lock)
+            folder.data_stream = compressed_data_stream
 
             # determine compression type and create plain data stream
             compression_type = folder.typeCompress & 0x000f
@@ -328,6 +428,7 @@ class CABFile(FileCollection):
             elif compression_type == 3:
                 window_bits = (folder.typeCompress >> 8) & 0x1f
                 folder.comp_name = "LZX (window_bits = %d)" % window_bits
+                folder.window_bits = window_bits
 
                 from .lzxdstream import LZXDStream
                 from ..util.filelike.stream import StreamSeekBuffer
@@ -425,67 +526,106 @@ class CABFolderStream(PosSavingReadOnlyFileLikeObject):
 
     @param blockcount:
         Number of data blocks in the folder.
+
+    @param blockreserved:
+        Size of the per-datablock reserved area.
+
+    @param lock:
+        Guards the seek() and read() calls on fileobj,
+        if it is shared between threads.
     """
 
-    def __init__(self, fileobj, offset, blockcount, blockreserved):
+    def __init__(self, fileobj, offset, blockcount, blockreserved, lock=None):
         super().__init__()
 
         self.fileobj = fileobj
+        self.offset = offset
         self.blockcount = blockcount
         self.blockreserved = blockreserved
 
+        if lock is None:
+            lock = Lock()
+        self.lock = lock
+
         # positions of the blocks in fileobj. block 0 starts at offset.
-        self.blockoffsets = [offset]
+        # filled by build_index(), once the first block is requested.
+        self.blockoffsets = None
 
         # positions in the stream of the start of each block.
-        self.streamindex = [0]
+        self.streamindex = None
+
+        # for each block, whether its checksum has been verified already.
+        self.verified = None
 
-    def next_block_size(self, payloadsize):
+    def clone(self):
         """
-        adds metadata for the next block
+        Returns a new stream object for the same folder, positioned at the
+        start. The block index and checksum verification state are shared.
         """
-        self.blockoffsets.append(self.blockoffsets[-1] +
-                                 CFData.size() + self.blockreserved +
-                                 payloadsize)
+        self.build_index()
+
+        result = CABFolderStream(self.fileobj, self.offset, self.blockcount,
+                                 self.blockreserved, self.lock)
+        result.blockoffsets = self.blockoffsets
+        result.streamindex = self.streamindex
+        result.verified = self.verified
+
+        return result
+
+    def build_index(self):
+        """
+        Scans the block headers of the whole folder once,
+        and stores the offsets of all blocks.
+
+        Only the headers are read; the payloads are skipped.
+        """
+        if self.blockoffsets is not None:
+            return
+
+        blockoffsets = [self.offset]
+        streamindex = [0]
+        blocksize = CFData.size() + self.blockreserved
+
+        with self.lock:
+            for _ in range(self.blockcount):
+                self.fileobj.seek(blockoffsets[-1])
+                datablock = CFData.read(self.fileobj)
 
-        self.streamindex.append(self.streamindex[-1] + payloadsize)
+                blockoffsets.append(blockoffsets[-1] +
+                                    blocksize + datablock.cbData)
+                streamindex.append(streamindex[-1] + datablock.cbData)
+
+        self.verified = bytearray(self.blockcount)
+        self.streamindex = streamindex
+        self.blockoffsets = blockoffsets
 
     def read_block_data(self, block_id):
         """
         reads the data of block block_id.
 
-        if necessary, the metadata info in self.blockvalues and
-        self.blockoffsets is updated.
+        the checksum of each block is only verified the first time
+        it is read.
 
         returns the block data.
         """
         if block_id >= self.blockcount:
             raise EOFError()
 
-        while block_id >= len(self.blockoffsets):
-            # We do not yet know where the block starts. Seek forwards.
-
-            # read info for the rightmost known block to get its size.
-            offset = self.blockoffsets[-1]
-            self.fileobj.seek(self.blockoffsets[-1])
-            datablock = CFData.read(self.fileobj)
-
-            # add starting position of next block to metadata.
-            self.next_block_size(datablock.cbData)
+        self.build_index()
 
-        # we now know the starting position of the block.
         offset = self.blockoffsets[block_id]
-        self.fileobj.seek(offset)
-        datablock = CFData.read(self.fileobj)
-        datablock.reserved = read_guaranteed(self.fileobj, self.blockreserved)
-        datablock.payload = read_guaranteed(self.fileobj, datablock.cbData)
 
-        # verify the datablock's checksum.
-        datablock.verify_checksum()
+        with self.lock:
+            self.fileobj.seek(offset)
+            datablock = CFData.read(self.fileobj)
+            datablock.reserved = read_guaranteed(self.fileobj,
+                                                 self.blockreserved)
+            datablock.payload = read_guaranteed(self.fileobj, datablock.cbData)
 
-        # add starting data of next block to metadata, if required.
-        if block_id + 1 == len(self.blockoffsets):
-            self.next_block_size(datablock.cbData)
+        # verify the datablock's checksum.
+        if not self.verified[block_id]:
+            datablock.verify_checksum()
+            self.verified[block_id] = True
 
         # finally, return the data.
         return datablock.payload
@@ -500,6 +640,8 @@ class CABFolderStream(PosSavingReadOnlyFileLikeObject):
         if size < 0:
             size = INF
 
+        self.build_index()
+
         # use self.streamindex to determine the block id for pos.
         blockid = bisect(self.streamindex, self.pos) - 1
 
@@ -516,18 +658,9 @@ class CABFolderStream(PosSavingReadOnlyFileLikeObject):
             blockid += 1
 
             if discard != 0:
-                if discard >= len(block_data):
-                    # we're actually still seeking through the file,
-                    # reading it block by block, approaching the stream cursor
-                    # position.
-
-                    discard -= len(block_data)
-                    continue
-
-                else:
-                    # discard the first few bytes of the block's data.
-                    block_data = block_data[discard:]
-                    discard = 0
+                # discard the first few bytes of the block's data.
+                block_data = block_data[discard:]
+                discard = 0
 
             if len(block_data) > size:
                 # less than the entire block was requested.
@@ -542,11 +675,12 @@ class CABFolderStream(PosSavingReadOnlyFileLikeObject):
         return b"".join(self.read_blocks(size))
 
     def get_size(self):
-        del self  # unused
-        return -1
+        self.build_index()
+        return self.streamindex[-1]
 
     def close(self):
         self.closed = True
         del self.fileobj
         del self.blockoffsets
         del self.streamindex
+        del self.verified
@@ -1,14 +1,15 @@
-# Copyright 2015-2016 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 """
 Downloads the SFT test cab archive and uses it to test the cabextract code.
 """
 
 import os
-from tempfile import gettempdir
+from tempfile import gettempdir, TemporaryDirectory
 from hashlib import md5
 from urllib.request import urlopen
 
 from .cab import CABFile
+from ..util.fslike.directory import Directory
 
 # the test archive file has been generated using ./gen_test_arc.sh
 
@@ -132,3 +133,20 @@ def test():
 
         assert_value(md5(path.open('rb').read()).hexdigest(), md5sum)
         assert_value(path.filesize, size)
+
+    # extract everything in one pass
+    with TemporaryDirectory() as tmpdir:
+        extract_dir = Directory(tmpdir).root
+        cabfile = CABFile(open_test_archive())
+
+        assert_value(
+            sorted(b"/".join(path.parts).decode()
+                   for path in cabfile.extract(extract_dir)),
+            sorted(TEST_FILES)
+        )
+
+        for filename, (md5sum, size) in TEST_FILES.items():
+            path = extract_dir[filename]
+
+            assert_value(md5(path.open('rb').read()).hexdigest(), md5sum)
+            assert_value(path.filesize, size)
@@ -0,0 +1,14 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Benchmarks of the converter on generated assets.
+
+The benchmarks can run anywhere, e.g. in CI, because they
+don't need the original game data. Run them with
+
+    python3 -m openage test --benchmark convert.benchmark.stages.benchmark_decode
+
+or create a JSON report of all stages with
+
+    python3 -m openage test --demo convert.benchmark.stages.report -o report.json
+"""
@@ -0,0 +1,698 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Generators for synthetic game assets.
+
+The converter benchmarks can't use the original game data, so they run
+on generated files instead. The files are valid for the converter's
+readers and look roughly like the real ones (sprites with transparent
+borders, several kinds of drawing commands, a few player colors),
+but their content is random. For the same parameters and seed,
+the generated files are always identical.
+"""
+
+from io import BytesIO
+import math
+from random import Random
+from struct import Struct
+import wave
+import zlib
+
+from ..dataformat.genie_structure import GenieStructure
+from ..dataformat.member_access import READ, READ_EXPORT
+from ..dataformat.read_members import SubdataMember
+from ..dataformat.value_members import MemberTypes as StorageType
+from ..gamedata.playercolor import PlayerColor
+from ..gamedata.sound import Sound
+
+
+# maximum number of pixels of one generated drawing command
+MAX_RUN_LENGTH = 15
+
+# number of player color indices that are used by the sprites
+PLAYER_COLOR_COUNT = 8
+
+# SLP versions: AoC, SWGB and HD, DE
+SLP_VERSIONS = (b"2.0N", b"3.0\x00", b"4.0X")
+
+slp_version = Struct("< 4s")
+slp_header = Struct("< i 24s")
+slp_header_v4 = Struct("< H H H H i i i 8x")
+slp_frame_info = Struct("< I I I I i i i i")
+
+smp_header = Struct("< 4s 7I 32s")
+smp_frame_header = Struct("< 28x i")
+smp_layer_header = Struct("< i i i i I I I I")
+
+smx_header = Struct("< 4s H H I I 16s")
+smx_frame_header = Struct("< B B I")
+smx_layer_header = Struct("< H H H H I i")
+
+row_edge = Struct("< H H")
+offset_entry = Struct("< I")
+
+drs_header = Struct("< 40s 4s 12s i i")
+drs_table_info = Struct("< 4s i i")
+drs_file_info = Struct("< i i i")
+
+cab_header = Struct("< 4s I I I I I B B H H H H H")
+cab_folder = Struct("< I H H")
+cab_file = Struct("< I I H H H H")
+cab_data = Struct("< I H H")
+
+# maximum size of the data blocks in CAB folders
+CAB_BLOCK_SIZE = 32768
+
+
+def frame_sizes(frame_count, width, height, seed=0):
+    """
+    Returns the (width, height) of the frames of a generated sprite.
+
+    The sizes vary by up to 25% around the given size,
+    like the frames of an animated unit do.
+    """
+    rng = Random(seed)
+
+    return [(max(1, round(width * rng.uniform(0.75, 1.25))),
+             max(1, round(height * rng.uniform(0.75, 1.25))))
+            for _ in range(frame_count)]
+
+
+def sprite_rows(width, height):
+    """
+    Yields (left, right) transparent border sizes for the rows of an
+    elliptic sprite, or None for rows that are completely transparent.
+    """
+    center = width // 2
+
+    for row in range(height):
+        # relative distance of the row from the vertical center
+        distance = (2 * row + 1) / height - 1
+        halfspan = round(width / 2 * math.sqrt(1 - distance ** 2))
+
+        left = max(0, center - halfspan)
+        right = max(0, width - center - halfspan)
+
+        if left + right >= width:
+            yield None
+
+        else:
+            yield left, right
+
+
+def split_runs(rng, count):
+    """
+    Splits count pixels into runs of random length.
+    """
+    while count > 0:
+        run = min(count, rng.randint(1, MAX_RUN_LENGTH))
+        count -= run
+        yield run
+
+
+def slp_row_commands(rng, count, shadow=False):
+    """
+    Returns the drawing commands of an SLP row with count visible pixels.
+    """
+    commands = bytearray()
+
+    for run in split_runs(rng, count):
+        kind = rng.random()
+
+        if shadow or kind < 0.5:
+            # color list
+            commands.append(run << 2)
+            commands.extend(rng.randrange(256) for _ in range(run))
+
+        elif kind < 0.75:
+            # fill
+            commands.append(run << 4 | 0x07)
+            commands.append(rng.randrange(256))
+
+        elif kind < 0.85:
+            # player color list
+            commands.append(run << 4 | 0x06)
+            commands.extend(rng.randrange(PLAYER_COLOR_COUNT)
+                            for _ in range(run))
+
+        else:
+            # skip
+            commands.append(run << 2 | 0x01)
+
+    # end of row
+    commands.append(0x0F)
+
+    return commands
+
+
+def slp_frame_data(rng, width, height, frame_offset, shadow=False):
+    """
+    Returns the outline table, command offset table and commands
+    of an SLP frame that is stored at frame_offset.
+    """
+    rows = list(sprite_rows(width, height))
+
+    outline_table = bytearray()
+    offset_table = bytearray()
+    commands = bytearray()
+
+    commands_offset = frame_offset + (row_edge.size + offset_entry.size) * height
+
+    for row in rows:
+        offset_table.extend(offset_entry.pack(commands_offset + len(commands)))
+
+        if row is None:
+            outline_table.extend(row_edge.pack(0x8000, 0x8000))
+            commands.append(0x0F)
+            continue
+
+        left, right = row
+        outline_table.extend(row_edge.pack(left, right))
+        commands.extend(slp_row_commands(rng, width - left - right, shadow))
+
+    return outline_table + offset_table + commands
+
+
+def create_slp(version=b"2.0N", frame_count=32, width=96, height=96, seed=0):
+    """
+    Creates an SLP file with frame_count sprite frames.
+    Version 4.0X files also contain a shadow for every frame.
+    """
+    if version not in SLP_VERSIONS:
+        raise Exception("unsupported SLP version: %r" % version)
+
+    rng = Random(seed)
+    sizes = frame_sizes(frame_count, width, height, seed)
+    has_shadow = version == b"4.0X"
+
+    frame_infos_offset = slp_version.size + slp_header.size
+    shadow_infos_offset = frame_infos_offset + frame_count * slp_frame_info.size
+
+    if has_shadow:
+        data_offset = shadow_infos_offset + frame_count * slp_frame_info.size
+    else:
+        data_offset = shadow_infos_offset
+
+    frame_infos = bytearray()
+    frame_data = bytearray()
+
+    frame_types = [False, True] if has_shadow else [False]
+
+    for shadow in frame_types:
+        for frame_width, frame_height in sizes:
+            frame_offset = data_offset + len(frame_data)
+            frame_data.extend(slp_frame_data(rng, frame_width, frame_height,
+                                             frame_offset, shadow))
+
+            # the command offset table follows the outline table
+            frame_infos.extend(slp_frame_info.pack(
+                frame_offset + row_edge.size * frame_height,
+                frame_offset,
+                0,
+                0,
+                frame_width,
+                frame_height,
+                frame_width // 2,
+                frame_height // 2,
+            ))
+
+    if version == b"4.0X":
+        header = slp_header_v4.pack(frame_count, 1, 0, frame_count, 0,
+                                    frame_infos_offset, shadow_infos_offset)
+    else:
+        header = slp_header.pack(frame_count, b"openage synthetic")
+
+    return slp_version.pack(version) + header + frame_infos + frame_data
+
+
+def smp_layer_data(rng, width, height, frame_offset, layer_offset, shadow=False):
+    """
+    Returns the outline table, command offset table and commands
+    of an SMP layer. All offsets are relative to the frame.
+    """
+    outline_table = bytearray()
+    offset_table = bytearray()
+    commands = bytearray()
+
+    tables_size = (row_edge.size + offset_entry.size) * height
+    commands_offset = layer_offset - frame_offset + tables_size
+
+    for row in sprite_rows(width, height):
+        offset_table.extend(offset_entry.pack(commands_offset + len(commands)))
+
+        if row is None:
+            outline_table.extend(row_edge.pack(0xFFFF, 0xFFFF))
+            commands.append(0x03)
+            continue
+
+        left, right = row
+        outline_table.extend(row_edge.pack(left, right))
+
+        for run in split_runs(rng, width - left - right):
+            kind = rng.random()
+
+            if shadow:
+                # color list of alpha values
+                commands.append((run - 1) << 2 | 0x01)
+                commands.extend(rng.randrange(256) for _ in range(run))
+
+            elif kind < 0.85:
+                # color list or player color list of
+                # (index, palette, damage modifiers) pixels
+                player = kind >= 0.75
+                commands.append((run - 1) << 2 | (0x02 if player else 0x01))
+
+                for _ in range(run):
+                    if player:
+                        commands.append(rng.randrange(PLAYER_COLOR_COUNT))
+                    else:
+                        commands.append(rng.randrange(256))
+
+                    commands.extend((0, rng.randrange(256),
+                                     rng.randrange(32)))
+
+            else:
+                # skip
+                commands.append((run - 1) << 2)
+
+        # end of row
+        commands.append(0x03)
+
+    return outline_table + offset_table + commands
+
+
+def create_smp(frame_count=32, width=96, height=96, seed=0):
+    """
+    Creates an SMP file. Every frame has a main and a shadow layer.
+    """
+    rng = Random(seed)
+    sizes = frame_sizes(frame_count, width, height, seed)
+
+    frame_offsets_size = frame_count * offset_entry.size
+    data = bytearray(smp_header.size + frame_offsets_size)
+
+    frame_offsets = []
+
+    for frame_width, frame_height in sizes:
+        frame_offset = len(data)
+        frame_offsets.append(frame_offset)
+
+        layer_types = (0x02, 0x04)
+
+        # frame header and the headers of its layers
+        headers_size = smp_frame_header.size * (1 + len(layer_types))
+        layers = bytearray()
+        layer_headers = bytearray()
+
+        for layer_type in layer_types:
+            layer_offset = frame_offset + headers_size + len(layers)
+            layers.extend(smp_layer_data(rng, frame_width, frame_height,
+                                         frame_offset, layer_offset,
+                                         layer_type == 0x04))
+
+            outline_offset = layer_offset - frame_offset
+            layer_headers.extend(smp_layer_header.pack(
+                frame_width,
+                frame_height,
+                frame_width // 2,
+                frame_height // 2,
+                layer_type,
+                outline_offset,
+                outline_offset + row_edge.size * frame_height,
+                0,
+            ))
+
+        data.extend(smp_frame_header.pack(len(layer_types)))
+        data.extend(layer_headers)
+        data.extend(layers)
+
+    for idx, frame_offset in enumerate(frame_offsets):
+        offset_entry.pack_into(data, smp_header.size + idx * offset_entry.size,
+                               frame_offset)
+
+    smp_header.pack_into(data, 0, b"SMP$", 0x0B, frame_count, 1, frame_count,
+                         0, len(data), 0x0C, b"openage synthetic")
+
+    return bytes(data)
+
+
+def create_smx(frame_count=32, width=96, height=96, seed=0):
+    """
+    Creates an SMX file with 4plus1 compressed main layers.
+    """
+    rng = Random(seed)
+    sizes = frame_sizes(frame_count, width, height, seed)
+
+    frames = bytearray()
+
+    for frame_width, frame_height in sizes:
+        outline_table = bytearray()
+        commands = bytearray()
+
+        # palette indices and palette sections of the drawn pixels
+        pixels = []
+
+        for row in sprite_rows(frame_width, frame_height):
+            if row is None:
+                outline_table.extend(row_edge.pack(0xFFFF, 0xFFFF))
+                commands.append(0x03)
+                continue
+
+            left, right = row
+            outline_table.extend(row_edge.pack(left, right))
+
+            for run in split_runs(rng, frame_width - left - right):
+                kind = rng.random()
+
+                if kind < 0.85:
+                    player = kind >= 0.75
+                    commands.append((run - 1) << 2 | (0x02 if player else 0x01))
+
+                    for _ in range(run):
+                        if player:
+                            pixels.append((rng.randrange(PLAYER_COLOR_COUNT), 0))
+                        else:
+                            pixels.append((rng.randrange(256), 0))
+
+                else:
+                    commands.append((run - 1) << 2)
+
+            commands.append(0x03)
+
+        # 4 palette indices per chunk, followed by their palette sections.
+        # the decoder peeks at the chunk after the last pixel,
+        # so there is always one more.
+        colors = bytearray()
+        for chunk_start in range(0, len(pixels) + 4, 4):
+            chunk = pixels[chunk_start:chunk_start + 4]
+            chunk.extend([(0, 0)] * (4 - len(chunk)))
+
+            sections = 0
+            for idx, (index, section) in enumerate(chunk):
+                colors.append(index)
+                sections |= section << (2 * idx)
+
+            colors.append(sections)
+
+        frames.extend(smx_frame_header.pack(0x01, 0, 0))
+        frames.extend(smx_layer_header.pack(frame_width, frame_height,
+                                            frame_width // 2, frame_height // 2,
+                                            0, 0))
+        frames.extend(outline_table)
+        frames.extend(offset_entry.pack(len(commands)))
+        frames.extend(offset_entry.pack(len(colors)))
+        frames.extend(commands)
+        frames.extend(colors)
+
+    header = smx_header.pack(b"SMPX", 2, frame_count, len(frames), 0,
+                             b"openage synth")
+
+    return header + frames
+
+
+def create_palette(seed=0, entry_count=256):
+    """
+    Creates a JASC palette file with random colors.
+    """
+    rng = Random(seed)
+
+    lines = ["JASC-PAL", "0100", str(entry_count)]
+    lines.extend("%d %d %d" % (rng.randrange(256),
+                               rng.randrange(256),
+                               rng.randrange(256))
+                 for _ in range(entry_count))
+    lines.append("")
+
+    return "\r\n".join(lines).encode('ascii')
+
+
+def create_wav(duration=2.0, rate=44100, channels=2, seed=0):
+    """
+    Creates a 16 bit PCM wave file with a few
+    mixed tones and some noise.
+    """
+    rng = Random(seed)
+    tones = [rng.uniform(110, 880) for _ in range(3)]
+
+    frames = bytearray()
+    sample = Struct("< h")
+
+    for idx in range(int(duration * rate)):
+        time = idx / rate
+        value = sum(math.sin(2 * math.pi * tone * time) for tone in tones) / 4
+        value += rng.uniform(-0.05, 0.05)
+
+        for _ in range(channels):
+            frames.extend(sample.pack(int(value * 32767)))
+
+    wavfile = BytesIO()
+    with wave.open(wavfile, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(frames)
+
+    return wavfile.getvalue()
+
+
+def create_drs(files, copyright_text=b"openage synthetic archive"):
+    """
+    Creates a DRS archive.
+
+    :param files: List of (file id, file extension, content).
+    """
+    # table for each extension, in the order of appearance
+    tables = {}
+    for file_id, extension, content in files:
+        tables.setdefault(extension, []).append((file_id, content))
+
+    tables_offset = drs_header.size
+    infos_offset = tables_offset + len(tables) * drs_table_info.size
+    data_offset = infos_offset + len(files) * drs_file_info.size
+
+    table_infos = bytearray()
+    file_infos = bytearray()
+    file_data = bytearray()
+
+    for extension, table_files in tables.items():
+        # extensions are stored reversed, padded with spaces
+        stored_extension = extension.encode('ascii').ljust(4)[::-1]
+
+        table_infos.extend(drs_table_info.pack(
+            stored_extension,
+            infos_offset + len(file_infos),
+            len(table_files),
+        ))
+
+        for file_id, content in table_files:
+            file_infos.extend(drs_file_info.pack(
+                file_id, data_offset + len(file_data), len(content)))
+            file_data.extend(content)
+
+    header = drs_header.pack(copyright_text, b"1.00", b"tribe",
+                             len(tables), data_offset)
+
+    return header + table_infos + file_infos + file_data
+
+
+def create_cab(files):
+    """
+    Creates a CAB cabinet with a single uncompressed folder.
+
+    The cabextract module only decompresses LZX,
+    which is out of scope for a fixture generator.
+
+    :param files: List of (file name, content).
+    """
+    from ...cabextract.cabchecksum import mscab_csum
+
+    folder_data = b"".join(content for _, content in files)
+
+    file_entries = bytearray()
+    position = 0
+    for name, content in files:
+        # 2020-01-01 00:00
+        file_entries.extend(cab_file.pack(len(content), position, 0,
+                                          (40 << 9) | (1 << 5) | 1, 0, 0))
+        file_entries.extend(name.encode('ascii') + b"\x00")
+        position += len(content)
+
+    files_offset = cab_header.size + cab_folder.size
+    data_offset = files_offset + len(file_entries)
+
+    blocks = bytearray()
+    block_count = 0
+    for block_start in range(0, len(folder_data), CAB_BLOCK_SIZE):
+        payload = folder_data[block_start:block_start + CAB_BLOCK_SIZE]
+        checksum = (len(payload) << 16 | len(payload)) ^ mscab_csum(payload)
+
+        blocks.extend(cab_data.pack(checksum, len(payload), len(payload)))
+        blocks.extend(payload)
+        block_count += 1
+
+    header = cab_header.pack(b"MSCF", 0, data_offset + len(blocks), 0,
+                             files_offset, 0, 3, 1, 1, len(files), 0, 0, 0)
+    folder = cab_folder.pack(data_offset, block_count, 0)
+
+    return header + folder + file_entries + blocks
+
+
+class SyntheticDat(GenieStructure):
+    """
+    Data file with some of the record types of empires.dat.
+
+    A complete empires.dat has far too many interdependent
+    records to be generated, but the records are read by the same
+    machinery, so this is enough for benchmarking the reader.
+    """
+
+    name_struct_file   = "synthetic"
+    name_struct        = "synthetic_dat"
+    struct_description = "synthetic data file for the benchmarks"
+
+    data_format = [
+        (READ, "versionstr", StorageType.STRING_MEMBER, "char[8]"),
+        (READ, "player_color_count", StorageType.INT_MEMBER, "uint16_t"),
+        (READ_EXPORT, "player_colors", StorageType.ARRAY_CONTAINER, SubdataMember(
+            ref_type=PlayerColor,
+            length="player_color_count",
+        )),
+        (READ, "sound_count", StorageType.INT_MEMBER, "uint16_t"),
+        (READ, "sound_ptrs", StorageType.ARRAY_ID, "int32_t[sound_count]"),
+        (READ_EXPORT, "sounds", StorageType.ARRAY_CONTAINER, SubdataMember(
+            ref_type=Sound,
+            length="sound_count",
+        )),
+    ]
+
+
+def create_dat(sound_count=2000, player_color_count=16, seed=0):
+    """
+    Creates a compressed data file in the layout of SyntheticDat.
+    Like empires.dat, it is compressed with raw deflate.
+    """
+    rng = Random(seed)
+
+    player_color = Struct("< 9i")
+    sound = Struct("< h h H i")
+    sound_item = Struct("< 13s i h h h")
+
+    data = bytearray(b"VER 5.7\x00")
+
+    data.extend(Struct("< H").pack(player_color_count))
+    for color_id in range(player_color_count):
+        data.extend(player_color.pack(color_id, 16 * (color_id + 1),
+                                      *(rng.randrange(256) for _ in range(7))))
+
+    data.extend(Struct("< H").pack(sound_count))
+    data.extend(Struct("< %di" % sound_count).pack(*(1 for _ in range(sound_count))))
+
+    for sound_id in range(sound_count):
+        item_count = rng.randint(1, 6)
+        data.extend(sound.pack(sound_id, rng.randrange(100), item_count, 300000))
+
+        for _ in range(item_count):
+            filename = ("s%07d.wav" % rng.randrange(10 ** 7)).encode('ascii')
+            data.extend(sound_item.pack(filename, rng.randrange(100000),
+                                        rng.randrange(100), rng.randrange(-1, 40),
+                                        -1))
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(bytes(data)) + compressor.flush()
+
+
+class SyntheticAssets:
+    """
+    Set of generated assets for the benchmarks.
+    Each asset is created on first access.
+    """
+
+    def __init__(self, frame_count=32, width=96, height=96, seed=0,
+                 audio_duration=2.0, dat_records=2000):
+        self.frame_count = frame_count
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.audio_duration = audio_duration
+        self.dat_records = dat_records
+
+        # asset name -> content
+        self.assets = {}
+
+    def get(self, name, create, *args):
+        """
+        Returns the asset with the given name, created with create(*args).
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            asset = create(*args)
+            self.assets[name] = asset
+
+        return asset
+
+    def slp(self, version):
+        """ SLP of the given version """
+        return self.get(("slp", version), create_slp, version,
+                        self.frame_count, self.width, self.height, self.seed)
+
+    def smp(self):
+        """ SMP with main and shadow layers """
+        return self.get("smp", create_smp, self.frame_count,
+                        self.width, self.height, self.seed)
+
+    def smx(self):
+        """ SMX with main layers """
+        return self.get("smx", create_smx, self.frame_count,
+                        self.width, self.height, self.seed)
+
+    def palette(self):
+        """ main palette file """
+        return self.get("palette", create_palette, self.seed)
+
+    def player_palette(self):
+        """ player color palette file """
+        return self.get("player_palette", create_palette, self.seed + 1,
+                        PLAYER_COLOR_COUNT)
+
+    def wav(self):
+        """ 16 bit PCM stereo wave file """
+        return self.get("wav", create_wav, self.audio_duration,
+                        44100, 2, self.seed)
+
+    def dat(self):
+        """ compressed SyntheticDat file """
+        return self.get("dat", create_dat, self.dat_records, 16, self.seed)
+
+    def archive_files(self):
+        """
+        Returns the (file id, extension, content) of the files
+        for the archives: all sprites and the sound.
+        """
+        files = [(index, "slp", self.slp(version))
+                 for index, version in enumerate(SLP_VERSIONS)]
+        files.append((100, "wav", self.wav()))
+        return files
+
+    def drs(self):
+        """ DRS archive of the sprites and the sound """
+        return self.get("drs", create_drs, self.archive_files())
+
+    def cab(self):
+        """ CAB cabinet of the sprites and the sound """
+        return self.get("cab", create_cab, [
+            ("%d.%s" % (file_id, extension), content)
+            for file_id, extension, content in self.archive_files()
+        ])
+
+    def get_config(self):
+        """
+        Returns the generation parameters.
+        """
+        return {
+            "frame_count": self.frame_count,
+            "width": self.width,
+            "height": self.height,
+            "seed": self.seed,
+            "audio_duration": self.audio_duration,
+            "dat_records": self.dat_records,
+        }
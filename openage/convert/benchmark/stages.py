@@ -0,0 +1,383 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Benchmarks of the converter stages on synthetic assets.
+
+Every stage yields workloads: (fixture name, function, input size in
+bytes, frame count). The functions only do the work of the stage, all
+preparations (e.g. decoding the sprites for the palette stage)
+are done before the workload is yielded.
+"""
+
+import argparse
+from collections import OrderedDict
+from io import BytesIO, StringIO
+import json
+import platform
+import sys
+from time import perf_counter
+
+from ...log import info
+from .fixtures import SyntheticAssets, SyntheticDat, SLP_VERSIONS
+
+
+def parse_stage(assets):
+    """
+    Reading the archives and the data file.
+    """
+    from ..drs import DRS
+    from ...cabextract.cab import CABFile
+    from zlib import decompress
+
+    drs_data = assets.drs()
+
+    def parse_drs():
+        """ reads all files from the DRS archive """
+        archive = DRS(BytesIO(drs_data))
+        for name in archive.root.iterdir():
+            with name.open("rb") as infile:
+                infile.read()
+
+    yield "drs", parse_drs, len(drs_data), 0
+
+    cab_data = assets.cab()
+
+    def parse_cab():
+        """ reads all files from the CAB cabinet """
+        cabinet = CABFile(BytesIO(cab_data))
+        for name in cabinet.root.iterdir():
+            with name.open("rb") as infile:
+                infile.read()
+
+    yield "cab", parse_cab, len(cab_data), 0
+
+    dat_data = assets.dat()
+
+    def parse_dat():
+        """ decompresses and reads the data file """
+        SyntheticDat().read(decompress(dat_data, -15), 0)
+
+    yield "dat", parse_dat, len(dat_data), 0
+
+
+def decode_stage(assets):
+    """
+    Decoding the drawing commands of the sprites.
+    """
+    from ..slp import SLP
+    from ..smp import SMP
+    from ..smx import SMX
+
+    for version in SLP_VERSIONS:
+        data = assets.slp(version)
+        yield ("slp-%s" % version.decode('ascii').rstrip('\x00'),
+               lambda data=data: SLP(data), len(data), assets.frame_count)
+
+    data = assets.smp()
+    yield "smp", lambda: SMP(data), len(data), assets.frame_count
+
+    data = assets.smx()
+    yield "smx", lambda: SMX(data), len(data), assets.frame_count
+
+
+def get_palettes(assets):
+    """
+    Returns the main and player ColorTables.
+    """
+    from ..colortable import ColorTable
+
+    return (ColorTable(assets.palette()),
+            ColorTable(assets.player_palette()))
+
+
+def palette_stage(assets):
+    """
+    Resolving the palette indices of the decoded frames to colors.
+    """
+    from ..slp import SLP
+    from ..smp import SMP
+    from ..smx import SMX
+
+    main_palette, player_palette = get_palettes(assets)
+
+    sprites = [("slp-%s" % version.decode('ascii').rstrip('\x00'),
+                SLP(assets.slp(version)))
+               for version in SLP_VERSIONS]
+    sprites.append(("smp", SMP(assets.smp())))
+    sprites.append(("smx", SMX(assets.smx())))
+
+    for name, sprite in sprites:
+        frames = sprite.main_frames
+
+        def resolve(frames=frames):
+            """ resolves the colors of all frames """
+            for frame in frames:
+                frame.get_picture_data(main_palette, player_palette)
+
+        size = sum(frame.get_picture_data(main_palette, player_palette).nbytes
+                   for frame in frames)
+
+        yield name, resolve, size, len(frames)
+
+
+def pack_stage(assets):
+    """
+    Packing the frames of the sprites into texture atlases.
+    """
+    from ..binpack import (Block, BestPacker, ColumnPacker, RowPacker,
+                           SkylinePacker)
+    from ..hardcoded.texture import MARGIN, TERRAIN_ASPECT_RATIO
+    from .fixtures import frame_sizes
+
+    sizes = frame_sizes(assets.frame_count, assets.width, assets.height,
+                        assets.seed)
+
+    def pack():
+        """ packs the frames like texture.merge_frames(), but uncached """
+        packer = BestPacker([SkylinePacker(margin=MARGIN, aspect_ratio=1),
+                             SkylinePacker(margin=MARGIN,
+                                           aspect_ratio=TERRAIN_ASPECT_RATIO),
+                             RowPacker(margin=MARGIN),
+                             ColumnPacker(margin=MARGIN)])
+        packer.pack([Block(width, height) for width, height in sizes])
+
+    yield "frames", pack, 0, len(sizes)
+
+
+def png_stage(assets):
+    """
+    Encoding the colored frames to PNG.
+    """
+    from ..png.png_create import COMPRESSION_PRESETS, save
+    from ..slp import SLP
+
+    main_palette, player_palette = get_palettes(assets)
+
+    images = [frame.get_picture_data(main_palette, player_palette)
+              for frame in SLP(assets.slp(SLP_VERSIONS[0])).main_frames]
+    size = sum(image.nbytes for image in images)
+
+    for compression in sorted(COMPRESSION_PRESETS):
+        def encode(compression=compression):
+            """ encodes all images """
+            for image in images:
+                save(image, compression)
+
+        yield "rgba-%s" % compression, encode, size, len(images)
+
+
+def opus_stage(assets):
+    """
+    Encoding the sound to opus.
+    """
+    from ..opus.opusenc import encode
+
+    data = assets.wav()
+    yield "wav", lambda: encode(data), len(data), 0
+
+
+def nyan_stage(assets):
+    """
+    Writing nyan objects to a file.
+    """
+    from ...nyan.nyan_structs import (MemberOperator, MemberType, NyanMember,
+                                      NyanObject)
+
+    unit = NyanObject("Unit", members=[
+        NyanMember("hp", MemberType.INT),
+        NyanMember("speed", MemberType.FLOAT),
+        NyanMember("name", MemberType.TEXT),
+    ])
+
+    objects = []
+    for idx in range(assets.dat_records):
+        armors = NyanObject("Armors", members=[
+            NyanMember("values", MemberType.SET, {idx, idx + 1, idx + 2},
+                       MemberOperator.ASSIGN, set_type=MemberType.INT),
+        ])
+
+        obj = NyanObject("Unit%d" % idx, parents=[unit],
+                         nested_objects=[armors])
+        obj.get_member_by_name("hp", unit).set_value(idx, MemberOperator.ASSIGN)
+        obj.get_member_by_name("speed", unit).set_value(0.5 + idx / 1000,
+                                                        MemberOperator.ASSIGN)
+        obj.get_member_by_name("name", unit).set_value("unit %d" % idx,
+                                                       MemberOperator.ASSIGN)
+        objects.append(obj)
+
+    def write():
+        """ writes all objects """
+        outfile = StringIO()
+        for obj in objects:
+            obj.write(outfile)
+        return outfile
+
+    size = len(write().getvalue().encode('utf-8'))
+
+    yield "objects", write, size, 0
+
+
+# stage name -> function that yields the workloads
+STAGES = OrderedDict((
+    ("parse", parse_stage),
+    ("decode", decode_stage),
+    ("palette", palette_stage),
+    ("pack", pack_stage),
+    ("png", png_stage),
+    ("opus", opus_stage),
+    ("nyan", nyan_stage),
+))
+
+
+def measure(stage, fixture, func, size, frames, repeat=3):
+    """
+    Runs func repeat times and returns the result of the fastest run.
+    """
+    seconds = None
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        duration = perf_counter() - start
+
+        if seconds is None or duration < seconds:
+            seconds = duration
+
+    result = OrderedDict((
+        ("stage", stage),
+        ("fixture", fixture),
+        ("seconds", seconds),
+        ("bytes", size),
+        ("frames", frames),
+        ("mb_per_s", None),
+        ("frames_per_s", None),
+    ))
+
+    if seconds > 0:
+        if size:
+            result["mb_per_s"] = size / seconds / 1e6
+        if frames:
+            result["frames_per_s"] = frames / seconds
+
+    return result
+
+
+def run_stages(assets, stages=None, repeat=3):
+    """
+    Benchmarks the given stages, or all of them.
+
+    Returns a list with the result of every workload.
+    """
+    results = []
+
+    for stage in stages or STAGES:
+        for fixture, func, size, frames in STAGES[stage](assets):
+            result = measure(stage, fixture, func, size, frames, repeat)
+            info("%-8s %-14s %9.4f s", stage, fixture, result["seconds"])
+            results.append(result)
+
+    return results
+
+
+def create_report(assets, results):
+    """
+    Returns the machine-readable report of the results.
+    """
+    return OrderedDict((
+        ("python", platform.python_version()),
+        ("machine", platform.machine()),
+        ("assets", assets.get_config()),
+        ("results", results),
+    ))
+
+
+# the workloads of the stages on the default assets, for benchmark_*()
+DEFAULT_ASSETS = SyntheticAssets()
+WORKLOADS = {}
+
+
+def run_workloads(stage):
+    """
+    Runs all workloads of the stage once.
+    """
+    workloads = WORKLOADS.get(stage)
+    if workloads is None:
+        workloads = list(STAGES[stage](DEFAULT_ASSETS))
+        WORKLOADS[stage] = workloads
+
+    for _, func, _, _ in workloads:
+        func()
+
+
+def benchmark_parse():
+    """ Reads synthetic DRS and CAB archives and a data file. """
+    run_workloads("parse")
+
+
+def benchmark_decode():
+    """ Decodes synthetic SLP, SMP and SMX sprites. """
+    run_workloads("decode")
+
+
+def benchmark_palette():
+    """ Resolves the colors of decoded synthetic sprites. """
+    run_workloads("palette")
+
+
+def benchmark_pack():
+    """ Packs the frames of a synthetic sprite into an atlas. """
+    run_workloads("pack")
+
+
+def benchmark_png():
+    """ Encodes the frames of a synthetic sprite to PNG. """
+    run_workloads("png")
+
+
+def benchmark_opus():
+    """ Encodes a synthetic sound to opus. """
+    run_workloads("opus")
+
+
+def benchmark_nyan():
+    """ Writes synthetic nyan objects. """
+    run_workloads("nyan")
+
+
+def report(args):
+    """
+    Benchmarks the converter stages and writes a JSON report.
+    """
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--frames", type=int, default=32,
+                     help="number of frames per sprite")
+    cli.add_argument("--width", type=int, default=96,
+                     help="average width of the frames")
+    cli.add_argument("--height", type=int, default=96,
+                     help="average height of the frames")
+    cli.add_argument("--seed", type=int, default=0,
+                     help="seed for generating the assets")
+    cli.add_argument("--records", type=int, default=2000,
+                     help="number of data records and nyan objects")
+    cli.add_argument("--repeat", type=int, default=3,
+                     help="runs per workload; the fastest run is reported")
+    cli.add_argument("--stage", action="append", choices=list(STAGES),
+                     help="only run this stage; may be given several times")
+    cli.add_argument("--output", "-o", default=None, metavar="report.json",
+                     help="file for the report, instead of stdout")
+    args = cli.parse_args(args)
+
+    assets = SyntheticAssets(args.frames, args.width, args.height,
+                             args.seed, dat_records=args.records)
+
+    results = run_stages(assets, args.stage, args.repeat)
+    result_report = create_report(assets, results)
+
+    if args.output is None:
+        json.dump(result_report, sys.stdout, indent=4)
+        print()
+
+    else:
+        with open(args.output, "w") as outfile:
+            json.dump(result_report, outfile, indent=4)
+
+    return 0
@@ -1,11 +1,14 @@
-# Copyright 2016-2016 the openage authors. See copying.md for legal info.
+# Copyright 2016-2020 the openage authors. See copying.md for legal info.
 
 """ Routines for 2D binpacking """
 
 # TODO pylint: disable=C,R
 
 
+from collections import OrderedDict
+import heapq
 import math
+from threading import Lock
 
 
 def factor(n):
@@ -54,9 +57,13 @@ class RowPacker(Packer):
         rows = [[] for _ in range(num_rows)]
 
         # Put blocks into rows.
+        # the heap entries are (row width, row index), so the narrowest row
+        # is found without summing up the widths for every block.
+        row_widths = [(0, idx) for idx in range(num_rows)]
         for block in blocks:
-            min_row = min(rows, key=lambda row: sum(b.width for b in row))
-            min_row.append(block)
+            width, idx = row_widths[0]
+            rows[idx].append(block)
+            heapq.heapreplace(row_widths, (width + block.width, idx))
 
         # Calculate positions.
         y = 0
@@ -82,9 +89,12 @@ class ColumnPacker(Packer):
         columns = [[] for _ in range(num_columns)]
 
         # Put blocks into columns.
+        # the heap entries are (column height, column index).
+        column_heights = [(0, idx) for idx in range(num_columns)]
         for block in blocks:
-            min_col = min(columns, key=lambda col: sum(b.height for b in col))
-            min_col.append(block)
+            height, idx = column_heights[0]
+            columns[idx].append(block)
+            heapq.heapreplace(column_heights, (height + block.height, idx))
 
         # Calculate positions.
         x = 0
@@ -124,6 +134,95 @@ class BestPacker:
         return self.current_best.height()
 
 
+class Block:
+    """A placeholder block that only has a size."""
+
+    __slots__ = ('width', 'height')
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+
+class PackingCache:
+    """
+    Stores the results of packings, keyed on the multiset of block sizes.
+
+    Many sprites share the same frame geometry, and blocks of equal size are
+    interchangeable, so one packing can be reused for all of them.
+    The least recently used results are dropped when the cache is full.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        Returns (width, height, positions) for the sizes in key,
+        or None if the packing is not known.
+        """
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+
+            return result
+
+    def put(self, key, result):
+        """
+        Stores the result of a packing.
+        """
+        with self.lock:
+            self.results[key] = result
+
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+
+
+class CachingPacker(Packer):
+    """
+    Wraps another packer, and reuses its results from the given
+    PackingCache for blocks with the same sizes.
+    """
+
+    def __init__(self, packer, cache):
+        super().__init__(0)
+        self.packer = packer
+        self.cache = cache
+        self.size = None
+
+    def pack(self, blocks):
+        # pack the blocks in a canonical order, so the result only depends
+        # on the sizes of the blocks.
+        order = sorted(range(len(blocks)),
+                       key=lambda idx: (blocks[idx].width, blocks[idx].height))
+        key = tuple((blocks[idx].width, blocks[idx].height) for idx in order)
+
+        result = self.cache.get(key)
+        if result is None:
+            placeholders = [Block(width, height) for width, height in key]
+            self.packer.pack(placeholders)
+
+            result = (self.packer.width(),
+                      self.packer.height(),
+                      tuple(self.packer.pos(block) for block in placeholders))
+
+            self.cache.put(key, result)
+
+        width, height, positions = result
+
+        self.size = width, height
+        self.mapping = {blocks[idx]: pos for idx, pos in zip(order, positions)}
+
+    def width(self):
+        return self.size[0]
+
+    def height(self):
+        return self.size[1]
+
+
 class PackerNode:
     """A node in a binary packing tree."""
 
@@ -249,3 +348,121 @@ class BinaryTreePacker(Packer):
         node = self.find_node(self.root, width, height)
         if node is not None:
             return self.split_node(node, width, height)
+
+
+def height_heuristic(block):
+    """Heuristic: Order blocks by height."""
+    return (block.height, block.width)
+
+
+class SkylinePacker(Packer):
+    """
+    Skyline bin packing strategy.
+
+    The blocks are placed bottom-left into a bin of fixed width. The free
+    space is tracked incrementally by the skyline: the list of the top edges
+    of the already placed blocks.
+
+    The bin width is chosen so the packing approximates the given aspect
+    ratio (width / height).
+    """
+    def __init__(self, margin, aspect_ratio=1, heuristic=height_heuristic):
+        super().__init__(margin)
+        self.aspect_ratio = aspect_ratio
+        self.heuristic = heuristic
+
+        self.bin_width = None
+
+        # skyline segments [x, y, width], ordered by x.
+        # they cover the whole bin width.
+        self.skyline = None
+
+    def pack(self, blocks):
+        self.mapping = {}
+
+        if not blocks:
+            return
+
+        area = sum((block.width + self.margin) * (block.height + self.margin)
+                   for block in blocks)
+        max_width = max(block.width for block in blocks) + self.margin
+
+        self.bin_width = max(max_width,
+                             math.ceil(math.sqrt(area * self.aspect_ratio)))
+        self.skyline = [[0, 0, self.bin_width]]
+
+        for block in sorted(blocks, key=self.heuristic, reverse=True):
+            self.mapping[block] = self.fit(block.width + self.margin,
+                                           block.height + self.margin)
+
+    def fit(self, width, height):
+        """
+        Places a block of the given size at the position where its top edge
+        is the lowest (leftmost for equal heights), and returns the position.
+        """
+        best_top = None
+        best = None
+
+        for idx, segment in enumerate(self.skyline):
+            y = self.fit_at(idx, width)
+            if y is None:
+                # the remaining segments are even further right
+                break
+
+            if best_top is None or y + height < best_top:
+                best_top = y + height
+                best = idx, segment[0], y
+
+        idx, x, y = best
+        self.add_segment(idx, x, y + height, width)
+
+        return x, y
+
+    def fit_at(self, idx, width):
+        """
+        Returns the y coordinate of a block of the given width placed
+        at the start of the idx-th segment, or None if it doesn't fit.
+        """
+        x = self.skyline[idx][0]
+        if x + width > self.bin_width:
+            return None
+
+        y = 0
+        remaining = width
+        while remaining > 0:
+            _, seg_y, seg_width = self.skyline[idx]
+            y = max(y, seg_y)
+            remaining -= seg_width
+            idx += 1
+
+        return y
+
+    def add_segment(self, idx, x, y, width):
+        """
+        Raises the skyline to y from x to x + width;
+        the idx-th segment starts at x.
+        """
+        end = x + width
+
+        # shrink or remove the segments below the new one
+        while idx < len(self.skyline) and self.skyline[idx][0] < end:
+            segment = self.skyline[idx]
+            seg_end = segment[0] + segment[2]
+
+            if seg_end <= end:
+                del self.skyline[idx]
+            else:
+                segment[2] = seg_end - end
+                segment[0] = end
+                break
+
+        self.skyline.insert(idx, [x, y, width])
+
+        # merge with neighbors of the same height
+        if idx + 1 < len(self.skyline) and self.skyline[idx + 1][1] == y:
+            self.skyline[idx][2] += self.skyline[idx + 1][2]
+            del self.skyline[idx + 1]
+
+        if idx > 0 and self.skyline[idx - 1][1] == y:
+            self.skyline[idx - 1][2] += self.skyline[idx][2]
+            del self.skyline[idx]
@@ -1,7 +1,8 @@
-# Copyright 2013-2019 the openage authors. See copying.md for legal info.
+# Copyright 2013-2020 the openage authors. See copying.md for legal info.
 
 # TODO pylint: disable=C,R
 
+import hashlib
 import math
 
 from openage.convert.dataformat.genie_structure import GenieStructure
@@ -33,6 +34,7 @@ class ColorTable(GenieStructure):
 
     def fill_from_array(self, ar):
         self.palette = [tuple(e) for e in ar]
+        self.rgba_array = None
 
     def fill(self, data):
         # split all lines of the input data
@@ -53,6 +55,7 @@ class ColorTable(GenieStructure):
         entry_count = int(lines[2])
 
         self.palette = []
+        self.rgba_array = None
 
         # data entries are line 3 to n
         for line in lines[3:entry_count + 3]:
@@ -69,6 +72,37 @@ class ColorTable(GenieStructure):
     def __getitem__(self, index):
         return self.palette[index]
 
+    def get_rgba_array(self):
+        """
+        Returns the palette as (N, 4) numpy array of uint8 rgba values,
+        for resolving whole images with a single lookup.
+        Entries without alpha value are fully opaque.
+
+        The array is created on first access and cached.
+        """
+        if self.rgba_array is None:
+            import numpy
+
+            entries = numpy.array(self.palette, dtype=numpy.uint8)
+            entries = entries.reshape(len(self.palette), -1)
+
+            rgba_array = numpy.full((len(self.palette), 4), 255,
+                                    dtype=numpy.uint8)
+            rgba_array[:, :entries.shape[1]] = entries
+
+            # the cached table is shared, so nobody may modify it
+            rgba_array.setflags(write=False)
+            self.rgba_array = rgba_array
+
+        return self.rgba_array
+
+    def get_digest(self):
+        """
+        Returns a hash of the color entries, e.g. for detecting whether
+        cached conversion results still match this palette.
+        """
+        return hashlib.sha256(repr(self.palette).encode()).hexdigest()
+
     def __len__(self):
         return len(self.palette)
 
@@ -181,6 +215,7 @@ class PlayerColorTable(ColorTable):
         self.header = base_table.header
         self.version = base_table.version
         self.palette = list()
+        self.rgba_array = None
         # now, strip the base table entries to the player colors.
 
         # entry id = ((playernum-1) * 8) + subcolor
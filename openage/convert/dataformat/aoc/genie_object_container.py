@@ -64,5 +64,53 @@ class GenieObjectContainer(ConverterObjectContainer):
         self.graphics_exports = {}
         self.sound_exports = {}
 
+        # Lookup indexes, built once the objects are created
+        # key: connection object; value: dict with connection types as keys
+        # and the connected ids of that type as values
+        self.connection_index = {}
+
+    def index_connections(self):
+        """
+        Indexes the other_connections of the age, building, unit
+        and tech connections by their connection type.
+        """
+        for connections in (self.age_connections, self.building_connections,
+                            self.unit_connections, self.tech_connections):
+            for connection in connections.values():
+                self.connection_index[connection] = self._create_connection_index(connection)
+
+    def get_connected_ids(self, connection, connection_type):
+        """
+        Returns the ids of other objects that a connection references
+        with the given connection type, in their original order.
+
+        :param connection: Age, building, unit or tech connection.
+        :param connection_type: 0 = age, 1 = building, 2 = unit, 3 = tech
+        """
+        index = self.connection_index.get(connection)
+
+        if index is None:
+            index = self._create_connection_index(connection)
+            self.connection_index[connection] = index
+
+        return index.get(connection_type, [])
+
+    @staticmethod
+    def _create_connection_index(connection):
+        """
+        Returns a dict that maps the connection types of other_connections
+        to the ids in other_connected_ids.
+        """
+        index = {}
+
+        connected_types = connection.get_member("other_connections").get_value()
+        connected_ids = connection.get_member("other_connected_ids").get_value()
+
+        for connected_type, connected_id in zip(connected_types, connected_ids):
+            type_id = connected_type.get_value()["other_connection"].get_value()
+            index.setdefault(type_id, []).append(connected_id.get_value())
+
+        return index
+
     def __repr__(self):
         return "GenieObjectContainer"
@@ -67,14 +67,19 @@ class GenieGameEntityGroup(ConverterObjectGroup):
         # List of GenieTechEffectBundleGroup objects
         self.researches = []
 
+        # Sets of the above for quick membership tests
+        self.creates_set = set()
+        self.researches_set = set()
+
     def add_creatable(self, line):
         """
         Adds another line to the list of creatables.
 
         :param line: The GenieBuildingLineGroup the villager produces.
         """
-        if not self.contains_creatable(line.get_head_unit_id()):
+        if line not in self.creates_set:
             self.creates.append(line)
+            self.creates_set.add(line)
 
     def add_researchable(self, tech_group):
         """
@@ -82,8 +87,9 @@ class GenieGameEntityGroup(ConverterObjectGroup):
 
         :param tech_group: The GenieTechLineGroup the building researches.
         """
-        if not self.contains_researchable(tech_group.get_id()):
+        if tech_group not in self.researches_set:
             self.researches.append(tech_group)
+            self.researches_set.add(tech_group)
 
     def add_unit(self, genie_unit, position=-1, after=None):
         """
@@ -133,7 +139,7 @@ class GenieGameEntityGroup(ConverterObjectGroup):
         elif isinstance(self, GenieBuildingLineGroup):
             line = self.data.unit_lines[line_id]
 
-        return line in self.creates
+        return line in self.creates_set
 
     def contains_entity(self, unit_id):
         """
@@ -148,7 +154,7 @@ class GenieGameEntityGroup(ConverterObjectGroup):
         """
         tech_line = self.data.tech_groups[line_id]
 
-        return tech_line in self.researches
+        return tech_line in self.researches_set
 
     def is_creatable(self):
         """
@@ -621,9 +627,6 @@ class GenieVillagerGroup(GenieUnitLineGroup):
             task_group = self.data.task_groups[task_group_id]
             self.variants.append(task_group)
 
-        # List of buildings that units can create
-        self.creates = []
-
     def is_creatable(self):
         """
         Villagers are creatable if any of their variant task groups are creatable.
@@ -6,6 +6,7 @@ Objects that represent data structures in the original game.
 These are simple containers that can be processed by the converter.
 """
 
+from .member_diff import MemberDiff, diff_members
 from .value_members import ValueMember
 from ...nyan.nyan_structs import NyanObject, MemberOperator
 from .aoc.expected_pointer import ExpectedPointer
@@ -114,6 +115,35 @@ class ConverterObject:
 
         return ConverterObject("%s-%s-diff" % (self.obj_id, other.get_id()), members=obj_diff)
 
+    def compact_diff(self, other):
+        """
+        Returns the diff between two objects as MemberDiff,
+        or None if they are equal.
+
+        Bit i of the diff's mask refers to the i-th member of the object.
+        The plain values are compared, so no members are created
+        for the diff. Use MemberDiff.get_named() to get the diff
+        values by member name.
+        """
+        if type(self) is not type(other):
+            raise Exception("type %s cannot be diffed with type %s"
+                            % (type(self), type(other)))
+
+        mask = 0
+        values = []
+
+        for index, (member_id, member) in enumerate(self.members.items()):
+            member_diff = diff_members(member, other.get_member(member_id))
+
+            if member_diff is not None:
+                mask |= 1 << index
+                values.append(member_diff)
+
+        if not values:
+            return None
+
+        return MemberDiff(mask, values)
+
     def __getitem__(self, key):
         """
         Short command for getting a member of the object.
@@ -5,11 +5,13 @@
 import hashlib
 import math
 import struct
+from array import array as typed_array
 
 from ..export.util import struct_type_lookup
 from ...util.strings import decode_until_null
 
-from .member_access import READ, READ_EXPORT, READ_UNKNOWN, NOREAD_EXPORT
+from .member_access import READ_EXPORT, READ_UNKNOWN, NOREAD_EXPORT
+from .read_plan import get_read_plan
 from .read_members import (IncludeMembers, ContinueReadMember,
                            MultisubtypeMember, GroupMember, SubdataMember,
                            ReadMember,
@@ -19,6 +21,17 @@ from ..export.struct_definition import (StructDefinition, vararray_match,
 from .value_members import MemberTypes as StorageType
 from .value_members import ContainerMember,\
     ArrayMember, IntMember, FloatMember, StringMember, BooleanMember, IDMember
+from .value_members import PackedArrayMember
+
+
+# array storage types that are stored in a PackedArrayMember:
+# array type -> element type
+PACKED_ARRAY_ELEMENTS = {
+    StorageType.ARRAY_INT: StorageType.INT_MEMBER,
+    StorageType.ARRAY_FLOAT: StorageType.FLOAT_MEMBER,
+    StorageType.ARRAY_BOOL: StorageType.BOOLEAN_MEMBER,
+    StorageType.ARRAY_ID: StorageType.ID_MEMBER,
+}
 
 
 class GenieStructure:
@@ -75,12 +88,30 @@ class GenieStructure:
         # source data file
         stop_reading_members = False
 
-        if not members:
-            members = target_class.get_data_format(
-                allowed_modes=(True, READ_EXPORT, READ, READ_UNKNOWN),
-                flatten_includes=False)
+        if members:
+            plan = ((None, member) for member in members)
+
+        else:
+            # members of fixed size and arrays with dynamic lengths
+            # are read by the precompiled plan of the class.
+            if not isinstance(target_class, type):
+                target_class = type(target_class)
 
-        for _, export, var_name, storage_type, var_type in members:
+            plan = get_read_plan(target_class)
+
+        for step, member in plan:
+
+            if step:
+                if stop_reading_members:
+                    step.skip(self)
+
+                else:
+                    offset = step.read(self, raw, offset,
+                                       generated_value_members)
+
+                continue
+
+            _, export, var_name, storage_type, var_type = member
 
             if stop_reading_members:
                 if isinstance(var_type, ReadMember):
@@ -349,6 +380,14 @@ class GenieStructure:
 
                     generated_value_members.append(gen_member)
 
+                elif is_array and result and storage_type in PACKED_ARRAY_ELEMENTS:
+                    # Store the numbers in a typed array,
+                    # the element members are created on access
+                    array = PackedArrayMember(var_name,
+                                              PACKED_ARRAY_ELEMENTS[storage_type],
+                                              typed_array(symbol, result))
+                    generated_value_members.append(array)
+
                 elif is_array:
                     # Turn every element of result into a member
                     # and put them into an array
@@ -0,0 +1,323 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Compact diffs of ValueMembers.
+
+ValueMember.diff() creates a new member for every compared member,
+including a NoDiffMember for each one that didn't change. For diffing
+whole unit lines or all civs against Gaia, most of that work is wasted.
+
+The functions here compare the plain values instead and only store
+what changed. The diff of a container or an array is a MemberDiff:
+bit i of its mask is set if the i-th submember (in container order)
+or element differs, and its values are the diff values of the changed
+submembers, in index order. Equal members have the diff None.
+
+Diff values are computed like ValueMember.diff() does it:
+    - int, float: self - other
+    - bitfield: self ^ other
+    - boolean, id, string: the value of other
+    - container, array: a MemberDiff
+"""
+
+from math import isclose
+
+from .value_members import MemberTypes, PackedArrayMember
+
+
+def _subtract(value, other):
+    return value - other
+
+
+def _xor(value, other):
+    return value ^ other
+
+
+def _other(_, other):
+    return other
+
+
+# primitive member type -> function that creates the diff value
+DIFF_VALUE = {
+    MemberTypes.INT_MEMBER: _subtract,
+    MemberTypes.FLOAT_MEMBER: _subtract,
+    MemberTypes.BITFIELD_MEMBER: _xor,
+    MemberTypes.BOOLEAN_MEMBER: _other,
+    MemberTypes.ID_MEMBER: _other,
+    MemberTypes.STRING_MEMBER: _other,
+}
+
+# array type -> element type
+ARRAY_ELEMENTS = {
+    MemberTypes.ARRAY_INT: MemberTypes.INT_MEMBER,
+    MemberTypes.ARRAY_FLOAT: MemberTypes.FLOAT_MEMBER,
+    MemberTypes.ARRAY_BITFIELD: MemberTypes.BITFIELD_MEMBER,
+    MemberTypes.ARRAY_BOOL: MemberTypes.BOOLEAN_MEMBER,
+    MemberTypes.ARRAY_ID: MemberTypes.ID_MEMBER,
+    MemberTypes.ARRAY_STRING: MemberTypes.STRING_MEMBER,
+    MemberTypes.ARRAY_CONTAINER: MemberTypes.CONTAINER_MEMBER,
+}
+
+# floats must have the last 6 digits in common, like in FloatMember.diff()
+FLOAT_TOLERANCE = 1e-7
+
+
+class MemberDiff:
+    """
+    Changed submembers of a container or elements of an array.
+    """
+
+    __slots__ = ('mask', 'values')
+
+    def __init__(self, mask, values):
+        # bit i is set if the i-th submember changed
+        self.mask = mask
+
+        # diff values of the changed submembers
+        self.values = values
+
+    def get_indices(self):
+        """
+        Yields the indices of the changed submembers.
+        """
+        mask = self.mask
+        index = 0
+
+        while mask:
+            if mask & 1:
+                yield index
+
+            mask >>= 1
+            index += 1
+
+    def get_items(self):
+        """
+        Yields (index, diff value) for the changed submembers.
+        """
+        return zip(self.get_indices(), self.values)
+
+    def get_named(self, names):
+        """
+        Returns a dict of the changed submembers with their names as keys.
+
+        :param names: Names of all submembers, e.g. the keys
+                      of the diffed container.
+        """
+        names = list(names)
+        return {names[index]: value for index, value in self.get_items()}
+
+    def is_changed(self, index):
+        """
+        Returns True if the submember at index changed.
+        """
+        return bool(self.mask >> index & 1)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "MemberDiff<%d changed>" % len(self.values)
+
+
+def diff_members(member, other):
+    """
+    Returns the diff value between the values of
+    member and other, or None if they are equal.
+    """
+    member_type = member.get_type()
+
+    if member_type is not other.get_type():
+        raise Exception("type %s member cannot be diffed with type %s"
+                        % (type(member), type(other)))
+
+    diff_value = DIFF_VALUE.get(member_type)
+    if diff_value is not None:
+        value = member.get_value()
+        other_value = other.get_value()
+
+        if member_type is MemberTypes.FLOAT_MEMBER:
+            if isclose(value, other_value, rel_tol=FLOAT_TOLERANCE):
+                return None
+
+        elif value == other_value:
+            return None
+
+        return diff_value(value, other_value)
+
+    if member_type is MemberTypes.CONTAINER_MEMBER:
+        return diff_containers(member, other)
+
+    if member_type is None:
+        # arrays without elements have no type
+        return None
+
+    return diff_arrays(member, other)
+
+
+def diff_containers(member, other):
+    """
+    Returns the MemberDiff between two ContainerMembers
+    with the same layout, or None if they are equal.
+    """
+    submembers = member.get_value()
+    other_submembers = other.get_value()
+
+    if len(submembers) != len(other_submembers):
+        raise Exception("ContainerMembers must have same length for diff")
+
+    mask = 0
+    values = []
+
+    for index, (name, submember) in enumerate(submembers.items()):
+        subdiff = diff_members(submember, other_submembers[name])
+
+        if subdiff is not None:
+            mask |= 1 << index
+            values.append(subdiff)
+
+    if not values:
+        return None
+
+    return MemberDiff(mask, values)
+
+
+def diff_arrays(member, other):
+    """
+    Returns the MemberDiff between two ArrayMembers
+    with the same length, or None if they are equal.
+    """
+    if len(member) != len(other):
+        raise Exception("ArrayMembers must have same length for diff")
+
+    element_type = ARRAY_ELEMENTS[member.get_type()]
+
+    if element_type is MemberTypes.CONTAINER_MEMBER:
+        mask = 0
+        values = []
+
+        for index, (element, other_element) in enumerate(zip(member.get_value(),
+                                                             other.get_value())):
+            subdiff = diff_containers(element, other_element)
+
+            if subdiff is not None:
+                mask |= 1 << index
+                values.append(subdiff)
+
+        if not values:
+            return None
+
+        return MemberDiff(mask, values)
+
+    return diff_values(element_type, get_plain_values(member),
+                       get_plain_values(other))
+
+
+def get_plain_values(member):
+    """
+    Returns the plain values of the elements of a primitive ArrayMember.
+    """
+    if isinstance(member, PackedArrayMember):
+        return member.get_raw_values()
+
+    return [element.get_value() for element in member.get_value()]
+
+
+def diff_values(element_type, values, other_values):
+    """
+    Returns the MemberDiff between two sequences of plain values
+    of the same length, or None if they are equal.
+    """
+    # one comparison in C for equal arrays, lists and tuples
+    if values == other_values:
+        return None
+
+    if element_type is MemberTypes.BOOLEAN_MEMBER:
+        # packed arrays store the raw numbers
+        values = [bool(value) for value in values]
+        other_values = [bool(value) for value in other_values]
+
+    diff_value = DIFF_VALUE[element_type]
+    mask = 0
+    changed = []
+
+    if element_type is MemberTypes.FLOAT_MEMBER:
+        for index, (value, other_value) in enumerate(zip(values, other_values)):
+            if not isclose(value, other_value, rel_tol=FLOAT_TOLERANCE):
+                mask |= 1 << index
+                changed.append(diff_value(value, other_value))
+
+    else:
+        for index, (value, other_value) in enumerate(zip(values, other_values)):
+            if value != other_value:
+                mask |= 1 << index
+                changed.append(diff_value(value, other_value))
+
+    if not changed:
+        return None
+
+    return MemberDiff(mask, changed)
+
+
+def diff_against(reference, members):
+    """
+    Diffs each of the members against the reference member,
+    e.g. the civs against Gaia or the units of a line against
+    the first unit.
+
+    Returns a list with the diff of every member.
+    """
+    return [diff_members(member, reference) for member in members]
+
+
+def test():
+    """
+    Compares the compact diffs to the ones of ValueMember.diff().
+    """
+    from array import array
+    from ...testing.testing import assert_value, assert_raises
+    from .value_members import (ArrayMember, BooleanMember, ContainerMember,
+                                FloatMember, IDMember, IntMember, StringMember)
+
+    def unit(hit_points, speed, name, armors, flags):
+        """ creates a unit record """
+        return ContainerMember("unit", [
+            IntMember("hit_points", hit_points),
+            FloatMember("speed", speed),
+            IDMember("graphic", 7),
+            StringMember("name", name),
+            PackedArrayMember("armors", MemberTypes.INT_MEMBER,
+                              array("h", armors)),
+            ArrayMember("flags", MemberTypes.BOOLEAN_MEMBER,
+                        [BooleanMember("flags", flag) for flag in flags]),
+        ])
+
+    gaia = unit(40, 0.9, "Militia", [1, 0, 4], [False, True])
+    same = unit(40, 0.90000001, "Militia", [1, 0, 4], [False, True])
+    other = unit(45, 1.2, "Militia", [1, 2, 4], [True, True])
+
+    assert_value(diff_members(same, gaia), None)
+
+    diff = diff_members(other, gaia)
+    names = list(other.get_value())
+
+    assert_value(list(diff.get_indices()), [0, 1, 4, 5])
+    assert_value(diff.get_named(names)["hit_points"], 5)
+    assert_value(round(diff.get_named(names)["speed"], 5), 0.3)
+    assert_value(list(diff.get_named(names)["armors"].get_items()), [(1, 2)])
+    assert_value(list(diff.get_named(names)["flags"].get_items()), [(0, False)])
+
+    # same result for packed and unpacked arrays
+    packed = PackedArrayMember("flags", MemberTypes.BOOLEAN_MEMBER,
+                               array("B", [1, 1]))
+    unpacked = other.get_value()["flags"]
+    assert_value(diff_members(packed, unpacked), None)
+
+    diffs = diff_against(gaia, [same, other, gaia])
+    assert_value([diff is None for diff in diffs], [True, False, True])
+
+    with assert_raises(Exception):
+        diff_members(IntMember("a", 1), FloatMember("a", 1.0))
+
+    with assert_raises(Exception):
+        diff_members(PackedArrayMember("a", MemberTypes.INT_MEMBER, [1]),
+                     PackedArrayMember("a", MemberTypes.INT_MEMBER, [1, 2]))
@@ -0,0 +1,316 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Precompiled read plans for GenieStructure.read().
+
+Interpreting the data_format of a structure for every single record
+is slow: the member types are matched against regexes and struct formats
+are built for each member of each unit, graphic, tech, ...
+
+A read plan is compiled once per GenieStructure class. Adjacent members
+with a fixed size are merged into a single precompiled struct.Struct,
+arrays with a dynamic length only look up their length attribute.
+All other members (subdata, includes, custom read members) are still
+handled by GenieStructure.read() itself.
+"""
+
+import math
+import struct
+from array import array
+from functools import lru_cache
+
+from ..export.struct_definition import vararray_match, integer_match
+from ..export.util import struct_type_lookup
+from ...util.strings import decode_until_null
+from .member_access import READ, READ_EXPORT, READ_UNKNOWN
+from .value_members import MemberTypes as StorageType
+from .value_members import (ArrayMember, IntMember, FloatMember,
+                            StringMember, BooleanMember, IDMember,
+                            PackedArrayMember, PACKED_MEMBER_CLASSES)
+
+
+# storage types for single values
+SCALAR_STORAGE = {
+    StorageType.INT_MEMBER: IntMember,
+    StorageType.FLOAT_MEMBER: FloatMember,
+    StorageType.BOOLEAN_MEMBER: BooleanMember,
+    StorageType.ID_MEMBER: IDMember,
+}
+
+# storage types for arrays: (element member type, element class)
+ARRAY_STORAGE = {
+    StorageType.ARRAY_INT: (StorageType.INT_MEMBER, IntMember),
+    StorageType.ARRAY_FLOAT: (StorageType.FLOAT_MEMBER, FloatMember),
+    StorageType.ARRAY_BOOL: (StorageType.BOOLEAN_MEMBER, BooleanMember),
+    StorageType.ARRAY_ID: (StorageType.ID_MEMBER, IDMember),
+    StorageType.ARRAY_STRING: (StorageType.STRING_MEMBER, StringMember),
+}
+
+# compiled plans, by GenieStructure class
+_READ_PLANS = {}
+
+
+class PrimitiveMember:
+    """
+    A member that is read from plain binary data
+    and is stored without any hooks.
+    """
+
+    __slots__ = ('export', 'name', 'storage_type', 'symbol',
+                 'is_array', 'length')
+
+    def __init__(self, export, name, storage_type, symbol, is_array, length):
+        self.export = export
+        self.name = name
+        self.storage_type = storage_type
+        self.symbol = symbol
+        self.is_array = is_array
+
+        # int for fixed lengths, the length member name otherwise
+        self.length = length
+
+    def create(self, name, result):
+        """
+        Creates the value member for the read result.
+        Returns (value for the structure attribute, value member).
+        """
+        if self.symbol == "s":
+            value = decode_until_null(result[0])
+            return value, StringMember(name, value)
+
+        if self.is_array:
+            if not result:
+                # same as an array without any elements in GenieStructure.read
+                return result, ArrayMember(name, None, [])
+
+            allowed_member_type, member_class = ARRAY_STORAGE[self.storage_type]
+
+            if allowed_member_type in PACKED_MEMBER_CLASSES:
+                return result, PackedArrayMember(
+                    name,
+                    allowed_member_type,
+                    array(self.symbol, result)
+                )
+
+            return result, ArrayMember(
+                name,
+                allowed_member_type,
+                [member_class(name, elem) for elem in result]
+            )
+
+        value = result[0]
+        if self.symbol == "f" and not math.isfinite(value):
+            raise Exception("invalid float when reading %s" % name)
+
+        return value, SCALAR_STORAGE[self.storage_type](name, value)
+
+
+class FixedMembers:
+    """
+    Adjacent members of fixed size, read with a single struct.
+    """
+
+    __slots__ = ('struct', 'members')
+
+    def __init__(self, members):
+        fmt = "<"
+        self.members = []
+
+        start = 0
+        for member in members:
+            member_fmt = "%d%s" % (member.length, member.symbol)
+            member_offset = struct.calcsize(fmt)
+
+            if member.symbol == "s":
+                count = 1
+            else:
+                count = member.length
+
+            self.members.append((member, start, count, member_offset))
+
+            fmt += member_fmt
+            start += count
+
+        self.struct = struct.Struct(fmt)
+
+    def read(self, target, raw, offset, generated_value_members):
+        """
+        Reads all members, stores them as attributes of target
+        and appends their value members.
+        Returns the new offset.
+        """
+        result = self.struct.unpack_from(raw, offset)
+
+        for member, start, count, member_offset in self.members:
+            if member.export == READ_UNKNOWN:
+                # uid for the unknown memory location
+                var_name = "unknown-0x%08x" % (offset + member_offset)
+            else:
+                var_name = member.name
+
+            value, gen_member = member.create(var_name,
+                                              result[start:start + count])
+
+            generated_value_members.append(gen_member)
+            setattr(target, var_name, value)
+
+        return offset + self.struct.size
+
+    def skip(self, target):
+        """
+        Sets the replacement values when reading was aborted.
+        """
+        for member, _, _, _ in self.members:
+            setattr(target, member.name, 0)
+
+
+class DynamicArray:
+    """
+    Array member whose length is stored in another member.
+    """
+
+    __slots__ = ('member',)
+
+    def __init__(self, member):
+        self.member = member
+
+    def read(self, target, raw, offset, generated_value_members):
+        """
+        Reads the array, stores it as attribute of target
+        and appends its value member.
+        Returns the new offset.
+        """
+        member = self.member
+        data_count = getattr(target, member.length)
+
+        if data_count < 0:
+            raise Exception("invalid length %d < 0 for member '%s'" % (
+                data_count, member.name))
+
+        array_struct = get_array_struct(data_count, member.symbol)
+        result = array_struct.unpack_from(raw, offset)
+
+        if member.export == READ_UNKNOWN:
+            var_name = "unknown-0x%08x" % offset
+        else:
+            var_name = member.name
+
+        value, gen_member = member.create(var_name, result)
+
+        generated_value_members.append(gen_member)
+        setattr(target, var_name, value)
+
+        return offset + array_struct.size
+
+    def skip(self, target):
+        """
+        Sets the replacement value when reading was aborted.
+        """
+        setattr(target, self.member.name, 0)
+
+
+@lru_cache(maxsize=1024)
+def get_array_struct(count, symbol):
+    """
+    Returns the struct for reading count elements.
+    """
+    return struct.Struct("<%d%s" % (count, symbol))
+
+
+def compile_member(export, var_name, storage_type, var_type):
+    """
+    Returns a PrimitiveMember if the member can be read
+    by a read plan, otherwise None.
+    """
+    if not isinstance(var_type, str):
+        # subdata, includes and custom read members
+        return None
+
+    is_array = vararray_match.match(var_type)
+
+    if is_array:
+        struct_type = is_array.group(1)
+        length = is_array.group(2)
+        if struct_type == "char":
+            struct_type = "char[]"
+
+        if integer_match.match(length):
+            length = int(length)
+
+    else:
+        struct_type = var_type
+        length = 1
+
+    symbol = struct_type_lookup.get(struct_type)
+    if symbol is None:
+        return None
+
+    # only allow the storage types that GenieStructure.read would accept,
+    # so the errors for everything else are still raised there.
+    if symbol == "s":
+        if storage_type is not StorageType.STRING_MEMBER:
+            return None
+
+    elif is_array:
+        if storage_type not in ARRAY_STORAGE:
+            return None
+
+    elif storage_type not in SCALAR_STORAGE:
+        return None
+
+    return PrimitiveMember(export, var_name, storage_type, symbol,
+                           bool(is_array) and symbol != "s", length)
+
+
+def compile_read_plan(cls):
+    """
+    Compiles the data_format of a GenieStructure class into a list of
+    (step, member) tuples. step is a FixedMembers or DynamicArray object,
+    or None for members that have to be read by GenieStructure.read().
+    """
+    plan = []
+    fixed_members = []
+
+    def flush():
+        """ merges the collected fixed size members """
+        if fixed_members:
+            plan.append((FixedMembers(fixed_members), None))
+            fixed_members.clear()
+
+    members = cls.get_data_format(
+        allowed_modes=(True, READ_EXPORT, READ, READ_UNKNOWN),
+        flatten_includes=False
+    )
+
+    for member in members:
+        _, export, var_name, storage_type, var_type = member
+
+        compiled = compile_member(export, var_name, storage_type, var_type)
+
+        if compiled is None:
+            flush()
+            plan.append((None, member))
+
+        elif isinstance(compiled.length, int):
+            fixed_members.append(compiled)
+
+        else:
+            flush()
+            plan.append((DynamicArray(compiled), None))
+
+    flush()
+
+    return plan
+
+
+def get_read_plan(cls):
+    """
+    Returns the cached read plan of a GenieStructure class.
+    """
+    try:
+        return _READ_PLANS[cls]
+
+    except KeyError:
+        plan = compile_read_plan(cls)
+        _READ_PLANS[cls] = plan
+        return plan
@@ -20,6 +20,12 @@ Quick usage guide on when to use which ValueMember:
     - ArrayMember: Stores a list of members with uniform type. Can be used
                    when repeating substructures appear in a data file.
                    (e.g. multiple unit objects, list of coordinates)
+    - PackedArrayMember: ArrayMember for numbers that are stored in a
+                         typed array.array. Used by the reader, so
+                         large arrays don't need one object per number.
+
+All members use __slots__, there are millions of them
+for a single dat file.
 """
 
 from enum import Enum
@@ -78,6 +84,8 @@ class IntMember(ValueMember):
     Stores numeric integer values.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name)
 
@@ -114,6 +122,8 @@ class FloatMember(ValueMember):
     Stores numeric floating point values.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name)
 
@@ -150,6 +160,8 @@ class BooleanMember(ValueMember):
     Stores boolean values.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name)
 
@@ -183,6 +195,8 @@ class IDMember(IntMember):
     Stores references to media/resource IDs.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name, value)
 
@@ -209,6 +223,8 @@ class BitfieldMember(ValueMember):
     Stores bit field members.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name)
 
@@ -259,6 +275,8 @@ class StringMember(ValueMember):
     Stores string values.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, value):
         super().__init__(name)
 
@@ -298,6 +316,8 @@ class ContainerMember(ValueMember):
     are the value of the dict.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, submembers):
         super().__init__(name)
 
@@ -363,6 +383,8 @@ class ArrayMember(ValueMember):
     Stores an ordered list of members with the same type.
     """
 
+    __slots__ = ()
+
     def __init__(self, name, allowed_member_type, members):
         super().__init__(name)
 
@@ -400,10 +422,11 @@ class ArrayMember(ValueMember):
             if len(self) == len(other):
 
                 diff_list = []
+                self_list = self.get_value()
                 other_list = other.get_value()
 
                 for index in range(len(self)):
-                    diff_value = self.value[index].diff(other_list[index])
+                    diff_value = self_list[index].diff(other_list[index])
 
                     diff_list.append(diff_value)
 
@@ -430,11 +453,64 @@ class ArrayMember(ValueMember):
         return "ArrayMember<%s>" % (type(self))
 
 
+class PackedArrayMember(ArrayMember):
+    """
+    Stores an ordered list of numbers in a typed array.
+
+    The element members are only created when the value of
+    the array is accessed.
+    """
+
+    __slots__ = ('raw_values', 'element_type')
+
+    def __init__(self, name, allowed_member_type, raw_values):
+        # pylint: disable=super-init-not-called
+        ValueMember.__init__(self, name)
+
+        if allowed_member_type not in PACKED_MEMBER_CLASSES:
+            raise Exception("%s values cannot be stored in a PackedArrayMember"
+                            % (allowed_member_type))
+
+        # array.array (or any other sequence) of the plain values
+        self.raw_values = raw_values
+        self.element_type = allowed_member_type
+        self.member_type = PACKED_ARRAY_TYPES[allowed_member_type]
+
+    def get_value(self):
+        if self.value is None:
+            member_class = PACKED_MEMBER_CLASSES[self.element_type]
+            self.value = [member_class(self.name, raw_value)
+                          for raw_value in self.raw_values]
+
+        return self.value
+
+    def get_raw_values(self):
+        """
+        Returns the plain values without creating the element members.
+        """
+        return self.raw_values
+
+    def __len__(self):
+        return len(self.raw_values)
+
+    def __getstate__(self):
+        # the element members can be recreated
+        return (self.name, self.element_type, self.raw_values)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return "PackedArrayMember<%s>" % (type(self))
+
+
 class NoDiffMember(ValueMember):
     """
     Is returned when no difference between two members is found.
     """
 
+    __slots__ = ()
+
     def __repr__(self):
         return "NoDiffMember<%s>" % (type(self))
 
@@ -460,3 +536,21 @@ class MemberTypes(Enum):
     ARRAY_BITFIELD   = "bitfieldarray"  # BitfieldMembers
     ARRAY_STRING     = "stringarray"    # StringMembers
     ARRAY_CONTAINER  = "contarray"      # ContainerMembers
+
+
+# element types that PackedArrayMember can store:
+# element type -> class of the element members
+PACKED_MEMBER_CLASSES = {
+    MemberTypes.INT_MEMBER: IntMember,
+    MemberTypes.FLOAT_MEMBER: FloatMember,
+    MemberTypes.BOOLEAN_MEMBER: BooleanMember,
+    MemberTypes.ID_MEMBER: IDMember,
+}
+
+# element type -> type of the PackedArrayMember
+PACKED_ARRAY_TYPES = {
+    MemberTypes.INT_MEMBER: MemberTypes.ARRAY_INT,
+    MemberTypes.FLOAT_MEMBER: MemberTypes.ARRAY_FLOAT,
+    MemberTypes.BOOLEAN_MEMBER: MemberTypes.ARRAY_BOOL,
+    MemberTypes.ID_MEMBER: MemberTypes.ARRAY_ID,
+}
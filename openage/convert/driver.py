@@ -4,11 +4,12 @@ Receives cleaned-up srcdir and targetdir objects from .main, and drives the
 actual conversion process.
 """
 
+import itertools
 import os
 import re
 from tempfile import gettempdir
 
-from ..log import info, dbg
+from ..log import info, dbg, warn
 from .opus import opusenc
 from .game_versions import GameVersion, has_x1_p1
 from .blendomatic import Blendomatic
@@ -23,9 +24,12 @@ from .hdlanguagefile import (read_age2_hd_fe_stringresources,
                              read_age2_hd_3x_stringresources)
 from .interface.cutter import InterfaceCutter
 from .interface.rename import hud_rename
+from .media_cache import MediaCache
+from .palette_registry import PALETTES
 from .processor.aoc.processor import AoCProcessor
 from .slp_converter_pool import SLPConverterPool
 from .stringresource import StringResource
+from .timings import Timings
 from .processor.modpack_exporter import ModpackExporter
 from openage.convert.dataformat.media_types import MediaType
 
@@ -83,7 +87,7 @@ def get_gamespec(srcdir, game_version, dont_pickle):
 
     filepath = srcdir.joinpath(game_version[0].media_paths[MediaType.DATFILE][0])
 
-    cache_file = os.path.join(gettempdir(), "{}.pickle".format(filepath.name))
+    cache_file = os.path.join(gettempdir(), "{}.gamespec".format(filepath.name))
 
     with filepath.open('rb') as empiresdat_file:
         gamespec = load_gamespec(empiresdat_file,
@@ -111,22 +115,42 @@ def convert(args):
         strings (filenames) that indicate the currently-converted object
         ints that predict the amount of objects remaining
     """
-    # data conversion
-    yield from convert_metadata(args)
-    with args.targetdir[GAMESPEC_VERSION_FILENAME].open('w') as fil:
-        fil.write(EmpiresDat.get_hash())
+    # the spans of the stages and files are recorded here
+    args.timings = Timings()
 
-    # media conversion
-    if not args.flag('no_media'):
-        yield from convert_media(args)
+    try:
+        # data conversion
+        yield from convert_metadata(args)
+        with args.targetdir[GAMESPEC_VERSION_FILENAME].open('w') as fil:
+            fil.write(EmpiresDat.get_hash())
+
+        # media conversion
+        if not args.flag('no_media'):
+            yield from convert_media(args)
+
+            with args.targetdir[ASSET_VERSION_FILENAME].open('w') as fil:
+                fil.write(str(ASSET_VERSION))
+
+        # clean args (set by convert_metadata for convert_media)
+        del args.palette
 
-        with args.targetdir[ASSET_VERSION_FILENAME].open('w') as fil:
-            fil.write(str(ASSET_VERSION))
+        info("asset conversion complete; asset version: %s", ASSET_VERSION)
 
-    # clean args (set by convert_metadata for convert_media)
-    del args.palette
+    finally:
+        # failed conversions get their partial report, too.
+        # not available when converting from the game launcher
+        timings_report = getattr(args, "timings_report", None)
+        if timings_report:
+            try:
+                args.timings.save(timings_report)
+                info("slowest files:\n%s", args.timings.format_slowest_files())
+                info("timings report: %s", timings_report)
+
+            except OSError as exc:
+                # must not replace the error of a failed conversion
+                warn("could not write the timings report: %s", exc)
 
-    info("asset conversion complete; asset version: %s", ASSET_VERSION)
+        del args.timings
 
 
 def get_palette(srcdir, offset=0):
@@ -136,7 +160,7 @@ def get_palette(srcdir, offset=0):
 
     palette_path = "interface/{}.bina".format(50500 + offset)
 
-    return ColorTable(srcdir[palette_path].open("rb").read())
+    return PALETTES.get_palette(srcdir[palette_path])
 
 
 def convert_metadata(args):
@@ -147,7 +171,8 @@ def convert_metadata(args):
 
     # required for player palette and color lookup during SLP conversion.
     yield "palette"
-    palette = get_palette(args.srcdir)
+    with args.timings.span("palette"):
+        palette = get_palette(args.srcdir)
 
     # store for use by convert_media
     args.palette = palette
@@ -163,16 +188,32 @@ def convert_metadata(args):
     args.converter = AoCProcessor
 
     yield "empires.dat"
-    gamespec = get_gamespec(args.srcdir, args.game_version, args.flag("no_pickle_cache"))
-    modpacks = args.converter.convert(gamespec)
+    with args.timings.span("gamespec"):
+        gamespec = get_gamespec(args.srcdir, args.game_version,
+                                args.flag("no_pickle_cache"))
+
+    with args.timings.span("processor"):
+        modpacks = args.converter.convert(gamespec,
+                                          getattr(args, "jobs", None))
 
     for modpack in modpacks:
-        ModpackExporter.export(modpack, args.srcdir, args.targetdir, args.game_version)
+        # includes the time for handling the progress messages
+        with args.timings.span("export"):
+            yield from ModpackExporter.export(
+                modpack,
+                args.srcdir,
+                args.targetdir,
+                args.game_version,
+                compression=getattr(args, "png_compression", "default"),
+                jobs=getattr(args, "jobs", None),
+                timings=args.timings,
+            )
 
     yield "blendomatic.dat"
-    blend_data = get_blendomatic_data(args.srcdir)
-    blend_data.save(args.targetdir, "blendomatic", ("csv",))
-    data_formatter.add_data(blend_data.dump("blending_modes"))
+    with args.timings.span("blendomatic"):
+        blend_data = get_blendomatic_data(args.srcdir)
+        blend_data.save(args.targetdir, "blendomatic", ("csv",))
+        data_formatter.add_data(blend_data.dump("blending_modes"))
 
     yield "player color palette"
     player_palette = PlayerColorTable(palette)
@@ -183,11 +224,13 @@ def convert_metadata(args):
     data_formatter.add_data(termcolortable.dump("termcolors"))
 
     yield "string resources"
-    stringres = get_string_resources(args)
-    data_formatter.add_data(stringres.dump("string_resources"))
+    with args.timings.span("string resources"):
+        stringres = get_string_resources(args)
+        data_formatter.add_data(stringres.dump("string_resources"))
 
     yield "game specification files"
-    data_formatter.export(args.targetdir, ("csv",))
+    with args.timings.span("data files"):
+        data_formatter.export(args.targetdir, ("csv",))
 
     if args.flag('gen_extra_files'):
         dbg("generating extra files for visualization")
@@ -290,20 +333,52 @@ def convert_media(args):
     # there is obj_id->name mapping information in some bina files
     named_mediafiles_map = extract_mediafiles_names_map(args.srcdir)
 
-    jobs = getattr(args, "jobs", None)
-    with SLPConverterPool(args.palette, jobs) as pool:
-
-        from ..util.threading import concurrent_chain
-        yield from concurrent_chain(
-            (convert_mediafile(
-                fpath,
-                dirname,
-                named_mediafiles_map,
-                pool,
-                args
-            ) for (fpath, dirname) in files_to_convert),
-            jobs
+    # results of earlier conversions can be reused
+    if getattr(args, "media_cache_dir", None):
+        args.media_cache = MediaCache(
+            args.media_cache_dir,
+            args.media_cache_size * 1024 ** 2,
+            args.flag("media_cache_hardlink"),
         )
+    else:
+        args.media_cache = None
+
+    try:
+        # the sounds are encoded in batches on their own thread pool,
+        # alongside the conversion of the other files.
+        wav_files = [(fpath, dirname) for (fpath, dirname) in files_to_convert
+                     if fpath.suffix == '.wav']
+        other_files = [(fpath, dirname) for (fpath, dirname) in files_to_convert
+                       if fpath.suffix != '.wav']
+
+        jobs = getattr(args, "jobs", None)
+
+        # worker processes are only spawned for profiling them,
+        # otherwise the SLPs are converted on the threads of the caller
+        profile = None
+        if getattr(args, "profile", None) and args.flag("profile_workers"):
+            profile = (args.profile, args.profile_dir)
+
+        with SLPConverterPool(args.palette, jobs, processes=profile is not None,
+                              timings=args.timings, profile=profile) as pool:
+
+            from ..util.threading import concurrent_chain
+            yield from concurrent_chain(
+                itertools.chain(
+                    (convert_wavs(wav_files, args, jobs),),
+                    (convert_mediafile(
+                        fpath,
+                        dirname,
+                        named_mediafiles_map,
+                        pool,
+                        args
+                    ) for (fpath, dirname) in other_files)
+                ),
+                jobs
+            )
+
+    finally:
+        del args.media_cache
 
 
 def get_filter(args):
@@ -346,14 +421,28 @@ def change_dir(path_parts, dirname):
     return path_parts
 
 
+def read_buffer(filepath):
+    """
+    Returns the content of the file at filepath.
+    Files from memory-mapped archives are returned as memoryview,
+    without copying them.
+    """
+    with filepath.open_r() as infile:
+        try:
+            return infile.getbuffer()
+        except AttributeError:
+            return infile.read()
+
+
 def convert_slp(filepath, dirname, names_map, converter_pool, args):
     """
     Convert a slp image and save it to the target dir.
     This also writes the accompanying metadata file.
+
+    Returns the number of read and written bytes.
     """
 
-    with filepath.open_r() as infile:
-        indata = infile.read()
+    indata = read_buffer(filepath)
 
     # some user interface textures must be cut using hardcoded values
     if filepath.parent.name == 'interface':
@@ -362,16 +451,6 @@ def convert_slp(filepath, dirname, names_map, converter_pool, args):
     else:
         cutter = None
 
-    # do the CPU-intense part a worker process
-    texture = converter_pool.convert(indata, cutter)
-
-    # the hotspots of terrain textures must be fixed
-    # it has to be in the west corner of a tile.
-    if filepath.parent.name == 'terrain':
-        for entry in texture.image_metadata:
-            entry["cx"] = 0
-            entry["cy"] = TILE_HALFSIZE["y"]
-
     # replace .slp by .png and rename the file
     # by some lookups (that map obj_id -> human readable)
     tex_filepath = hud_rename(slp_rename(
@@ -383,28 +462,115 @@ def convert_slp(filepath, dirname, names_map, converter_pool, args):
     # additionally change the output dir name if requested
     out_filename = b'/'.join(change_dir(tex_filepath.parts, dirname)).decode()
 
+    # not available when converting from the game launcher
+    compression = getattr(args, "png_compression", "default")
+
+    media_cache = getattr(args, "media_cache", None)
+    if media_cache:
+        cache_key = media_cache.key(
+            indata,
+            args.palette.get_digest(),
+            cutter.idx if cutter else None,
+            filepath.parent.name,
+            out_filename,
+            compression,
+        )
+        if media_cache.fetch(cache_key, args.targetdir) is not None:
+            return len(indata), 0
+
+    # do the CPU-intense part; the decoding releases the GIL,
+    # so this runs concurrently on the conversion threads.
+    texture = converter_pool.convert(indata, cutter)
+
+    # the hotspots of terrain textures must be fixed
+    # it has to be in the west corner of a tile.
+    if filepath.parent.name == 'terrain':
+        for entry in texture.image_metadata:
+            entry["cx"] = 0
+            entry["cy"] = TILE_HALFSIZE["y"]
+
     # save atlas to targetdir
-    texture.save(args.targetdir, out_filename, ("csv",))
+    written_files = texture.save(args.targetdir, out_filename, ("csv",),
+                                 compression)
+
+    if media_cache:
+        media_cache.store(cache_key, args.targetdir, written_files)
 
+    return len(indata), sum(args.targetdir[written_file].filesize
+                            for written_file in written_files)
 
-def convert_wav(filepath, dirname, args):
+
+def convert_wavs(wav_files, args, jobs=None, batch_size=64):
     """
-    Convert a wav audio file to an opus file
+    Convert wav audio files to opus files.
+
+    wav_files is a list of (filepath, dirname) tuples, like the
+    arguments of convert_mediafile.
+    The files are encoded in batches on a pool of jobs threads.
+
+    Yields progress messages, like convert_mediafile.
     """
+    media_cache = getattr(args, "media_cache", None)
 
-    with filepath.open_r() as infile:
-        indata = infile.read()
+    # (wav data, output file name, cache key)
+    batch = []
+
+    for filepath, dirname in wav_files:
+        # progress message
+        yield b'/'.join(filepath.parts).decode()
+
+        with filepath.open_r() as infile:
+            indata = infile.read()
+
+        # replace .wav by .opus and rename the directory
+        out_parts = change_dir(filepath.with_suffix('.opus').parts, dirname)
+        out_filename = b'/'.join(out_parts).decode()
+
+        cache_key = None
+        if media_cache:
+            cache_key = media_cache.key(indata, out_filename)
+            if media_cache.fetch(cache_key, args.targetdir) is not None:
+                continue
 
-    outdata = opusenc.encode(indata)
-    if isinstance(outdata, (str, int)):
-        raise Exception("opusenc failed: {}".format(outdata))
+        batch.append((indata, out_filename, cache_key))
 
-    # rename the directory
-    out_parts = change_dir(filepath.parts, dirname)
+        if len(batch) >= batch_size:
+            save_wav_batch(batch, args, jobs)
+            batch = []
 
-    # save the converted sound data
-    with args.targetdir[out_parts].with_suffix('.opus').open_w() as outfile:
-        outfile.write(outdata)
+    save_wav_batch(batch, args, jobs)
+
+
+def save_wav_batch(batch, args, jobs=None):
+    """
+    Encodes the wav data of a convert_wavs batch and saves the results.
+    """
+    if not batch:
+        return
+
+    media_cache = getattr(args, "media_cache", None)
+
+    with args.timings.span("opus", file_type=".wav") as span:
+        span.items = len(batch)
+        span.bytes_in = sum(len(indata) for indata, _, _ in batch)
+
+        outdatas = opusenc.encode_many((indata for indata, _, _ in batch),
+                                       jobs)
+
+        span.bytes_out = sum(len(outdata) for outdata in outdatas
+                             if isinstance(outdata, bytes))
+
+    for (_, out_filename, cache_key), outdata in zip(batch, outdatas):
+        if isinstance(outdata, (str, int)):
+            raise Exception("opusenc failed: {}".format(outdata))
+
+        # save the converted sound data, the old file may
+        # be hardlinked to a media cache entry
+        with args.targetdir[out_filename].open_new() as outfile:
+            outfile.write(outdata)
+
+        if media_cache:
+            media_cache.store(cache_key, args.targetdir, [out_filename])
 
 
 def convert_mediafile(filepath, dirname, names_map, converter_pool, args):
@@ -421,14 +587,22 @@ def convert_mediafile(filepath, dirname, names_map, converter_pool, args):
     filename = b'/'.join(filepath.parts).decode()
     yield filename
 
-    if filepath.suffix == '.slp':
-        convert_slp(filepath, dirname, names_map, converter_pool, args)
+    with args.timings.span("media", filename, filepath.suffix) as span:
+        if filepath.suffix == '.slp':
+            span.bytes_in, span.bytes_out = convert_slp(
+                filepath, dirname, names_map, converter_pool, args)
 
-    elif filepath.suffix == '.wav':
-        convert_wav(filepath, dirname, args)
+        elif filepath.suffix == '.wav':
+            # usually, convert_media converts them in batches instead.
+            for _ in convert_wavs([(filepath, dirname)], args, jobs=1):
+                pass
+
+        else:
+            # simply copy the file over.
+            with filepath.open_r() as infile:
+                data = infile.read()
 
-    else:
-        # simply copy the file over.
-        with filepath.open_r() as infile:
             with args.targetdir[filename].open_w() as outfile:
-                outfile.write(infile.read())
+                outfile.write(data)
+
+            span.bytes_in = span.bytes_out = len(data)
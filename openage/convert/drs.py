@@ -1,4 +1,4 @@
-# Copyright 2013-2018 the openage authors. See copying.md for legal info.
+# Copyright 2013-2020 the openage authors. See copying.md for legal info.
 
 """
 Code for reading Genie .DRS archives.
@@ -7,11 +7,15 @@ Note that .DRS archives can't store file names; they just store the file
 extension, and a file number.
 """
 
+import mmap
+from io import UnsupportedOperation
+from threading import Lock
+
 from ..log import spam, dbg
 from ..util.strings import decode_until_null
 from ..util.struct import NamedStruct
 from ..util.fslike.filecollection import FileCollection
-from ..util.filelike.stream import StreamFragment
+from ..util.filelike.stream import BufferFragment, StreamFragment
 
 # version of the drs files, hardcoded for now
 FILE_VERSION = 57
@@ -69,6 +73,12 @@ class DRSFileInfo(NamedStruct):
 class DRS(FileCollection):
     """
     represents a file archive in DRS format.
+
+    If possible, the archive is memory-mapped: the contained files are
+    then served as slices of the mapping, which can be read concurrently
+    and without copying (see BufferFragment.getbuffer()).
+    Otherwise, all reads of the contained files share fileobj,
+    guarded by a lock.
     """
     def __init__(self, fileobj):
         super().__init__()
@@ -76,6 +86,9 @@ class DRS(FileCollection):
         # queried from the outside
         self.fileobj = fileobj
 
+        self.mapping = self.map_file(fileobj)
+        self.lock = Lock()
+
         # read header
         header = DRSHeader.read(fileobj)
         header.copyright = decode_until_null(header.copyright).strip()
@@ -102,13 +115,32 @@ class DRS(FileCollection):
         for filename, offset, size in self.read_tables():
             def open_r(offset=offset, size=size):
                 """ Returns a opened ('rb') file-like object for fileobj. """
-                return StreamFragment(self.fileobj, offset, size)
+                if self.mapping is not None:
+                    return BufferFragment(self.mapping, offset, size)
+
+                return StreamFragment(self.fileobj, offset, size, self.lock)
 
             self.add_fileentry(
                 [filename.encode()],
                 (open_r, None, lambda size=size: size, None)
             )
 
+    @staticmethod
+    def map_file(fileobj):
+        """
+        Returns a read-only memory mapping of fileobj,
+        or None if it's not a mappable file.
+        """
+        try:
+            fileno = fileobj.fileno()
+        except (AttributeError, UnsupportedOperation):
+            return None
+
+        try:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
     def read_tables(self):
         """
         Reads the tables from self.tables, and yields tuples of
@@ -4,6 +4,8 @@
 Output format specification for data to write.
 """
 
+from io import TextIOWrapper
+
 from ...util.fslike.path import Path
 
 
@@ -44,11 +46,22 @@ class DataDefinition:
                              type(exportdir))
 
         output_dir = exportdir.joinpath(self.targetdir)
-        output_content = self.dump()
 
-        # generate human-readable file
-        with output_dir[self.filename].open('wb') as outfile:
-            outfile.write(output_content.encode('utf-8'))
+        # generate human-readable file, with the same
+        # line endings on all platforms
+        with output_dir[self.filename].open('wb') as rawfile:
+            with TextIOWrapper(rawfile, encoding='utf-8', newline='') as outfile:
+                self.write(outfile)
+
+    def write(self, outfile):
+        """
+        Writes the contents of the DataDefinition
+        to the text file-like object outfile.
+
+        Subclasses with large outputs can override this to
+        stream their content instead of building it with dump().
+        """
+        outfile.write(self.dump())
 
     def set_filename(self, filename):
         """
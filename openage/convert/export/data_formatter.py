@@ -1,4 +1,4 @@
-# Copyright 2014-2019 the openage authors. See copying.md for legal info.
+# Copyright 2014-2020 the openage authors. See copying.md for legal info.
 
 # TODO pylint: disable=C,R
 
@@ -165,6 +165,8 @@ class DataFormatter:
         Generates files in the requested formats to projectdir.
 
         projectdir is a util.fslike.path.Path.
+
+        Returns the names of the written files, relative to projectdir.
         """
         # storage of all needed content snippets
         generate_files = list()
@@ -222,7 +224,13 @@ class DataFormatter:
                 gen_file.create_forward_declarations(generate_files)
 
         # we now invoke the content generation for each generated file
+        written_files = list()
         for gen_file in generate_files:
             file_name, content = gen_file.generate()
-            with projectdir[file_name].open('wb') as outfile:
+            # the old file may be hardlinked to a media cache entry
+            with projectdir[file_name].open_new() as outfile:
                 outfile.write(content.encode('utf-8'))
+
+            written_files.append(file_name)
+
+        return written_files
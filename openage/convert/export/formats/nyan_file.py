@@ -5,7 +5,10 @@ Nyan file struct that stores a bunch of objects and
 manages imports.
 """
 
+from io import StringIO
+
 from ....nyan.nyan_structs import NyanObject
+from ....util.ordered_set import OrderedSet
 from ..data_definition import DataDefinition
 
 FILE_VERSION = "0.1.0"
@@ -17,7 +20,8 @@ class NyanFile(DataDefinition):
     """
 
     def __init__(self, targetdir, filename, modpack_name, nyan_objects=None):
-        self.nyan_objects = set()
+        # insertion ordered, so the file content is deterministic
+        self.nyan_objects = OrderedSet()
 
         if nyan_objects:
             for nyan_object in nyan_objects:
@@ -47,14 +51,21 @@ class NyanFile(DataDefinition):
         """
         Returns the string that represents the nyan file.
         """
-        output_str = "# NYAN FILE \nversion %s\n\n" % (FILE_VERSION)
+        output = StringIO()
+        self.write(output)
+
+        return output.getvalue()
+
+    def write(self, outfile):
+        """
+        Writes the nyan file content to the text file-like object outfile.
+        """
+        outfile.write("# NYAN FILE \nversion %s\n\n" % (FILE_VERSION))
 
         # TODO: imports
 
         for nyan_object in self.nyan_objects:
-            output_str += nyan_object.dump()
-
-        return output_str
+            nyan_object.write(outfile)
 
     def get_relative_file_path(self):
         """
@@ -0,0 +1,139 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Deduplication of media export requests.
+
+Different graphics and sound ids often refer to byte-identical source
+files, e.g. because the files were packed into several DRS archives.
+Identical sources give identical results, so only one of them has
+to be converted. The targets of the others are then linked
+to (or copied from) the converted file.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import shutil
+
+from ...log import info
+
+
+def hash_source(request, sourcedir, chunksize=1048576):
+    """
+    Returns the hash of the source file of the request,
+    or None if it doesn't exist.
+    """
+    source_file = request.get_source_path(sourcedir)
+
+    if not source_file.is_file():
+        return None
+
+    digest = hashlib.sha256()
+    with source_file.open_r() as infile:
+        while True:
+            data = infile.read(chunksize)
+            if not data:
+                break
+
+            digest.update(data)
+
+    return digest.digest()
+
+
+def deduplicate(export_requests, sourcedir, jobs=None):
+    """
+    Finds the requests whose source files are identical to the ones
+    of earlier requests of the same type.
+
+    Returns (unique requests, duplicates), where duplicates is a list of
+    (request, original request) tuples.
+    """
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    with ThreadPoolExecutor(jobs) as pool:
+        digests = pool.map(lambda request: hash_source(request, sourcedir),
+                           export_requests)
+
+        unique_requests = []
+        duplicates = []
+
+        # (request type, source hash) -> request
+        originals = {}
+        duplicate_size = 0
+
+        for request, digest in zip(export_requests, digests):
+            if digest is None:
+                # the export will skip it
+                unique_requests.append(request)
+                continue
+
+            key = (type(request), digest)
+            original = originals.get(key)
+
+            if original is None:
+                originals[key] = request
+                unique_requests.append(request)
+
+            else:
+                duplicates.append((request, original))
+                duplicate_size += request.get_source_path(sourcedir).filesize
+
+    if duplicates:
+        info("media deduplication: %d of %d files are duplicates "
+             "(%.1f MiB of source data)",
+             len(duplicates), len(export_requests),
+             duplicate_size / 1024 ** 2)
+
+    return unique_requests, duplicates
+
+
+def link_duplicates(duplicates, exportdir, hardlink=True):
+    """
+    Creates the targets of the duplicate requests
+    from the targets of their original requests.
+
+    With hardlink, the targets are hardlinked where possible,
+    otherwise the files are copied.
+
+    Yields the target filenames of the duplicates.
+    """
+    for request, original in duplicates:
+        source_path = original.get_target_path(exportdir)
+        target_path = request.get_target_path(exportdir)
+
+        if not source_path.is_file():
+            # the original was not exported, e.g. its source is broken
+            continue
+
+        if source_path != target_path:
+            place_file(source_path, target_path, hardlink)
+
+        yield request.target_filename
+
+
+def place_file(source_path, target_path, hardlink=True):
+    """
+    Hardlinks or copies the file at source_path to target_path.
+    """
+    if hardlink:
+        native_source = source_path.resolve_native_path()
+        native_target = target_path.resolve_native_path_w()
+
+        if native_source is not None and native_target is not None:
+            target_path.parent.mkdirs()
+
+            try:
+                if os.path.lexists(native_target):
+                    os.unlink(native_target)
+
+                os.link(native_source, native_target)
+                return
+
+            except OSError:
+                # e.g. cross-device link, fall back to copying
+                pass
+
+    with source_path.open_r() as infile:
+        with target_path.open_w() as outfile:
+            shutil.copyfileobj(infile, outfile)
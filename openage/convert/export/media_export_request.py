@@ -5,7 +5,7 @@ Specifies a request for a media resource that should be
 converted and exported into a modpack.
 """
 from openage.convert.dataformat.media_types import MediaType
-from openage.convert.colortable import ColorTable
+from openage.convert.palette_registry import PALETTES
 from openage.convert.texture import Texture
 from openage.convert.dataformat.version_detect import GameEdition
 
@@ -35,19 +35,102 @@ class MediaExportRequest:
         raise NotImplementedError("%s has not implemented get_type()"
                                   % (self))
 
-    def save(self, sourcedir, exportdir, game_version=None):
+    def save(self, sourcedir, exportdir, game_version=None, palettes=None,
+             compression="default"):
         """
         Convert the media to openage target format and output the result
         to a file. Encountered metadata is returned on completion.
 
+        This runs all the export stages (read, decode, pack, encode, write)
+        one after another; the ModpackExporter can also run the stages
+        of many requests concurrently.
+
         :param sourcedir: Relative path to the source directory.
         :type sourcedir: ...util.fslike.path.Path
         :param exportdir: Relative path to the export directory.
         :type exportdir: ...util.fslike.path.Path
+        :param palettes: Registry of the already loaded palettes.
+        :type palettes: ...palette_registry.PaletteRegistry
+        :param compression: Compression preset for the resulting file.
+        :type compression: str
+        """
+        data = self.read(sourcedir)
+
+        if data is None:
+            # TODO: Filter files that do not exist out sooner
+            return
+
+        decoded = self.decode(data)
+        packed = self.pack(decoded, sourcedir, game_version, palettes)
+        self.write(exportdir, self.encode(packed, compression))
+
+    def read(self, sourcedir):
         """
-        raise NotImplementedError("%s has not implemented save()"
+        Read the source file.
+
+        :param sourcedir: Relative path to the source directory.
+        :type sourcedir: ...util.fslike.path.Path
+        :returns: Content of the source file, or None if it doesn't exist.
+        """
+        source_file = self.get_source_path(sourcedir)
+
+        if not source_file.is_file():
+            return None
+
+        with source_file.open_r() as infile:
+            return infile.read()
+
+    def decode(self, data):
+        """
+        Decode the content of the source file.
+        """
+        return data
+
+    def pack(self, decoded, sourcedir, game_version, palettes=None):
+        """
+        Create the media object that is encoded to the target format.
+        """
+        del sourcedir, game_version, palettes  # unused
+
+        return decoded
+
+    def encode(self, packed, compression="default"):
+        """
+        Encode the media object to the content of the target file.
+        """
+        raise NotImplementedError("%s has not implemented encode()"
                                   % (self))
 
+    def write(self, exportdir, encoded):
+        """
+        Write the encoded data to the target file.
+
+        :param exportdir: Relative path to the export directory.
+        :type exportdir: ...util.fslike.path.Path
+        :param encoded: Content of the target file.
+        :type encoded: bytes
+        """
+        with self.get_target_path(exportdir).open_w() as outfile:
+            outfile.write(encoded)
+
+    def get_source_path(self, sourcedir):
+        """
+        Returns the path of the source file.
+
+        :param sourcedir: Relative path to the source directory.
+        :type sourcedir: ...util.fslike.path.Path
+        """
+        return sourcedir[self.get_type().value, self.source_filename]
+
+    def get_target_path(self, exportdir):
+        """
+        Returns the path of the target file.
+
+        :param exportdir: Relative path to the export directory.
+        :type exportdir: ...util.fslike.path.Path
+        """
+        return exportdir.joinpath(self.targetdir)[self.target_filename]
+
     def set_source_filename(self, filename):
         """
         Sets the filename for the source file.
@@ -96,42 +179,42 @@ class GraphicsMediaExportRequest(MediaExportRequest):
     def get_type(self):
         return MediaType.GRAPHICS
 
-    def save(self, sourcedir, exportdir, game_version):
-        source_file = sourcedir[self.get_type().value, self.source_filename]
-
-        if source_file.is_file():
-            media_file = source_file.open("rb")
+    def decode(self, data):
+        suffix = self.source_filename[self.source_filename.rfind("."):].lower()
 
-        else:
-            # TODO: Filter files that do not exist out sooner
-            return
-
-        if source_file.suffix.lower() == ".slp":
+        if suffix == ".slp":
             from ..slp import SLP
 
-            image = SLP(media_file.read())
+            return SLP(data)
 
-        elif source_file.suffix.lower() == ".smp":
+        elif suffix == ".smp":
             from ..smp import SMP
 
-            image = SMP(media_file.read())
+            return SMP(data)
 
-        elif source_file.suffix.lower() == ".smx":
+        elif suffix == ".smx":
             from ..smx import SMX
 
-            image = SMX(media_file.read())
+            return SMX(data)
+
+        raise Exception("unknown graphics file format: %s" % self.source_filename)
 
+    def pack(self, decoded, sourcedir, game_version, palettes=None):
         palette_subdir = MediaType.PALETTES.value
 
         if GameEdition.AOC is game_version[0]:
             palette_name = "50500.bina"
 
+        if palettes is None:
+            palettes = PALETTES
+
         palette_path = sourcedir[palette_subdir, palette_name]
-        palette_file = palette_path.open("rb")
-        palette_table = ColorTable(palette_file.read())
+        palette_table = palettes.get_palette(palette_path, game_version[0])
 
-        texture = Texture(image, palette_table)
-        texture.save(exportdir.joinpath(self.targetdir), self.target_filename)
+        return Texture(decoded, palette_table)
+
+    def encode(self, packed, compression="default"):
+        return packed.encode_png(compression)
 
 
 class SoundMediaExportRequest(MediaExportRequest):
@@ -142,23 +225,12 @@ class SoundMediaExportRequest(MediaExportRequest):
     def get_type(self):
         return MediaType.SOUNDS
 
-    def save(self, sourcedir, exportdir, game_version):
-        source_file = sourcedir[self.get_type().value, self.source_filename]
-
-        if source_file.is_file():
-            with source_file.open_r() as infile:
-                media_file = infile.read()
-
-        else:
-            # TODO: Filter files that do not exist out sooner
-            return
-
+    def encode(self, packed, compression="default"):
         from ..opus.opusenc import encode
 
-        soundata = encode(media_file)
+        soundata = encode(packed)
 
         if isinstance(soundata, (str, int)):
             raise Exception("opusenc failed: {}".format(soundata))
 
-        with exportdir[self.targetdir, self.target_filename].open_w() as outfile:
-            outfile.write(soundata)
+        return soundata
@@ -1,11 +1,12 @@
-# Copyright 2013-2019 the openage authors. See copying.md for legal info.
+# Copyright 2013-2020 the openage authors. See copying.md for legal info.
 
 # TODO pylint: disable=C,R
 
-import pickle
+import json
 from zlib import decompress
 
 from . import civ
+from . import gamespec_cache
 from . import graphic
 from . import maps
 from . import playercolor
@@ -20,6 +21,7 @@ from ..dataformat.genie_structure import GenieStructure
 from ..dataformat.read_members import SubdataMember
 from ..dataformat.member_access import READ, READ_EXPORT, READ_UNKNOWN
 from ..dataformat.value_members import MemberTypes as StorageType
+from ..dataformat.value_members import ArrayMember, ContainerMember
 
 from ...log import spam, dbg, info, warn
 
@@ -376,32 +378,41 @@ def load_gamespec(fileobj, game_version, cachefile_name=None, load_cache=False):
     file.
 
     If cachefile_name is given, this file is consulted before performing the
-    load.
+    load. The cache is only used if it was created from the same dat file
+    with the same data format.
     """
+    dbg("reading dat file")
+    compressed_data = fileobj.read()
+    fileobj.close()
+
+    cache_key = None
+    if cachefile_name:
+        cache_key = gamespec_cache.get_cache_key(compressed_data,
+                                                 EmpiresDat.get_hash(),
+                                                 game_version)
+
     # try to use the cached result from a previous run
     if cachefile_name and load_cache:
         try:
-            with open(cachefile_name, "rb") as cachefile:
-                # pickle.load() can fail in many ways, we need to catch all.
-                # pylint: disable=broad-except
-                try:
-                    wrapper = pickle.load(cachefile)
-                    info("using cached wrapper: %s", cachefile_name)
-                    return wrapper
-                except Exception:
-                    warn("could not use cached wrapper:")
-                    import traceback
-                    traceback.print_exc()
-                    warn("we will just skip the cache, no worries.")
+            gamespec = gamespec_cache.load_cache(cachefile_name, cache_key)
+            info("using cached wrapper: %s", cachefile_name)
+            return gamespec
 
         except FileNotFoundError:
             pass
 
-    # read the file ourselves
+        except gamespec_cache.GamespecCacheError as exc:
+            info("not using cached wrapper: %s", exc)
 
-    dbg("reading dat file")
-    compressed_data = fileobj.read()
-    fileobj.close()
+        # reading the cache can fail in many ways, we need to catch all.
+        # pylint: disable=broad-except
+        except Exception:
+            warn("could not use cached wrapper:")
+            import traceback
+            traceback.print_exc()
+            warn("we will just skip the cache, no worries.")
+
+    # read the file ourselves
 
     dbg("decompressing dat file")
     # -15: there's no header, window size is 15.
@@ -418,7 +429,211 @@ def load_gamespec(fileobj, game_version, cachefile_name=None, load_cache=False):
 
     if cachefile_name:
         dbg("dumping dat file contents to cache file: %s", cachefile_name)
-        with open(cachefile_name, "wb") as cachefile:
-            pickle.dump(gamespec, cachefile)
+        gamespec_cache.store_cache(cachefile_name, cache_key, gamespec)
 
     return gamespec
+
+
+class LazyEmpiresDat:
+    """
+    Random access to the records of a decompressed empires.dat file.
+
+    An indexing pass records the offset and length of every entry in the
+    top-level record lists (graphics, terrains, civs, unit_headers,
+    researches, ...). The records are only decoded when they are requested
+    and are memoized afterwards. Units are part of their civ record.
+
+    The index can be passed in again (see get_index()), then the
+    indexing pass is skipped.
+    """
+
+    def __init__(self, file_data, game_version, index=None):
+        self.raw = file_data
+
+        # the same structure EmpiresDatWrapper.read() would read into
+        wrapper = EmpiresDatWrapper(game_version=game_version)
+        self.datfile = EmpiresDat(game_versions=wrapper.game_versions)
+
+        # all members except the record lists, by name
+        self.members = {}
+
+        # record list name -> (SubdataMember, [(offset, length), ...],
+        #                      offset after the list)
+        self.record_lists = {}
+
+        # (record list name, index) -> ContainerMember
+        self.records = {}
+
+        self._create_index(index or {})
+
+    def _create_index(self, index):
+        """
+        Reads the top-level members of the dat file and the positions
+        of all records. Known positions are taken from index.
+        """
+        offset = 0
+
+        members = EmpiresDat.get_data_format(
+            allowed_modes=(True, READ_EXPORT, READ, READ_UNKNOWN),
+            flatten_includes=False
+        )
+
+        for member in members:
+            _, _, var_name, _, var_type = member
+
+            if isinstance(var_type, SubdataMember):
+                if var_name in index:
+                    positions, offset = index[var_name]
+                    positions = [tuple(position) for position in positions]
+
+                else:
+                    positions, offset = self._index_records(var_type, offset)
+
+                self.record_lists[var_name] = (var_type, positions, offset)
+                continue
+
+            offset, gen_members = self.datfile.read(self.raw, offset,
+                                                    cls=EmpiresDat,
+                                                    members=(member,))
+
+            for gen_member in gen_members:
+                self.members[gen_member.get_name()] = gen_member
+
+    def _index_records(self, var_type, offset):
+        """
+        Finds the positions of all records in a record list.
+        Returns the positions and the offset after the list.
+        """
+        positions = []
+
+        if var_type.offset_to:
+            offset_lookup = getattr(self.datfile, var_type.offset_to[0])
+        else:
+            offset_lookup = None
+
+        for idx in range(var_type.get_length(self.datfile)):
+            # entries with a datfile offset of 0 don't exist
+            if offset_lookup and not var_type.offset_to[1](offset_lookup[idx]):
+                continue
+
+            end, _ = self._read_record(var_type, offset)
+            positions.append((offset, end - offset))
+            offset = end
+
+        return positions, offset
+
+    def _read_record(self, var_type, offset):
+        """
+        Decodes the record at offset.
+        Returns the offset after the record and its members.
+        """
+        varargs = {}
+        for passed_member_name in var_type.passed_args or ():
+            varargs[passed_member_name] = getattr(self.datfile,
+                                                  passed_member_name)
+
+        record_class = var_type.class_lookup[None]
+        record = record_class(game_versions=self.datfile.game_versions,
+                              **varargs)
+
+        return record.read(self.raw, offset, record_class)
+
+    def get_index(self):
+        """
+        Returns the record positions as JSON-serializable dict.
+        """
+        return {name: [positions, end]
+                for name, (_, positions, end) in self.record_lists.items()}
+
+    def get_record_count(self, name):
+        """
+        Returns the number of records in the record list.
+        """
+        _, positions, _ = self.record_lists[name]
+        return len(positions)
+
+    def get_record(self, name, idx):
+        """
+        Returns the ContainerMember of a record, decoding it if required.
+
+        idx is the position in the record list, like in the
+        ArrayMember created by load_gamespec().
+        """
+        key = (name, idx)
+
+        try:
+            return self.records[key]
+
+        except KeyError:
+            var_type, positions, _ = self.record_lists[name]
+            offset, _ = positions[idx]
+
+            _, gen_members = self._read_record(var_type, offset)
+            record = ContainerMember(name, gen_members)
+
+            self.records[key] = record
+            return record
+
+    def get_records(self, name):
+        """
+        Yields the ContainerMembers of all records in the record list.
+        """
+        for idx in range(self.get_record_count(name)):
+            yield self.get_record(name, idx)
+
+    def __getitem__(self, name):
+        """
+        Returns a top-level member.
+        Record lists are decoded completely and returned as ArrayMember.
+        """
+        if name in self.record_lists:
+            return ArrayMember(name, StorageType.CONTAINER_MEMBER,
+                               list(self.get_records(name)))
+
+        return self.members[name]
+
+
+def load_lazy_gamespec(fileobj, game_version, indexfile_name=None):
+    """
+    Creates a LazyEmpiresDat for a 'empires.dat' gzipped wrapper file.
+
+    If indexfile_name is given, the record index is stored there and
+    reused as long as the dat file and its data format don't change.
+    """
+    compressed_data = fileobj.read()
+    fileobj.close()
+
+    index = None
+    index_key = None
+    if indexfile_name:
+        index_key = gamespec_cache.get_cache_key(compressed_data,
+                                                 EmpiresDat.get_hash(),
+                                                 game_version)
+
+        try:
+            with open(indexfile_name) as indexfile:
+                stored = json.load(indexfile)
+
+            if stored.get("key") == index_key:
+                info("using cached record index: %s", indexfile_name)
+                index = stored["records"]
+
+        except FileNotFoundError:
+            pass
+
+        except ValueError:
+            warn("ignoring broken record index: %s", indexfile_name)
+
+    # -15: there's no header, window size is 15.
+    file_data = decompress(compressed_data, -15)
+    del compressed_data
+
+    datfile = LazyEmpiresDat(file_data, game_version, index)
+
+    if indexfile_name and index is None:
+        dbg("storing record index: %s", indexfile_name)
+        with open(indexfile_name, "w") as indexfile:
+            json.dump({"key": index_key, "records": datfile.get_index()},
+                      indexfile)
+
+    return datfile
@@ -0,0 +1,604 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Columnar cache file for the ValueMember tree read from empires.dat.
+
+Reading the dat file is slow, and so was unpickling millions of small
+ValueMember objects. Instead, the tree is stored as flat typed columns:
+
+All ContainerMembers with the same layout (the names and types of their
+members) form a table. Every member of the layout is a column of the
+table, one row per container. Nested arrays are stored as (start, count)
+columns that point into shared element columns.
+
+The file is memory-mapped for loading, and ValueMembers are only created
+when they are accessed, so the converter only pays for the data it uses.
+
+File layout (native byte order):
+
+    magic, format version, cache key length, cache key, index offset
+    column data, 8 byte aligned
+    index (json): layouts, column positions and the root array
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from ..dataformat.value_members import (ArrayMember, BitfieldMember,
+                                        BooleanMember, ContainerMember,
+                                        FloatMember, IDMember, IntMember,
+                                        PackedArrayMember, StringMember,
+                                        MemberTypes)
+
+
+# file identification
+MAGIC = b"OAGSPEC\0"
+
+# increase when the file layout changes
+CACHE_FORMAT_VERSION = 1
+
+# magic, format version, key length
+HEADER = struct.Struct("<8sII")
+
+# position of the index
+INDEX_OFFSET = struct.Struct("<Q")
+
+# column format for the scalar member types
+SCALAR_FORMATS = {
+    MemberTypes.INT_MEMBER: "q",
+    MemberTypes.ID_MEMBER: "q",
+    MemberTypes.BITFIELD_MEMBER: "q",
+    MemberTypes.FLOAT_MEMBER: "d",
+    MemberTypes.BOOLEAN_MEMBER: "B",
+    MemberTypes.STRING_MEMBER: "Q",
+}
+
+# scalar member classes
+SCALAR_CLASSES = {
+    MemberTypes.INT_MEMBER: IntMember,
+    MemberTypes.ID_MEMBER: IDMember,
+    MemberTypes.BITFIELD_MEMBER: BitfieldMember,
+    MemberTypes.FLOAT_MEMBER: FloatMember,
+    MemberTypes.BOOLEAN_MEMBER: BooleanMember,
+    MemberTypes.STRING_MEMBER: StringMember,
+}
+
+# array type -> (element type, name of the element column)
+ARRAY_ELEMENTS = {
+    MemberTypes.ARRAY_INT: (MemberTypes.INT_MEMBER, "ints"),
+    MemberTypes.ARRAY_ID: (MemberTypes.ID_MEMBER, "ints"),
+    MemberTypes.ARRAY_BITFIELD: (MemberTypes.BITFIELD_MEMBER, "ints"),
+    MemberTypes.ARRAY_FLOAT: (MemberTypes.FLOAT_MEMBER, "floats"),
+    MemberTypes.ARRAY_BOOL: (MemberTypes.BOOLEAN_MEMBER, "bools"),
+    MemberTypes.ARRAY_STRING: (MemberTypes.STRING_MEMBER, "strings"),
+    MemberTypes.ARRAY_CONTAINER: (MemberTypes.CONTAINER_MEMBER, "refs"),
+}
+
+# shared element columns
+ELEMENT_FORMATS = {
+    "ints": "q",
+    "floats": "d",
+    "bools": "B",
+    "strings": "Q",
+    "ref_layouts": "Q",
+    "ref_rows": "Q",
+    "string_offsets": "Q",
+}
+
+
+class GamespecCacheError(Exception):
+    """
+    Raised when a cache file can't be used.
+    """
+
+
+class LazyContainerMember(ContainerMember):
+    """
+    ContainerMember whose submembers are created from the
+    cache columns on first access.
+    """
+
+    def __init__(self, name, reader, layout, row):
+        # pylint: disable=super-init-not-called
+        self._value = None
+        self.name = name
+        self.member_type = MemberTypes.CONTAINER_MEMBER
+
+        self._reader = reader
+        self._layout = layout
+        self._row = row
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self._reader.create_members(self._layout, self._row)
+
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+
+class LazyArrayMember(ArrayMember):
+    """
+    ArrayMember whose elements are created from the
+    cache columns on first access.
+    """
+
+    def __init__(self, name, member_type, reader, start, count):
+        # pylint: disable=super-init-not-called
+        self._value = None
+        self.name = name
+        self.member_type = member_type
+
+        self._reader = reader
+        self._start = start
+        self._count = count
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self._reader.create_elements(self.name,
+                                                       self.member_type,
+                                                       self._start,
+                                                       self._count)
+
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+
+    def __len__(self):
+        if self._value is None:
+            return self._count
+
+        return len(self._value)
+
+
+class GamespecCacheWriter:
+    """
+    Flattens a ValueMember tree into columns.
+    """
+
+    def __init__(self):
+        # layout (tuple of (name, type)) -> layout id
+        self.layout_ids = {}
+        self.layouts = []
+
+        # one list of columns per layout
+        self.tables = []
+        self.row_counts = []
+
+        self.elements = {name: array(fmt)
+                         for name, fmt in ELEMENT_FORMATS.items()}
+
+        # string -> string id
+        self.string_ids = {}
+        self.string_data = bytearray()
+        self.elements["string_offsets"].append(0)
+
+    def add_string(self, value):
+        """
+        Stores the string and returns its id.
+        """
+        try:
+            return self.string_ids[value]
+
+        except KeyError:
+            string_id = len(self.string_ids)
+            self.string_ids[value] = string_id
+
+            self.string_data.extend(value.encode())
+            self.elements["string_offsets"].append(len(self.string_data))
+
+            return string_id
+
+    def add_container(self, container):
+        """
+        Stores the container in the table of its layout.
+        Returns (layout id, row).
+        """
+        members = container.get_value()
+
+        layout = tuple((name, member.get_type())
+                       for name, member in members.items())
+
+        # the values of this row, the children are stored first.
+        row = [self.add_member(member) for member in members.values()]
+
+        layout_id = self.layout_ids.get(layout)
+        if layout_id is None:
+            layout_id = len(self.layouts)
+            self.layout_ids[layout] = layout_id
+            self.layouts.append(layout)
+            self.tables.append([self.new_column(member_type)
+                                for _, member_type in layout])
+            self.row_counts.append(0)
+
+        for column, value in zip(self.tables[layout_id], row):
+            if isinstance(value, tuple):
+                column[0].append(value[0])
+                column[1].append(value[1])
+            else:
+                column.append(value)
+
+        row_id = self.row_counts[layout_id]
+        self.row_counts[layout_id] += 1
+
+        return layout_id, row_id
+
+    @staticmethod
+    def new_column(member_type):
+        """
+        Creates the column storage for a member type.
+        """
+        if member_type in SCALAR_FORMATS:
+            return array(SCALAR_FORMATS[member_type])
+
+        # containers: (layout, row), arrays: (start, count)
+        return (array("Q"), array("Q"))
+
+    def add_member(self, member):
+        """
+        Converts the member to its column value.
+        """
+        member_type = member.get_type()
+
+        if member_type is MemberTypes.STRING_MEMBER:
+            return self.add_string(member.get_value())
+
+        if member_type in SCALAR_FORMATS:
+            return member.get_value()
+
+        if member_type is MemberTypes.CONTAINER_MEMBER:
+            return self.add_container(member)
+
+        return self.add_array(member)
+
+    def add_array(self, member):
+        """
+        Stores the array elements in the element columns.
+        Returns (start, count).
+        """
+        if len(member) == 0:
+            return (0, 0)
+
+        element_type, column_name = ARRAY_ELEMENTS[member.get_type()]
+
+        if isinstance(member, PackedArrayMember):
+            # no need to create the element members.
+            # the typecode of the raw values can differ from
+            # the column's, so they are not extended as array.
+            start = len(self.elements[column_name])
+            if element_type is MemberTypes.BOOLEAN_MEMBER:
+                self.elements[column_name].extend(
+                    bool(value) for value in member.get_raw_values()
+                )
+            else:
+                self.elements[column_name].extend(
+                    value for value in member.get_raw_values()
+                )
+
+            return (start, len(member))
+
+        elements = member.get_value()
+
+        if column_name == "refs":
+            refs = [self.add_container(element) for element in elements]
+
+            start = len(self.elements["ref_layouts"])
+            for layout_id, row in refs:
+                self.elements["ref_layouts"].append(layout_id)
+                self.elements["ref_rows"].append(row)
+
+        elif column_name == "strings":
+            start = len(self.elements["strings"])
+            self.elements["strings"].extend(
+                self.add_string(element.get_value()) for element in elements
+            )
+
+        else:
+            start = len(self.elements[column_name])
+            self.elements[column_name].extend(
+                element.get_value() for element in elements
+            )
+
+        return (start, len(elements))
+
+    def write(self, root, cache_key, fileobj):
+        """
+        Writes the root ArrayMember and all its children to fileobj.
+        """
+        root_start, root_count = self.add_array(root)
+
+        key = cache_key.encode()
+        fileobj.write(HEADER.pack(MAGIC, CACHE_FORMAT_VERSION, len(key)))
+        fileobj.write(key)
+
+        index_pos = fileobj.tell()
+        fileobj.write(INDEX_OFFSET.pack(0))
+
+        def write_column(data):
+            """ writes the column 8 byte aligned, returns its position """
+            fileobj.write(b"\0" * (-fileobj.tell() % 8))
+            position = fileobj.tell()
+            fileobj.write(data)
+            return [position, len(data)]
+
+        index = {
+            "root": [root.get_name(), root.get_type().value,
+                     root_start, root_count],
+            "layouts": [[[name, member_type.value if member_type else None]
+                         for name, member_type in layout]
+                        for layout in self.layouts],
+            "tables": [],
+            "elements": {},
+        }
+
+        for table in self.tables:
+            columns = []
+            for column in table:
+                if isinstance(column, tuple):
+                    columns.append([write_column(column[0].tobytes()),
+                                    write_column(column[1].tobytes())])
+                else:
+                    columns.append(write_column(column.tobytes()))
+
+            index["tables"].append(columns)
+
+        for name, column in self.elements.items():
+            index["elements"][name] = write_column(column.tobytes())
+
+        index["elements"]["string_data"] = write_column(bytes(self.string_data))
+
+        index_offset = fileobj.tell()
+        fileobj.write(json.dumps(index).encode())
+
+        fileobj.seek(index_pos)
+        fileobj.write(INDEX_OFFSET.pack(index_offset))
+
+
+class GamespecCacheReader:
+    """
+    Provides the cached ValueMember tree from a memory-mapped cache file.
+    """
+
+    def __init__(self, fileobj, cache_key):
+        try:
+            self.data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # the file is empty
+            raise GamespecCacheError("cache file is empty")
+
+        buf = memoryview(self.data)
+
+        try:
+            magic, version, key_len = HEADER.unpack_from(buf, 0)
+        except struct.error:
+            raise GamespecCacheError("cache file is truncated")
+
+        if magic != MAGIC:
+            raise GamespecCacheError("not a gamespec cache file")
+
+        if version != CACHE_FORMAT_VERSION:
+            raise GamespecCacheError("cache format version %d, expected %d"
+                                     % (version, CACHE_FORMAT_VERSION))
+
+        key = bytes(buf[HEADER.size:HEADER.size + key_len]).decode()
+        if key != cache_key:
+            raise GamespecCacheError("cache is outdated")
+
+        index_offset, = INDEX_OFFSET.unpack_from(buf, HEADER.size + key_len)
+        index = json.loads(bytes(buf[index_offset:]).decode())
+
+        def column(position, fmt):
+            """ typed view on a column, without copying """
+            offset, length = position
+            return buf[offset:offset + length].cast(fmt)
+
+        self.root = index["root"]
+
+        self.layouts = [
+            tuple((name, MemberTypes(member_type) if member_type else None)
+                  for name, member_type in layout)
+            for layout in index["layouts"]
+        ]
+
+        self.tables = []
+        for layout, columns in zip(self.layouts, index["tables"]):
+            table = []
+            for (_, member_type), position in zip(layout, columns):
+                if member_type in SCALAR_FORMATS:
+                    table.append(column(position, SCALAR_FORMATS[member_type]))
+                else:
+                    table.append((column(position[0], "Q"),
+                                  column(position[1], "Q")))
+
+            self.tables.append(table)
+
+        self.elements = {name: column(index["elements"][name], fmt)
+                         for name, fmt in ELEMENT_FORMATS.items()}
+
+        offset, length = index["elements"]["string_data"]
+        self.string_data = buf[offset:offset + length]
+
+    def get_root(self):
+        """
+        Returns the lazily loaded root ArrayMember.
+        """
+        name, member_type, start, count = self.root
+        return LazyArrayMember(name, MemberTypes(member_type),
+                               self, start, count)
+
+    def get_string(self, string_id):
+        """
+        Returns the string with the given id.
+        """
+        offsets = self.elements["string_offsets"]
+        return str(self.string_data[offsets[string_id]:
+                                    offsets[string_id + 1]], "utf-8")
+
+    def create_members(self, layout_id, row):
+        """
+        Creates the submembers of a container.
+        """
+        members = {}
+
+        for (name, member_type), column in zip(self.layouts[layout_id],
+                                               self.tables[layout_id]):
+
+            if member_type is MemberTypes.STRING_MEMBER:
+                member = StringMember(name, self.get_string(column[row]))
+
+            elif member_type in SCALAR_CLASSES:
+                member = SCALAR_CLASSES[member_type](name, column[row])
+
+            elif member_type is MemberTypes.CONTAINER_MEMBER:
+                member = LazyContainerMember(name, self,
+                                             column[0][row], column[1][row])
+
+            else:
+                member = LazyArrayMember(name, member_type, self,
+                                         column[0][row], column[1][row])
+
+            members[name] = member
+
+        return members
+
+    def create_elements(self, name, member_type, start, count):
+        """
+        Creates the elements of an array.
+        """
+        if count == 0:
+            return []
+
+        element_type, column_name = ARRAY_ELEMENTS[member_type]
+        end = start + count
+
+        if column_name == "refs":
+            layouts = self.elements["ref_layouts"][start:end]
+            rows = self.elements["ref_rows"][start:end]
+
+            return [LazyContainerMember(name, self, layout, row)
+                    for layout, row in zip(layouts, rows)]
+
+        if column_name == "strings":
+            return [StringMember(name, self.get_string(string_id))
+                    for string_id in self.elements["strings"][start:end]]
+
+        member_class = SCALAR_CLASSES[element_type]
+        return [member_class(name, value)
+                for value in self.elements[column_name][start:end]]
+
+
+def get_cache_key(dat_data, format_hash, game_version):
+    """
+    Returns the key that a cache file must match to be valid
+    for the given dat file contents and data format.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(dat_data)
+    hasher.update(format_hash.encode())
+
+    # the game version decides which members are read
+    edition, expansions = game_version
+    hasher.update(edition.name.encode())
+    for expansion in expansions:
+        hasher.update(expansion.name.encode())
+
+    hasher.update(sys.byteorder.encode())
+
+    return hasher.hexdigest()
+
+
+def load_cache(cachefile_name, cache_key):
+    """
+    Returns the lazily loaded gamespec stored in the cache file.
+
+    Raises FileNotFoundError when there is no cache file
+    and GamespecCacheError when the cache can't be used.
+    """
+    with open(cachefile_name, "rb") as cachefile:
+        # the mapping stays valid after closing the file.
+        return GamespecCacheReader(cachefile, cache_key).get_root()
+
+
+def store_cache(cachefile_name, cache_key, gamespec):
+    """
+    Writes the gamespec ArrayMember to the cache file.
+    """
+    # write to a temporary file, so a still memory-mapped
+    # previous cache file is not modified.
+    tmp_name = "%s.%d.tmp" % (cachefile_name, os.getpid())
+
+    with open(tmp_name, "wb") as cachefile:
+        GamespecCacheWriter().write(gamespec, cache_key, cachefile)
+
+    os.replace(tmp_name, cachefile_name)
+
+
+def test():
+    """
+    Stores a small member tree and compares it to the loaded one.
+    """
+    from tempfile import TemporaryDirectory
+    from ...testing.testing import assert_value, assert_raises
+
+    def unit(idx):
+        """ creates a container with all member types """
+        return ContainerMember("units", [
+            IntMember("id", idx),
+            IDMember("graphic", -idx),
+            FloatMember("hp", 1.5 * idx),
+            BooleanMember("enabled", idx % 2),
+            BitfieldMember("flags", idx * 3),
+            StringMember("name", "unit%d" % idx),
+            ArrayMember("resources", MemberTypes.FLOAT_MEMBER,
+                        [FloatMember("resources", 0.5 * elem)
+                         for elem in range(idx)]),
+            ArrayMember("empty", None, []),
+            PackedArrayMember("armors", MemberTypes.INT_MEMBER,
+                              array("h", range(-idx, idx))),
+            PackedArrayMember("flags", MemberTypes.BOOLEAN_MEMBER,
+                              array("B", [idx % 3, 0, 2])),
+        ])
+
+    root = ArrayMember("empiresdat", MemberTypes.CONTAINER_MEMBER, [
+        ContainerMember("empiresdat", [
+            StringMember("versionstr", "VER 5.7"),
+            ArrayMember("units", MemberTypes.CONTAINER_MEMBER,
+                        [unit(idx) for idx in range(10)]),
+            ContainerMember("header", [IntMember("count", 10)]),
+        ])
+    ])
+
+    def to_python(member):
+        """ converts the member tree to builtin types """
+        value = member.get_value()
+
+        if isinstance(value, dict):
+            return {key: (submember.get_type(), to_python(submember))
+                    for key, submember in value.items()}
+
+        if isinstance(value, list):
+            return [(elem.get_name(), to_python(elem)) for elem in value]
+
+        return value
+
+    with TemporaryDirectory() as tmpdir:
+        cachefile_name = os.path.join(tmpdir, "test.gamespec")
+        store_cache(cachefile_name, "testkey", root)
+
+        loaded = load_cache(cachefile_name, "testkey")
+        assert_value(loaded.get_type(), root.get_type())
+        assert_value(to_python(loaded), to_python(root))
+
+        with assert_raises(GamespecCacheError):
+            load_cache(cachefile_name, "otherkey")
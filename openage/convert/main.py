@@ -1,4 +1,4 @@
-# Copyright 2015-2019 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """ Entry point for all of the asset conversion. """
 
@@ -9,7 +9,7 @@ import subprocess
 import sys
 from configparser import ConfigParser
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, gettempdir
 
 from . import changelog
 from .game_versions import GameVersion, get_game_versions, Support, has_x1_p1
@@ -19,6 +19,7 @@ from ..util.files import which
 from ..util.fslike.wrapper import (DirectoryCreator,
                                    Synchronizer as AccessSynchronizer)
 from ..util.fslike.directory import CaseIgnoringDirectory, Directory
+from ..util.profiler import add_profile_arguments, profiling
 from ..util.strings import format_progress
 from openage.convert.dataformat.version_detect import get_game_info, GameEdition
 
@@ -596,6 +597,22 @@ def interactive_browser(srcdir=None):
             out_path, filename = os.path.split(target)
             tex.save(Directory(out_path).root, filename)
 
+    def load_gamedata():
+        """
+        returns the game data file as LazyEmpiresDat,
+        which only decodes the requested records.
+        """
+        from .dataformat.media_types import MediaType
+        from .gamedata.empiresdat import load_lazy_gamespec
+
+        media_path = game_versions[0].media_paths[MediaType.DATFILE][0]
+        filepath = data.joinpath(media_path)
+        indexfile_name = os.path.join(gettempdir(),
+                                      "{}.index".format(filepath.name))
+
+        with filepath.open('rb') as datfile:
+            return load_lazy_gamespec(datfile, game_versions, indexfile_name)
+
     import code
     from pprint import pprint
 
@@ -613,7 +630,8 @@ def interactive_browser(srcdir=None):
                 "* version detection:   pprint(game_versions)\n"
                 "* list contents:       pprint(list(data['graphics'].list()))\n"
                 "* dump data:           save(data['file/path'], '/tmp/outputfile')\n"
-                "* save a slp as png:   save_slp(data['dir/123.slp'], '/tmp/pic.png')\n"),
+                "* save a slp as png:   save_slp(data['dir/123.slp'], '/tmp/pic.png')\n"
+                "* inspect game data:   dat = load_gamedata(); dat.get_record('civs', 1)\n"),
         local=locals()
     )
 
@@ -665,11 +683,43 @@ def init_subparser(cli):
 
     cli.add_argument(
         "--no-pickle-cache", action='store_true',
-        help="don't use a pickle file to skip the dat file reading.")
+        help="don't use the gamespec cache file to skip the dat file reading.")
+
+    cli.add_argument(
+        "--media-cache-dir", default=None,
+        help=("directory for caching converted media files, "
+              "so unchanged files are not converted again."))
+
+    cli.add_argument(
+        "--media-cache-size", type=int, default=4096,
+        help="size limit of the media cache in MiB")
+
+    cli.add_argument(
+        "--media-cache-hardlink", action='store_true',
+        help=("hardlink cached media files to the output directory "
+              "instead of copying them."))
+
+    cli.add_argument(
+        "--png-compression", choices=("fast", "default", "max"),
+        default="default",
+        help=("compression of the converted textures: fast encoding "
+              "for development, or the smallest files for releases."))
 
     cli.add_argument(
         "--jobs", "-j", type=int, default=None)
 
+    cli.add_argument(
+        "--timings-report", default=None, metavar="path.json",
+        help=("write the durations and throughputs of the conversion "
+              "stages and the slowest files to this JSON file"))
+
+    add_profile_arguments(cli)
+
+    cli.add_argument(
+        "--profile-workers", action='store_true',
+        help=("convert the SLPs in worker processes and profile them, "
+              "too; requires --profile"))
+
     cli.add_argument(
         "--interactive", "-i", action='store_true',
         help="browse the files interactively")
@@ -702,7 +752,10 @@ def main(args, error):
     outdir = get_asset_path(args.output_dir)
 
     if args.force or conversion_required(outdir, args):
-        if not convert_assets(outdir, args, srcdir):
+        with profiling(args.profile, args.profile_dir):
+            converted = convert_assets(outdir, args, srcdir)
+
+        if not converted:
             return 1
     else:
         print("assets are up to date; no conversion is required.")
@@ -0,0 +1,305 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Persistent cache for converted media files.
+
+Converting the SLP and WAV files is by far the most expensive part of the
+asset conversion, but most of them don't change between game patches.
+The cache stores the produced output files (png, csv, opus, ...) under a key
+that is derived from the source file content and everything else
+that influences the conversion result.
+Unchanged files are then satisfied by copying (or, if requested,
+hardlinking) the stored files to the target directory.
+
+Layout of the cache directory:
+
+    <cache_dir>/<key[:2]>/<key>/index   list of output file names
+    <cache_dir>/<key[:2]>/<key>/<n>     content of the n-th output file
+
+The least recently used entries are removed when the cache grows
+beyond its size limit.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from threading import Lock
+from time import time
+
+from ..log import dbg, warn
+from .changelog import ASSET_VERSION
+
+
+# default size limit of the cache in bytes
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+
+# name of the file that lists the outputs of a cache entry
+INDEX_FILENAME = "index"
+
+# temporary entry directories older than this (in seconds) are
+# leftovers of interrupted stores; younger ones may still be in
+# progress in another converter that shares the cache directory.
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+class MediaCache:
+    """
+    Content-addressed storage of media conversion results.
+
+    The cache lives in a native directory, the conversion targets
+    are util.fslike Paths.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, hardlink=False):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+
+        # hardlinked outputs share their inode with the cache entry,
+        # so they must never be modified in place afterwards:
+        # the converters replace their outputs with Path.open_new().
+        self.hardlink = hardlink
+
+        # guards the size bookkeeping and eviction
+        self.lock = Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # key -> (last usage time, size in bytes)
+        self.entries = {}
+        for key, entry_dir in self._entry_dirs():
+            self.entries[key] = (os.path.getmtime(entry_dir),
+                                 self._dir_size(entry_dir))
+
+        self.size = sum(size for _, size in self.entries.values())
+
+        dbg("media cache at %s: %d entries, %d bytes",
+            self.cache_dir, len(self.entries), self.size)
+
+    @staticmethod
+    def key(*components):
+        """
+        Creates the cache key for the given conversion input.
+
+        The components are the source data and everything else that
+        changes the conversion result (palette, output name, ...).
+        They may be bytes, str, int or None.
+        The asset version is always part of the key.
+        """
+        keyhash = hashlib.sha256()
+        keyhash.update(str(ASSET_VERSION).encode())
+
+        for component in components:
+            if component is None:
+                component = b""
+            elif isinstance(component, str):
+                component = component.encode()
+            elif isinstance(component, int):
+                component = str(component).encode()
+            elif not isinstance(component, (bytes, bytearray, memoryview)):
+                raise TypeError("unsupported cache key component: %s"
+                                % type(component))
+
+            # prefix each component by its length so the
+            # key components can't be shifted between each other.
+            keyhash.update(str(len(component)).encode() + b":")
+            keyhash.update(component)
+
+        return keyhash.hexdigest()
+
+    def fetch(self, key, targetdir):
+        """
+        Places the cached outputs for key in targetdir.
+
+        Returns the list of output file names,
+        or None if there is no such entry.
+        """
+        entry_dir = self._entry_dir(key)
+
+        try:
+            with open(os.path.join(entry_dir, INDEX_FILENAME)) as indexfile:
+                filenames = indexfile.read().splitlines()
+
+            for idx, filename in enumerate(filenames):
+                self._place(os.path.join(entry_dir, str(idx)),
+                            targetdir[filename])
+
+        except FileNotFoundError:
+            # not cached, or evicted concurrently
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(entry_dir)
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = (os.path.getmtime(entry_dir),
+                                     self.entries[key][1])
+
+        return filenames
+
+    def store(self, key, targetdir, filenames):
+        """
+        Adds the given output files from targetdir to the cache.
+        """
+        entry_dir = self._entry_dir(key)
+
+        try:
+            prefix_dir = os.path.dirname(entry_dir)
+            os.makedirs(prefix_dir, exist_ok=True)
+
+            # unique, even among processes sharing the cache
+            tmp_dir = tempfile.mkdtemp(dir=prefix_dir, prefix=key + ".tmp")
+
+        except OSError as exc:
+            warn("could not store media cache entry %s: %s", key, exc)
+            return
+
+        try:
+            for idx, filename in enumerate(filenames):
+                with targetdir[filename].open_r() as infile:
+                    data = infile.read()
+
+                with open(os.path.join(tmp_dir, str(idx)), "wb") as outfile:
+                    outfile.write(data)
+
+            with open(os.path.join(tmp_dir, INDEX_FILENAME), "w") as indexfile:
+                indexfile.write("\n".join(filenames))
+
+            entry_size = self._dir_size(tmp_dir)
+
+            # publish the entry atomically
+            os.rename(tmp_dir, entry_dir)
+
+        except OSError as exc:
+            # another thread may have stored the same entry meanwhile.
+            # a broken cache must never fail the conversion.
+            if not os.path.isdir(entry_dir):
+                warn("could not store media cache entry %s: %s", key, exc)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.entries[key] = (os.path.getmtime(entry_dir), entry_size)
+            self.size += entry_size
+            self._evict()
+
+    def _place(self, cached_path, targetpath):
+        """
+        Copies the cached file content to targetpath.
+        With hardlinking enabled, the file is linked instead if both
+        are on the same native filesystem.
+        """
+        native_path = None
+        if self.hardlink:
+            native_path = targetpath.resolve_native_path_w()
+
+        if native_path is not None:
+            targetpath.parent.mkdirs()
+
+            try:
+                if os.path.lexists(native_path):
+                    os.unlink(native_path)
+
+                os.link(cached_path, native_path)
+                return
+
+            except OSError:
+                # e.g. cross-device link, fall back to copying
+                pass
+
+        with open(cached_path, "rb") as infile:
+            with targetpath.open_new() as outfile:
+                shutil.copyfileobj(infile, outfile)
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache size
+        is within the limit. Must be called with the lock held.
+        """
+        if self.size <= self.max_size:
+            return
+
+        for key, (_, size) in sorted(self.entries.items(),
+                                     key=lambda item: item[1][0]):
+            if self.size <= self.max_size:
+                break
+
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            del self.entries[key]
+            self.size -= size
+
+    def _entry_dir(self, key):
+        """ Native directory of the cache entry for key. """
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entry_dirs(self):
+        """ Yields (key, directory) for all existing cache entries. """
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+
+                if ".tmp" in key:
+                    # leftover of an interrupted store, unless
+                    # another converter is still writing it
+                    try:
+                        if time() - os.path.getmtime(entry_dir) > STALE_TMP_AGE:
+                            shutil.rmtree(entry_dir, ignore_errors=True)
+                    except FileNotFoundError:
+                        pass
+                    continue
+
+                yield key, entry_dir
+
+    @staticmethod
+    def _dir_size(path):
+        """ Size of all files directly in path. """
+        return sum(entry.stat().st_size
+                   for entry in os.scandir(path) if entry.is_file())
+
+
+def test():
+    """
+    Fetches a hardlinked entry and replaces the output like the
+    converters do, which must not change the cache entry.
+    """
+    from tempfile import TemporaryDirectory
+    from ..testing.testing import assert_value
+    from ..util.fslike.directory import Directory
+
+    with TemporaryDirectory() as tmp:
+        cache = MediaCache(os.path.join(tmp, "cache"), hardlink=True)
+        key = cache.key(b"source", "sprite.png")
+
+        srcdir = Directory(os.path.join(tmp, "src"), create_if_missing=True).root
+        with srcdir["sprite.png"].open_w() as outfile:
+            outfile.write(b"cached")
+        cache.store(key, srcdir, ["sprite.png"])
+
+        targetdir = Directory(os.path.join(tmp, "tgt"), create_if_missing=True).root
+        assert_value(cache.fetch(key, targetdir), ["sprite.png"])
+
+        # the output shares the inode with the entry
+        native_path = targetdir["sprite.png"].resolve_native_path()
+        assert_value(os.stat(native_path).st_nlink, 2)
+
+        # a later conversion of changed sources replaces the output
+        with targetdir["sprite.png"].open_new() as outfile:
+            outfile.write(b"changed")
+
+        with targetdir["sprite.png"].open_r() as infile:
+            assert_value(infile.read(), b"changed")
+
+        copydir = Directory(os.path.join(tmp, "copy"), create_if_missing=True).root
+        cache.hardlink = False
+        cache.fetch(key, copydir)
+
+        with copydir["sprite.png"].open_r() as infile:
+            assert_value(infile.read(), b"cached")
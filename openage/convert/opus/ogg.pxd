@@ -1,10 +1,10 @@
-# Copyright 2018-2018 the openage authors. See copying.md for legal info.
+# Copyright 2018-2020 the openage authors. See copying.md for legal info.
 
 cdef extern from "ogg/config_types.h":
     ctypedef short ogg_int16_t
     ctypedef long ogg_int64_t
 
-cdef extern from "ogg/ogg.h":
+cdef extern from "ogg/ogg.h" nogil:
     ctypedef struct ogg_stream_state:
         pass
     ctypedef struct ogg_page:
@@ -1,21 +1,65 @@
-# Copyright 2018-2018 the openage authors. See copying.md for legal info.
+# Copyright 2018-2020 the openage authors. See copying.md for legal info.
 
+from concurrent.futures import ThreadPoolExecutor
+import os
 import time
+from libc.stdlib cimport malloc, realloc, free
+cimport cython
 from libc.string cimport memcpy, memset
-from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from cpython.bytes cimport PyBytes_FromStringAndSize
 
 from ...log import dbg, spam
 
-from .bytearray cimport (PyByteArray_AS_STRING, PyByteArray_GET_SIZE,
-                         PyByteArray_Resize)
+from .bytearray cimport PyByteArray_AS_STRING
 from . cimport ogg, opus
 
 
+# maximum size of one encoded 20 ms opus frame
+DEF MAX_FRAME_BYTES = 1275
+
+# upper bound for the ogg overhead of one packet:
+# lacing values, and the header of a page that may start with it.
+DEF PACKET_OGG_OVERHEAD = 6 + 27 + 255
+
+# results of encode_loop, besides the negative opus error codes
+DEF ENCODE_OK = 0
+DEF ENCODE_OUT_OF_MEMORY = 1
+DEF ENCODE_PACKETIN_FAILED = 2
+
+
+cdef struct ogg_buffer:
+    # the ogg file content
+    unsigned char *data
+    size_t size
+    size_t capacity
+
+
+def encode_many(inputs, jobs=None):
+    '''
+    Encodes all wav files of the bytes objects in 'inputs' like encode(),
+    on a pool of 'jobs' threads. Defaults to one thread per CPU.
+
+    Returns the list of results of encode(), in the order of the inputs.
+    '''
+    inputs = list(inputs)
+
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    if jobs == 1 or len(inputs) < 2:
+        return [encode(inputdata) for inputdata in inputs]
+
+    with ThreadPoolExecutor(min(jobs, len(inputs))) as pool:
+        return list(pool.map(encode, inputs))
+
+
 def encode(inputdata):
     '''
     Converts the wav file in the bytes object 'inputdata' to an opusfile
     and returns it as bytes object. If allocations fail, raises a MemoryError.
     If something else fails, a number or an error message is returned.
+
+    The encoding releases the GIL.
     '''
     inopt = read_wav(inputdata)
     if not isinstance(inopt, dict):
@@ -28,20 +72,11 @@ def encode(inputdata):
     else:
         inputdata = inputdata[inopt['header_len']:]
 
-    outdata = bytearray(1024*50)
-    cdef size_t outsize = 0  # valid bytes inside 'outdata'
-
-    cdef ogg.ogg_packet op
-    cdef ogg.ogg_page og
-    cdef ogg.ogg_stream_state os
-    cdef opus.OpusEncoder *oe
-    cdef int err
     cdef int channels = inopt['channels']
     cdef int wframe_len = inopt['wframe_len']
     cdef opus.opus_int32 rate = inopt['input_rate']
     cdef opus.opus_int32 coding_rate = 48000
     cdef opus.opus_int32 frame_sz = 960
-    cdef opus.opus_int32 lookahead
 
     if rate > 24000:
         coding_rate = 48000
@@ -65,69 +100,132 @@ def encode(inputdata):
             raise MemoryError("Upsampling failed.") from None
         dbg("Resampled data length: %s", len(inputdata))
 
+    # the output buffer is sized for the worst case of the sample count,
+    # so it normally never has to grow.
+    cdef size_t frame_count = len(inputdata) // (wframe_len * frame_sz) + 1
+    cdef ogg_buffer out
+    out.size = 0
+    out.capacity = 4096 + frame_count * (MAX_FRAME_BYTES + PACKET_OGG_OVERHEAD)
+    out.data = <unsigned char *> malloc(out.capacity)
+    if out.data == NULL:
+        raise MemoryError("Could not allocate output buffer.")
+
+    try:
+        return encode_frames(inputdata, inopt, &out,
+                             channels, wframe_len, coding_rate, frame_sz)
+    finally:
+        free(out.data)
+
+
+cdef encode_frames(inputdata, dict inopt, ogg_buffer *out,
+                   int channels, int wframe_len,
+                   opus.opus_int32 coding_rate, opus.opus_int32 frame_sz):
+    '''
+    Runs the encoder for encode(), writing the ogg stream to out.
+    Returns the encoded file as bytes object, or an error message.
+    '''
+    cdef ogg.ogg_packet packet
+    cdef ogg.ogg_page page
+    cdef ogg.ogg_stream_state stream
+    cdef ogg.ogg_packet *op = &packet
+    cdef ogg.ogg_page *og = &page
+    cdef ogg.ogg_stream_state *os = &stream
+    cdef opus.OpusEncoder *oe
+    cdef int err
+    cdef opus.opus_int32 lookahead
+
     # initialize structs
-    if ogg.ogg_stream_init(&os, int(time.time() * 100) % (1<<31)):
+    if ogg.ogg_stream_init(os, int(time.time() * 100) % (1<<31)):
         return "Could not initialize ogg_stream."
 
     oe = opus.opus_encoder_create(coding_rate, channels, opus.OPUS_APPLICATION_AUDIO, &err)
     if err != opus.OPUS_OK:
-        ogg.ogg_stream_clear(&os)
+        ogg.ogg_stream_clear(os)
         if err == opus.OPUS_ALLOC_FAIL:
             raise MemoryError("Could not allocate opus encoder.")
         return "Could not allocate opus encoder."
 
     err = opus.opus_encoder_ctl(oe, opus.OPUS_GET_LOOKAHEAD(&lookahead))
     if err != opus.OPUS_OK:
-        free_buffers(&os, oe, NULL, NULL)
+        free_buffers(os, oe, NULL, NULL)
         return "Getting encoder lookahead failed: {}".format(err)
 
     inopt['pre_skip'] = int(lookahead / (48000 / coding_rate))
 
-    try:
-        if write_opus_header(&os, &op, inopt):
-            free_buffers(&os, oe, NULL, NULL)
-            return "Could not write opus header."
+    if write_opus_header(os, op, inopt):
+        free_buffers(os, oe, NULL, NULL)
+        return "Could not write opus header."
 
-        while ogg.ogg_stream_flush(&os, &og):
-            outsize = write_ogg_page(outsize, outdata, &og)
-    except MemoryError:
-        free_buffers(&os, oe, NULL, NULL)
-        raise MemoryError("Could not create opus header.") from None
+    while ogg.ogg_stream_flush(os, og):
+        if write_ogg_page(out, og):
+            free_buffers(os, oe, NULL, NULL)
+            raise MemoryError("Could not create opus header.")
 
-    try:
-        if write_opus_comment(&os, &op):
-            free_buffers(&os, oe, NULL, NULL)
-            return "Could not write opus comment."
+    if write_opus_comment(os, op):
+        free_buffers(os, oe, NULL, NULL)
+        return "Could not write opus comment."
 
-        while ogg.ogg_stream_flush(&os, &og):
-            outsize = write_ogg_page(outsize, outdata, &og)
-    except MemoryError:
-        free_buffers(&os, oe, NULL, NULL)
-        raise MemoryError("Could not write opus comment.") from None
+    while ogg.ogg_stream_flush(os, og):
+        if write_ogg_page(out, og):
+            free_buffers(os, oe, NULL, NULL)
+            raise MemoryError("Could not write opus comment.")
 
     # allocate buffer for samples.
     cdef size_t padbuf_sz = wframe_len * frame_sz
     cdef size_t outbuf_sz = wframe_len * frame_sz  #TODO better size
-    cdef unsigned char *inbuf = NULL
-    cdef unsigned char *padbuf = <unsigned char *> PyMem_Malloc(padbuf_sz)
-    op.packet = <unsigned char *> PyMem_Malloc(outbuf_sz)
+    cdef unsigned char *padbuf = <unsigned char *> malloc(padbuf_sz)
+    op.packet = <unsigned char *> malloc(outbuf_sz)
     if padbuf == NULL or op.packet == NULL:
-        free_buffers(&os, oe, padbuf, op.packet)
+        free_buffers(os, oe, padbuf, op.packet)
         raise MemoryError("Could not allocate buffers.")
     op.granulepos = <ogg.ogg_int64_t> inopt['pre_skip']
 
-    # Main encoding loop (one frame per iteration)
+    cdef const unsigned char *indata = inputdata
+    cdef size_t in_sz = len(inputdata)
+
+    # the main encoding loop doesn't need the GIL.
+    cdef int result
+    dbg("Starting encoding loop.")
+    with nogil:
+        result = encode_loop(indata, in_sz, padbuf, padbuf_sz,
+                             outbuf_sz, out, op, og, os, oe,
+                             wframe_len, coding_rate, frame_sz)
+
+    free_buffers(os, oe, padbuf, op.packet)
+
+    if result == ENCODE_OUT_OF_MEMORY:
+        raise MemoryError("Could not write opus data.")
+    elif result == ENCODE_PACKETIN_FAILED:
+        return "ogg_stream_packetin() failed."
+    elif result != ENCODE_OK:
+        return "Encoding error in opus_encode(): {}".format(result)
+
+    return PyBytes_FromStringAndSize(<char *> out.data, out.size)
+
+
+
+cdef int encode_loop(const unsigned char *indata, size_t in_sz,
+                     unsigned char *padbuf, size_t padbuf_sz,
+                     size_t outbuf_sz, ogg_buffer *out,
+                     ogg.ogg_packet *op, ogg.ogg_page *og,
+                     ogg.ogg_stream_state *os, opus.OpusEncoder *oe,
+                     int wframe_len, opus.opus_int32 coding_rate,
+                     opus.opus_int32 frame_sz) nogil:
+    '''
+    Main encoding loop (one frame per iteration).
+    Returns ENCODE_OK, another ENCODE_* value or an opus error code.
+    '''
+    cdef const unsigned char *inbuf = NULL
     cdef opus.opus_int32 enc_bytes = 0  # encoded bytes in this iteration
     cdef size_t ttl_samples = 0         # read samples
-    cdef size_t in_sz = len(inputdata)
-    cdef size_t in_pos = 0              # offset of next sample in inputdata
+    cdef size_t in_pos = 0              # offset of next sample in indata
     cdef size_t nb_samples              # no. of samples available this iteration
-    dbg("Starting encoding loop.")
+
     while not op.e_o_s:
-        # fill buffer. Read directly from input_data, if possible.
-        nb_samples = min((in_sz - in_pos) // wframe_len, frame_sz)
-        inbuf = (<unsigned char *> inputdata) + ttl_samples * wframe_len
-        if nb_samples < frame_sz:
+        # fill buffer. Read directly from indata, if possible.
+        nb_samples = min((in_sz - in_pos) // wframe_len, <size_t> frame_sz)
+        inbuf = indata + ttl_samples * wframe_len
+        if nb_samples < <size_t> frame_sz:
             op.e_o_s = 1
             memcpy(padbuf, inbuf, in_sz - in_pos)
             memset(padbuf + in_sz - in_pos, 0, padbuf_sz - (in_sz - in_pos))
@@ -136,13 +234,11 @@ def encode(inputdata):
         in_pos += nb_samples * wframe_len
         ttl_samples += nb_samples
 
-
         # convert.
-        enc_bytes = opus.opus_encode(oe, <opus.opus_int16 *> inbuf, frame_sz, op.packet, outbuf_sz)
+        enc_bytes = opus.opus_encode(oe, <const opus.opus_int16 *> inbuf, frame_sz, op.packet, outbuf_sz)
         # check how much was converted/ loop or EOF ?
         if enc_bytes < 0:
-            free_buffers(&os, oe, padbuf, op.packet)
-            return "Encoding error in opus_encode(): {}".format(enc_bytes)
+            return enc_bytes
 
         # append converted opuspacket.
         op.bytes = enc_bytes
@@ -151,24 +247,16 @@ def encode(inputdata):
             pass  # TODO. set granulepos ? for resampling decoders.
         op.packetno += 1
 
-        err = ogg.ogg_stream_packetin(&os, &op)
-        if err:
-            free_buffers(&os, oe, padbuf, op.packet)
-            return "ogg_stream_packetin() failed."
+        if ogg.ogg_stream_packetin(os, op):
+            return ENCODE_PACKETIN_FAILED
 
-        try:
-            # Try to write page or force, if end of stream is reached.
-            while ogg.ogg_stream_pageout(&os, &og)\
-                    or (op.e_o_s and ogg.ogg_stream_flush(&os, &og)):
-                outsize = write_ogg_page(outsize, outdata, &og)
-        except MemoryError:
-                free_buffers(&os, oe, padbuf, op.packet)
-                raise MemoryError("Could not write opus data.") from None
-
-
-    free_buffers(&os, oe, padbuf, op.packet)
+        # Try to write page or force, if end of stream is reached.
+        while ogg.ogg_stream_pageout(os, og)\
+                or (op.e_o_s and ogg.ogg_stream_flush(os, og)):
+            if write_ogg_page(out, og):
+                return ENCODE_OUT_OF_MEMORY
 
-    return outdata[:outsize]
+    return ENCODE_OK
 
 
 cdef int write_opus_header(ogg.ogg_stream_state *os, ogg.ogg_packet *op, inopt):
@@ -296,33 +384,41 @@ def read_wav(wav):
     return inopt
 
 
-cdef int write_ogg_page(size_t offset, bytearray outdata, ogg.ogg_page *og) except? 0:
+cdef int write_ogg_page(ogg_buffer *out, ogg.ogg_page *og) nogil:
     '''
-    Write 'og' at 'offset' into 'outdata'.
-    If succesful, return new offset. Otherwise, raise a MemoryError.
+    Append 'og' to 'out', growing it if necessary.
+    Returns non-zero if the buffer could not be grown.
     '''
-    if PyByteArray_GET_SIZE(outdata) < offset + og.header_len + og.body_len:
-        # TODO increase more than necessary
-        PyByteArray_Resize(outdata, offset + og.header_len + og.body_len)
+    cdef size_t page_len = og.header_len + og.body_len
+    cdef size_t new_capacity
+    cdef unsigned char *new_data
 
-    cdef char *out = PyByteArray_AS_STRING(outdata) + offset
-    memcpy(out, og.header, og.header_len)
-    memcpy(out + og.header_len, og.body, og.body_len)
-    return offset + og.header_len + og.body_len
+    if out.size + page_len > out.capacity:
+        new_capacity = max(2 * out.capacity, out.size + page_len)
+        new_data = <unsigned char *> realloc(out.data, new_capacity)
+        if new_data == NULL:
+            return 1
+
+        out.data = new_data
+        out.capacity = new_capacity
+
+    memcpy(out.data + out.size, og.header, og.header_len)
+    memcpy(out.data + out.size + og.header_len, og.body, og.body_len)
+    out.size += page_len
+    return 0
 
 
 cdef void free_buffers(ogg.ogg_stream_state *os, opus.OpusEncoder *oe,
-                       unsigned char *pymem1, unsigned char *pymem2):
+                       unsigned char *mem1, unsigned char *mem2):
     ogg.ogg_stream_clear(os)
     if oe != NULL:
         opus.opus_encoder_destroy(oe)
-    if pymem1 != NULL:
-        PyMem_Free(pymem1)
-    if pymem2 != NULL:
-        PyMem_Free(pymem2)
+    free(mem1)
+    free(mem2)
     return
 
 
+@cython.cdivision(True)
 cdef upsample(const char *inp, size_t inp_len, dict opts, int target_rate):
     '''
     Upsamples the PCM-data in 'indata' to 'target_rate' using linear
@@ -386,28 +482,30 @@ cdef upsample(const char *inp, size_t inp_len, dict opts, int target_rate):
     # Therefore inp must be casted to (char *). But we convert to a stream
     # with 16 bits ber sample. To keep the audio volume the same, we set the
     # higher order byte to the calculated value.
-    if bit_depth > 8:
-        for iout in range(0, osmpls):
-            if (iin + 1) * num < iout * den:
-                iin += 1
-
-            alpha = (<float> iout * den) / num - iin
-            for ch in range(0, channel):
-                a = (<short *> inp)[iin * channel + ch]
-                b = (<short *> inp)[(iin + 1) * channel + ch]
-                (<opus.opus_int16 *> out)[iout * channel + ch] = \
-                        (<opus.opus_int16> (a + alpha * (b - a))) & mask
-    else:
-        for iout in range(0, osmpls):
-            if (iin + 1) * num < iout * den:
-                iin += 1
-
-            alpha = (<float> iout * den) / num - iin
-            for ch in range(0, channel):
-                a = (<char *> inp)[iin * channel + ch]
-                b = (<char *> inp)[(iin + 1) * channel + ch]
-                (<opus.opus_int16 *> out)[iout * channel + ch] = \
-                        (<opus.opus_int16> (a + alpha * (b - a))) << 8 & mask
+    # The interpolation runs without the GIL.
+    with nogil:
+        if bit_depth > 8:
+            for iout in range(0, osmpls):
+                if (iin + 1) * num < iout * den:
+                    iin += 1
+
+                alpha = (<float> iout * den) / num - iin
+                for ch in range(0, channel):
+                    a = (<short *> inp)[iin * channel + ch]
+                    b = (<short *> inp)[(iin + 1) * channel + ch]
+                    (<opus.opus_int16 *> out)[iout * channel + ch] = \
+                            (<opus.opus_int16> (a + alpha * (b - a))) & mask
+        else:
+            for iout in range(0, osmpls):
+                if (iin + 1) * num < iout * den:
+                    iin += 1
+
+                alpha = (<float> iout * den) / num - iin
+                for ch in range(0, channel):
+                    a = (<char *> inp)[iin * channel + ch]
+                    b = (<char *> inp)[(iin + 1) * channel + ch]
+                    (<opus.opus_int16 *> out)[iout * channel + ch] = \
+                            (<opus.opus_int16> (a + alpha * (b - a))) << 8 & mask
 
     return ret
 
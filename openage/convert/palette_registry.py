@@ -0,0 +1,77 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Process-wide storage of the parsed color palettes.
+
+Every graphics export needs the palette of its game edition, but
+reading and parsing the palette file again for each of the thousands
+of graphics is wasted work. The registry parses each palette once
+and keeps it, together with its numpy lookup table.
+"""
+
+from threading import Lock
+
+from ..log import dbg
+from .colortable import ColorTable
+
+
+class PaletteRegistry:
+    """
+    Parsed ColorTables, by game edition and source path.
+
+    The registry can be pickled, e.g. for handing the already
+    loaded palettes to worker processes.
+    """
+
+    def __init__(self):
+        # (game edition, palette path) -> ColorTable
+        self.palettes = {}
+
+        # guards the loading of palettes
+        self.lock = Lock()
+
+    def get_palette(self, palette_path, game_edition=None):
+        """
+        Returns the ColorTable for the palette file at the
+        util.fslike palette_path. It's loaded if necessary.
+        """
+        key = (game_edition, str(palette_path))
+
+        palette = self.palettes.get(key)
+        if palette is not None:
+            return palette
+
+        with self.lock:
+            # another thread may have loaded it in the meantime
+            palette = self.palettes.get(key)
+            if palette is not None:
+                return palette
+
+            dbg("loading palette %s", palette_path)
+
+            with palette_path.open("rb") as palette_file:
+                palette = ColorTable(palette_file.read())
+
+            # create the lookup table right away,
+            # so it's shared by all users of the palette.
+            palette.get_rgba_array()
+
+            self.palettes[key] = palette
+
+        return palette
+
+    def __len__(self):
+        return len(self.palettes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+
+# the palettes that were loaded by this process
+PALETTES = PaletteRegistry()
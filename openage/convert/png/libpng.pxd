@@ -2,7 +2,7 @@
 
 from libc.stdio cimport FILE
 
-cdef extern from "libpng/png.h":
+cdef extern from "libpng/png.h" nogil:
     const char PNG_LIBPNG_VER_STRING[]
     const int PNG_COLOR_TYPE_RGBA = 6
     const int PNG_INTERLACE_NONE = 0
@@ -10,7 +10,16 @@ cdef extern from "libpng/png.h":
     const int PNG_FILTER_TYPE_DEFAULT = 0
     const int PNG_TRANSFORM_IDENTITY = 0
 
+    # row filters
+    const int PNG_FILTER_NONE = 0x08
+    const int PNG_FILTER_SUB = 0x10
+    const int PNG_FILTER_UP = 0x20
+    const int PNG_FILTER_AVG = 0x40
+    const int PNG_FILTER_PAETH = 0x80
+    const int PNG_ALL_FILTERS = 0xF8
+
     ctypedef unsigned char png_byte
+    ctypedef png_byte *png_bytep
     ctypedef const png_byte *png_const_bytep
     ctypedef png_byte **png_bytepp
     ctypedef unsigned long int png_uint_32
@@ -31,6 +40,8 @@ cdef extern from "libpng/png.h":
     ctypedef void *png_voidp
     ctypedef (png_structp, png_const_charp) *png_error_ptr
     ctypedef FILE *png_FILE_p
+    ctypedef void (*png_rw_ptr)(png_structp, png_bytep, size_t) nogil
+    ctypedef void (*png_flush_ptr)(png_structp) nogil
 
     png_structp png_create_write_struct(png_const_charp user_png_ver,
                                         png_voidp error_ptr,
@@ -49,6 +60,18 @@ cdef extern from "libpng/png.h":
                       int filter_method)
     void png_init_io(png_structrp png_ptr,
                      png_FILE_p fp)
+    void png_set_write_fn(png_structrp png_ptr,
+                          png_voidp io_ptr,
+                          png_rw_ptr write_data_fn,
+                          png_flush_ptr output_flush_fn)
+    png_voidp png_get_io_ptr(png_const_structrp png_ptr)
+    void png_set_compression_level(png_structrp png_ptr,
+                                   int level)
+    void png_set_compression_strategy(png_structrp png_ptr,
+                                      int strategy)
+    void png_set_filter(png_structrp png_ptr,
+                        int method,
+                        int filters)
     void png_set_rows(png_const_structrp png_ptr,
                       png_inforp info_ptr,
                       png_bytepp row_pointers)
@@ -2,10 +2,10 @@
 #
 # cython: profile=False
 
-from libc.stdio cimport fopen, fclose
 from libc.stdint cimport uint8_t
-from libc.stdlib cimport realloc
-from cpython.mem cimport PyMem_Malloc
+from libc.stdlib cimport free, realloc
+from libc.string cimport memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize
 
 from . cimport libpng
 
@@ -14,35 +14,103 @@ import numpy
 cimport numpy
 
 
+cdef extern from "zlib.h":
+    const int Z_DEFAULT_COMPRESSION
+    const int Z_BEST_SPEED
+    const int Z_BEST_COMPRESSION
+    const int Z_FILTERED
+    const int Z_RLE
+
+
+# compression presets:
+# name -> (zlib compression level, zlib strategy, png row filters)
+COMPRESSION_PRESETS = {
+    # quick encoding for development builds
+    "fast": (Z_BEST_SPEED, Z_RLE, libpng.PNG_FILTER_SUB),
+
+    # the libpng defaults
+    "default": (Z_DEFAULT_COMPRESSION, Z_FILTERED, libpng.PNG_ALL_FILTERS),
+
+    # smallest files, e.g. for release packs
+    "max": (Z_BEST_COMPRESSION, Z_FILTERED, libpng.PNG_ALL_FILTERS),
+}
+
+
+cdef struct png_buffer:
+    # the encoded png data
+    uint8_t *data
+    size_t size
+    size_t capacity
+
+    # set when growing the buffer failed
+    bint failed
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def save(filename, numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] imagedata not None):
+def save(numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] imagedata not None,
+         compression="default"):
     """
-    Save an image as a PNG file.
+    Encode an RGBA image as PNG.
+
+    compression is one of the keys of COMPRESSION_PRESETS.
+
+    Returns the PNG file content as bytes object.
     """
+    if imagedata.shape[2] != 4:
+        raise ValueError("RGBA image data expected, "
+                         "got %d channels" % imagedata.shape[2])
+
+    try:
+        level, strategy, filters = COMPRESSION_PRESETS[compression]
+    except KeyError:
+        raise ValueError("unknown png compression: %s" % compression) from None
+
     cdef unsigned int width = imagedata.shape[1]
     cdef unsigned int height = imagedata.shape[0]
     cdef numpy.uint8_t[:,:,::1] mview = imagedata
-    png_create(filename.encode('UTF-8'), mview, width, height)
+
+    cdef png_buffer buf
+    buf.data = NULL
+    buf.size = 0
+    buf.capacity = 0
+    buf.failed = False
+
+    try:
+        with nogil:
+            png_create(&buf, mview, width, height, level, strategy, filters)
+
+        if buf.failed:
+            raise MemoryError("could not allocate the png buffer")
+
+        return PyBytes_FromStringAndSize(<char *> buf.data, buf.size)
+
+    finally:
+        free(buf.data)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void png_create(char* filename, numpy.uint8_t[:,:,::1] imagedata,
-                     int width, int height):
+cdef void png_create(png_buffer *buf, numpy.uint8_t[:,:,::1] imagedata,
+                     int width, int height,
+                     int level, int strategy, int filters) nogil:
     """
-    Create a PNG file with libpng and write it to file.
+    Create a PNG file with libpng and write it to buf.
     """
-    cdef libpng.png_FILE_p fp = fopen(filename, "wb")
-
     cdef libpng.png_structp png
     cdef libpng.png_infop info
+    cdef int row_idx
 
     png = libpng.png_create_write_struct(libpng.PNG_LIBPNG_VER_STRING, NULL, NULL, NULL)
     info = libpng.png_create_info_struct(png)
-    
-    libpng.png_init_io(png, fp)
-    libpng.png_set_IHDR(png, 
+
+    libpng.png_set_write_fn(png, buf, write_to_buffer, flush_buffer)
+
+    libpng.png_set_compression_level(png, level)
+    libpng.png_set_compression_strategy(png, strategy)
+    libpng.png_set_filter(png, 0, filters)
+
+    libpng.png_set_IHDR(png,
                         info,
                         width,
                         height,
@@ -52,16 +120,44 @@ cdef void png_create(char* filename, numpy.uint8_t[:,:,::1] imagedata,
                         libpng.PNG_COMPRESSION_TYPE_DEFAULT,
                         libpng.PNG_FILTER_TYPE_DEFAULT)
     libpng.png_write_info(png, info)
-    
+
     for row_idx in range(height):
         libpng.png_write_row(png, &imagedata[row_idx,0,0])
 
     libpng.png_write_end(png, info)
 
-    # TODO: This doesn't work, but would be faster
-    # libpng.png_set_rows(png, info, imagedata)
-    # libpng.png_write_png(png, info, libpng.PNG_TRANSFORM_IDENTITY, NULL)
-    
-    fclose(fp)
-    
-    libpng.png_destroy_write_struct(&png, &info)
\ No newline at end of file
+    libpng.png_destroy_write_struct(&png, &info)
+
+
+cdef void write_to_buffer(libpng.png_structp png,
+                          libpng.png_bytep data, size_t length) nogil:
+    """
+    libpng write callback; appends the data to the png_buffer.
+    """
+    cdef png_buffer *buf = <png_buffer *> libpng.png_get_io_ptr(png)
+    cdef size_t new_capacity
+    cdef uint8_t *new_data
+
+    if buf.failed:
+        return
+
+    if buf.size + length > buf.capacity:
+        new_capacity = max(2 * buf.capacity, buf.size + length, 65536)
+        new_data = <uint8_t *> realloc(buf.data, new_capacity)
+
+        if new_data == NULL:
+            buf.failed = True
+            return
+
+        buf.data = new_data
+        buf.capacity = new_capacity
+
+    memcpy(buf.data + buf.size, data, length)
+    buf.size += length
+
+
+cdef void flush_buffer(libpng.png_structp png) nogil:
+    """
+    libpng flush callback; there's nothing to flush for buffers.
+    """
+    pass
@@ -0,0 +1,287 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Creates the raw API objects of converter groups on a process pool.
+
+The raw API objects of a line are independent of the other lines
+until the nyan objects are linked, so each line can be converted
+by its own task. The workers are forked from the converter, so they
+start with the same dataset and no data has to be sent to them.
+
+Each worker returns the pickled raw API objects of its group. Objects
+that existed before the fork (the dataset, API objects, groups, ...)
+are pickled as references to their copies in the parent process.
+The sprites and sounds created by the workers are recreated in the
+parent, sounds are shared by file id like in the serial conversion.
+The results are merged in the order of the tasks, so the outcome
+doesn't depend on the number of workers.
+"""
+
+import multiprocessing
+import os
+import pickle
+from io import BytesIO
+
+from ...dataformat.aoc.combined_sound import CombinedSound
+from ...dataformat.aoc.combined_sprite import CombinedSprite
+from ...dataformat.converter_object import ConverterObject, ConverterObjectGroup
+from ....nyan.nyan_structs import NyanObject
+
+
+# values that are pickled by value even if they are shared
+PRIMITIVE_TYPES = (bool, int, float, str, bytes, tuple, type(None))
+
+# (dataset, shared objects, group processing functions) of the pool,
+# inherited by the forked workers
+_POOL_STATE = None
+
+
+def get_shared_objects(full_data_set):
+    """
+    Returns the list of objects that are reachable from the dataset
+    before the workers are forked. Workers refer to these objects
+    by their index in the list.
+    """
+    objects = [full_data_set, full_data_set.nyan_api_objects]
+    objects.extend(full_data_set.nyan_api_objects.values())
+
+    for value in vars(full_data_set).values():
+        if isinstance(value, dict) and value is not full_data_set.nyan_api_objects:
+            objects.extend(obj for obj in value.values()
+                           if not isinstance(obj, PRIMITIVE_TYPES))
+
+    for raw_api_object in full_data_set.pregen_nyan_objects.values():
+        if raw_api_object.nyan_object is not None:
+            objects.append(raw_api_object.nyan_object)
+
+    return objects
+
+
+def dump_raw_api_objects(group, shared_ids):
+    """
+    Pickles the raw API objects of the group.
+
+    :param shared_ids: Maps the id() of the shared objects to
+                       their index in the shared objects list.
+    """
+    def persistent_id(obj):
+        """ refers to shared objects instead of pickling them """
+        index = shared_ids.get(id(obj))
+        if index is not None:
+            return ("shared", index)
+
+        if isinstance(obj, CombinedSprite):
+            return ("sprite", id(obj), obj.head_sprite_id, obj.filename)
+
+        if isinstance(obj, CombinedSound):
+            return ("sound", obj.head_sound_id, obj.file_id, obj.filename)
+
+        if isinstance(obj, (ConverterObject, ConverterObjectGroup, NyanObject)):
+            # a copy would silently break the links between the objects
+            raise Exception("%s was created after the workers were forked "
+                            "and can't be returned by them" % (obj))
+
+        return None
+
+    result = BytesIO()
+    pickler = pickle.Pickler(result, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(group.raw_api_objects)
+
+    return result.getvalue()
+
+
+def load_raw_api_objects(group, data, full_data_set, shared_objects):
+    """
+    Adds the raw API objects pickled by a worker to the group.
+
+    The references of the sprites and sounds to the raw
+    API objects are restored, too.
+    """
+    # sprites created by the worker for this group, by their id in the worker
+    sprites = {}
+
+    def persistent_load(pid):
+        """ resolves the references to shared objects """
+        if pid[0] == "shared":
+            return shared_objects[pid[1]]
+
+        if pid[0] == "sprite":
+            _, worker_id, head_sprite_id, filename = pid
+            sprite = sprites.get(worker_id)
+
+            if sprite is None:
+                sprite = CombinedSprite(head_sprite_id, filename, full_data_set)
+                full_data_set.combined_sprites[head_sprite_id] = sprite
+                sprites[worker_id] = sprite
+
+            return sprite
+
+        if pid[0] == "sound":
+            _, head_sound_id, file_id, filename = pid
+            sound = full_data_set.combined_sounds.get(file_id)
+
+            if sound is None:
+                sound = CombinedSound(head_sound_id, file_id, filename,
+                                      full_data_set)
+                full_data_set.combined_sounds[file_id] = sound
+
+            return sound
+
+        raise pickle.UnpicklingError("unknown persistent id: %s" % (pid,))
+
+    unpickler = pickle.Unpickler(BytesIO(data))
+    unpickler.persistent_load = persistent_load
+    raw_api_objects = unpickler.load()
+
+    for raw_api_object in raw_api_objects.values():
+        group.add_raw_api_object(raw_api_object)
+
+        for _, value, _ in raw_api_object.raw_members:
+            values = value if isinstance(value, list) else (value,)
+
+            for member_value in values:
+                if isinstance(member_value, (CombinedSprite, CombinedSound)):
+                    member_value.add_reference(raw_api_object)
+
+
+def process_group(task):
+    """
+    Creates the raw API objects of a group in a worker process.
+    """
+    full_data_set, shared_ids, process_functions = _POOL_STATE
+    group_type, group_id = task
+
+    group = getattr(full_data_set, group_type)[group_id]
+    process_functions[group_type](group)
+
+    return dump_raw_api_objects(group, shared_ids)
+
+
+def can_fork():
+    """
+    Returns True if the pool can be used on this platform.
+    """
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def process_groups(full_data_set, tasks, process_functions, jobs=None):
+    """
+    Runs process_functions[group_type](group) for each
+    (group_type, group_id) task on a pool of forked workers.
+
+    :param full_data_set: GenieObjectContainer that holds the groups
+                          in its group_type attributes.
+    :param tasks: List of (group_type, group_id) tuples.
+    :param process_functions: Creates the raw API objects of a group,
+                              by group type.
+    :param jobs: Number of worker processes; all cores by default.
+    """
+    global _POOL_STATE  # pylint: disable=global-statement
+
+    if jobs is None:
+        jobs = os.cpu_count()
+
+    shared_objects = get_shared_objects(full_data_set)
+    shared_ids = {id(obj): index for index, obj in enumerate(shared_objects)}
+
+    _POOL_STATE = (full_data_set, shared_ids, process_functions)
+
+    try:
+        context = multiprocessing.get_context("fork")
+        chunksize = max(1, len(tasks) // (jobs * 4))
+
+        with context.Pool(jobs) as pool:
+            results = pool.imap(process_group, tasks, chunksize)
+
+            # imap returns the results in the order of the tasks
+            for (group_type, group_id), data in zip(tasks, results):
+                group = getattr(full_data_set, group_type)[group_id]
+                load_raw_api_objects(group, data, full_data_set,
+                                     shared_objects)
+
+    finally:
+        _POOL_STATE = None
+
+
+def test():
+    """
+    Compares the raw API objects created by the pool
+    to the ones of the serial conversion.
+    """
+    from ....testing.testing import assert_value
+    from ...dataformat.aoc.expected_pointer import ExpectedPointer
+    from ...dataformat.aoc.genie_object_container import GenieObjectContainer
+    from ...dataformat.converter_object import RawAPIObject
+
+    if not can_fork():
+        return
+
+    def create_dataset():
+        """ creates lines that share sounds and an API object """
+        dataset = GenieObjectContainer()
+        dataset.nyan_api_objects = {"engine.Unit": NyanObject("Unit")}
+        dataset.genie_sounds = {7: ConverterObject(7)}
+
+        for line_id in range(12):
+            dataset.unit_lines[line_id] = ConverterObjectGroup(line_id)
+            dataset.unit_lines[line_id].data = dataset
+
+        return dataset
+
+    def process_line(line):
+        """ creates the raw API objects of a line """
+        dataset = line.data
+        name = "Line%d" % line.get_id()
+
+        unit = RawAPIObject(name, name, dataset.nyan_api_objects)
+        unit.add_raw_parent("engine.Unit")
+        unit.set_location("data/%s/" % name)
+
+        sprite = CombinedSprite(line.get_id() % 3, "sprite_%s" % name, dataset)
+        dataset.combined_sprites.update({sprite.get_id(): sprite})
+        sprite.add_reference(unit)
+
+        if 7 in dataset.combined_sounds:
+            sound = dataset.combined_sounds[7]
+        else:
+            sound = CombinedSound(7, 7, "sound_%s" % name, dataset)
+            dataset.combined_sounds.update({7: sound})
+        sound.add_reference(unit)
+
+        next_line = dataset.unit_lines[(line.get_id() + 1) % 12]
+        unit.add_raw_member("sprite", sprite, "engine.Unit")
+        unit.add_raw_member("sounds", [sound], "engine.Unit")
+        unit.add_raw_member("next", ExpectedPointer(next_line, "Line"), "engine.Unit")
+        line.add_raw_api_object(unit)
+
+    def describe(dataset):
+        """ returns the comparable state of the dataset """
+        lines = []
+        for line in dataset.unit_lines.values():
+            for raw_api_object in line.get_raw_api_objects().values():
+                sprite, sounds, pointer = (member[1] for member
+                                           in raw_api_object.raw_members)
+                next_line = pointer.group_object
+
+                lines.append((raw_api_object.get_id(),
+                              raw_api_object.api_ref is dataset.nyan_api_objects,
+                              sprite is dataset.combined_sprites[sprite.get_id()],
+                              sprite.get_relative_sprite_location(),
+                              sounds[0] is dataset.combined_sounds[7],
+                              next_line is dataset.unit_lines[next_line.get_id()]))
+
+        sound = dataset.combined_sounds[7]
+        return (lines, sound.filename, len(sound._refs),  # pylint: disable=protected-access
+                [sprite.filename for sprite in dataset.combined_sprites.values()])
+
+    tasks = [("unit_lines", line_id) for line_id in range(12)]
+
+    serial = create_dataset()
+    for _, line_id in tasks:
+        process_line(serial.unit_lines[line_id])
+
+    pooled = create_dataset()
+    process_groups(pooled, tasks, {"unit_lines": process_line}, jobs=3)
+
+    assert_value(describe(pooled), describe(serial))
@@ -4,10 +4,13 @@
 Convert API-like objects to nyan objects. Subroutine of the
 main AoC processor.
 """
+import os
+
 from ...dataformat.aoc.internal_nyan_names import UNIT_LINE_LOOKUPS, CLASS_ID_LOOKUPS,\
     BUILDING_LINE_LOOKUPS, TECH_GROUP_LOOKUPS
 from ...dataformat.converter_object import RawAPIObject
 from ...dataformat.aoc.genie_unit import GenieVillagerGroup
+from . import entity_pool
 from .ability_subprocessor import AoCAbilitySubprocessor
 from openage.convert.processor.aoc.auxiliary_subprocessor import AoCAuxiliarySubprocessor
 from openage.convert.dataformat.aoc.expected_pointer import ExpectedPointer
@@ -19,9 +22,15 @@ from openage.convert.dataformat.aoc.internal_nyan_names import AMBIENT_GROUP_LOO
 class AoCNyanSubprocessor:
 
     @classmethod
-    def convert(cls, gamedata):
+    def convert(cls, gamedata, jobs=None):
+        """
+        Creates the nyan objects of the game entities and techs.
 
-        cls._process_game_entities(gamedata)
+        :param jobs: Number of processes that create the raw API objects;
+                     all CPU cores by default.
+        :type jobs: int
+        """
+        cls._process_game_entities(gamedata, jobs)
         cls._create_nyan_objects(gamedata)
         cls._create_nyan_members(gamedata)
 
@@ -64,22 +73,93 @@ class AoCNyanSubprocessor:
         # TODO: civs, more complex game entities
 
     @classmethod
-    def _process_game_entities(cls, full_data_set):
+    def _process_game_entities(cls, full_data_set, jobs=None):
+        """
+        Creates the raw API objects of all lines and groups.
+
+        Each group is processed by its own task on a process pool
+        (see entity_pool), unless only one job is requested.
+        """
+        # the types are shared by the lines, so they
+        # must exist before the lines are processed
+        cls._create_game_entity_types(full_data_set)
+
+        tasks = []
+        tasks.extend(("unit_lines", line_id)
+                     for line_id in full_data_set.unit_lines)
+        tasks.extend(("building_lines", line_id)
+                     for line_id in full_data_set.building_lines)
+        tasks.extend(("ambient_groups", group_id)
+                     for group_id in full_data_set.ambient_groups)
+        tasks.extend(("tech_groups", group_id)
+                     for group_id, tech_group in full_data_set.tech_groups.items()
+                     if tech_group.is_researchable())
+
+        process_functions = {
+            "unit_lines": cls._unit_line_to_game_entity,
+            "building_lines": cls._building_line_to_game_entity,
+            "ambient_groups": cls._ambient_group_to_game_entity,
+            "tech_groups": cls._tech_group_to_tech,
+        }
+
+        if jobs is None:
+            jobs = os.cpu_count()
+
+        if jobs > 1 and len(tasks) > 1 and entity_pool.can_fork():
+            entity_pool.process_groups(full_data_set, tasks,
+                                       process_functions, jobs)
+
+        else:
+            for group_type, group_id in tasks:
+                group = getattr(full_data_set, group_type)[group_id]
+                process_functions[group_type](group)
 
+        # TODO: civs, more complex game entities
+
+    @classmethod
+    def _create_game_entity_types(cls, full_data_set):
+        """
+        Creates the game entity types for the classes of all
+        unit and building lines.
+        """
         for unit_line in full_data_set.unit_lines.values():
-            cls._unit_line_to_game_entity(unit_line)
+            if isinstance(unit_line, GenieVillagerGroup):
+                current_unit = unit_line.variants[0].line[0]
+
+            else:
+                current_unit = unit_line.line[0]
+
+            unit_class = current_unit.get_member("unit_class").get_value()
+            cls._get_game_entity_type(full_data_set, unit_class)
 
         for building_line in full_data_set.building_lines.values():
-            cls._building_line_to_game_entity(building_line)
+            current_building = building_line.line[0]
+            unit_class = current_building.get_member("unit_class").get_value()
+            cls._get_game_entity_type(full_data_set, unit_class)
 
-        for ambient_group in full_data_set.ambient_groups.values():
-            cls._ambient_group_to_game_entity(ambient_group)
+    @staticmethod
+    def _get_game_entity_type(dataset, unit_class):
+        """
+        Returns the raw API object of the game entity type for a unit class.
+        The type is created if it doesn't exist yet.
 
-        for tech_group in full_data_set.tech_groups.values():
-            if tech_group.is_researchable():
-                cls._tech_group_to_tech(tech_group)
+        :param unit_class: Class ID of a unit or building.
+        :type unit_class: int
+        """
+        class_name = CLASS_ID_LOOKUPS[unit_class]
+        class_obj_name = "aux.game_entity_type.types.%s" % (class_name)
 
-        # TODO: civs, more complex game entities
+        # Create the game entity type on-the-fly if it not already exists
+        if class_obj_name not in dataset.pregen_nyan_objects.keys():
+            type_location = "data/aux/game_entity_type/"
+            new_game_entity_type = RawAPIObject(class_obj_name, class_name,
+                                                dataset.nyan_api_objects, type_location)
+            new_game_entity_type.set_filename("types")
+            new_game_entity_type.add_raw_parent("engine.aux.game_entity_type.GameEntityType")
+            new_game_entity_type.create_nyan_object()
+            dataset.pregen_nyan_objects.update({class_obj_name: new_game_entity_type})
+
+        return dataset.pregen_nyan_objects[class_obj_name]
 
     @staticmethod
     def _unit_line_to_game_entity(unit_line):
@@ -128,20 +208,7 @@ class AoCNyanSubprocessor:
             types_set.append(type_obj)
 
         unit_class = current_unit.get_member("unit_class").get_value()
-        class_name = CLASS_ID_LOOKUPS[unit_class]
-        class_obj_name = "aux.game_entity_type.types.%s" % (class_name)
-
-        # Create the game entity type on-the-fly if it not already exists
-        if class_obj_name not in dataset.pregen_nyan_objects.keys():
-            type_location = "data/aux/game_entity_type/"
-            new_game_entity_type = RawAPIObject(class_obj_name, class_name,
-                                                dataset.nyan_api_objects, type_location)
-            new_game_entity_type.set_filename("types")
-            new_game_entity_type.add_raw_parent("engine.aux.game_entity_type.GameEntityType")
-            new_game_entity_type.create_nyan_object()
-            dataset.pregen_nyan_objects.update({class_obj_name: new_game_entity_type})
-
-        type_obj = dataset.pregen_nyan_objects[class_obj_name].get_nyan_object()
+        type_obj = AoCNyanSubprocessor._get_game_entity_type(dataset, unit_class).get_nyan_object()
         types_set.append(type_obj)
 
         raw_api_object.add_raw_member("types", types_set, "engine.aux.game_entity.GameEntity")
@@ -247,20 +314,7 @@ class AoCNyanSubprocessor:
             types_set.append(type_obj)
 
         unit_class = current_building.get_member("unit_class").get_value()
-        class_name = CLASS_ID_LOOKUPS[unit_class]
-        class_obj_name = "aux.game_entity_type.types.%s" % (class_name)
-
-        # Create the game entity type on-the-fly if it not already exists
-        if class_obj_name not in dataset.pregen_nyan_objects.keys():
-            type_location = "data/aux/game_entity_type/"
-            new_game_entity_type = RawAPIObject(class_obj_name, class_name,
-                                                dataset.nyan_api_objects, type_location)
-            new_game_entity_type.set_filename("types")
-            new_game_entity_type.add_raw_parent("engine.aux.game_entity_type.GameEntityType")
-            new_game_entity_type.create_nyan_object()
-            dataset.pregen_nyan_objects.update({class_obj_name: new_game_entity_type})
-
-        type_obj = dataset.pregen_nyan_objects[class_obj_name].get_nyan_object()
+        type_obj = AoCNyanSubprocessor._get_game_entity_type(dataset, unit_class).get_nyan_object()
         types_set.append(type_obj)
 
         if building_line.is_dropsite():
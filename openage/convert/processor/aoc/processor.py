@@ -40,7 +40,7 @@ from openage.convert.dataformat.aoc.genie_unit import GenieAmbientGroup
 class AoCProcessor:
 
     @classmethod
-    def convert(cls, gamespec):
+    def convert(cls, gamespec, jobs=None):
         """
         Input game speification and media here and get a set of
         modpacks back.
@@ -48,6 +48,9 @@ class AoCProcessor:
         :param gamespec: Gamedata from empires.dat read in by the
                          reader functions.
         :type gamespec: class: ...dataformat.value_members.ArrayMember
+        :param jobs: Number of processes for creating the nyan objects;
+                     all CPU cores by default.
+        :type jobs: int
         :returns: A list of modpacks.
         :rtype: list
         """
@@ -59,7 +62,7 @@ class AoCProcessor:
         data_set = cls._processor(data_set)
 
         # Create modpack definitions
-        modpacks = cls._post_processor(data_set)
+        modpacks = cls._post_processor(data_set, jobs)
 
         return modpacks
 
@@ -84,6 +87,7 @@ class AoCProcessor:
         cls._extract_building_connections(gamespec, data_set)
         cls._extract_unit_connections(gamespec, data_set)
         cls._extract_tech_connections(gamespec, data_set)
+        data_set.index_connections()
         cls._extract_genie_graphics(gamespec, data_set)
         cls._extract_genie_sounds(gamespec, data_set)
         cls._extract_genie_terrains(gamespec, data_set)
@@ -121,9 +125,9 @@ class AoCProcessor:
         return full_data_set
 
     @classmethod
-    def _post_processor(cls, full_data_set):
+    def _post_processor(cls, full_data_set, jobs=None):
 
-        AoCNyanSubprocessor.convert(full_data_set)
+        AoCNyanSubprocessor.convert(full_data_set, jobs)
         AoCMediaSubprocessor.convert(full_data_set)
 
         return AoCModpackSubprocessor.get_modpacks(full_data_set)
@@ -448,22 +452,14 @@ class AoCProcessor:
             else:
                 # The unit comes after another one
                 # Search other_connections for the previous unit in line
-                connected_types = connection.get_member("other_connections").get_value()
-                connected_index = -1
-                for index in range(len(connected_types)):
-                    connected_type = connected_types[index].get_value()["other_connection"].get_value()
-                    if connected_type == 2:
-                        # 2 == Unit
-                        connected_index = index
-                        break
+                # 2 == Unit
+                connected_unit_ids = full_data_set.get_connected_ids(connection, 2)
 
-                else:
+                if not connected_unit_ids:
                     raise Exception("Unit %s is not first in line, but no previous unit can"
                                     " be found in other_connections" % (unit_id))
 
-                # Find the id of the connected unit
-                connected_ids = connection.get_member("other_connected_ids").get_value()
-                previous_unit_id = connected_ids[connected_index].get_value()
+                previous_unit_id = connected_unit_ids[0]
 
                 unit_line.add_unit(unit, after=previous_unit_id)
 
@@ -530,18 +526,10 @@ class AoCProcessor:
             # Check if the building is part of an existing line.
             # To do this, we look for connected techs and
             # check if any tech has an upgrade effect.
-            connected_types = connection.get_member("other_connections").get_value()
-            connected_tech_indices = []
-            for index in range(len(connected_types)):
-                connected_type = connected_types[index].get_value()["other_connection"].get_value()
-                if connected_type == 3:
-                    # 3 == Tech
-                    connected_tech_indices.append(index)
-
-            connected_ids = connection.get_member("other_connected_ids").get_value()
-
-            for index in connected_tech_indices:
-                connected_tech_id = connected_ids[index].get_value()
+            # 3 == Tech
+            connected_tech_ids = full_data_set.get_connected_ids(connection, 3)
+
+            for connected_tech_id in connected_tech_ids:
                 connected_tech = full_data_set.genie_techs[connected_tech_id]
                 effect_bundle_id = connected_tech.get_member("tech_effect_id").get_value()
                 effect_bundle = full_data_set.genie_effect_bundles[effect_bundle_id]
@@ -567,19 +555,14 @@ class AoCProcessor:
                     continue
 
                 # Find the previous building
-                connected_index = -1
-                for c_index in range(len(connected_types)):
-                    connected_type = connected_types[c_index].get_value()["other_connection"].get_value()
-                    if connected_type == 1:
-                        # 1 == Building
-                        connected_index = c_index
-                        break
+                # 1 == Building
+                connected_building_ids = full_data_set.get_connected_ids(connection, 1)
 
-                else:
+                if not connected_building_ids:
                     raise Exception("Building %s is not first in line, but no previous building can"
                                     " be found in other_connections" % (building_id))
 
-                previous_building_id = connected_ids[connected_index].get_value()
+                previous_building_id = connected_building_ids[0]
 
                 # Add the upgrade tech group to the data set.
                 building_upgrade = BuildingLineUpgrade(connected_tech_id, line_id,
@@ -662,22 +645,14 @@ class AoCProcessor:
             if (tech.has_member("tech_type") and tech.get_member("tech_type").get_value() == 2)\
                     or connection.get_member("line_mode").get_value() == 0:
                 # Search other_connections for the age id
-                connected_types = connection.get_member("other_connections").get_value()
-                connected_index = -1
-                for index in range(len(connected_types)):
-                    connected_type = connected_types[index].get_value()["other_connection"].get_value()
-                    if connected_type == 0:
-                        # 2 == Unit
-                        connected_index = index
-                        break
+                # 0 == Age
+                connected_age_ids = full_data_set.get_connected_ids(connection, 0)
 
-                else:
+                if not connected_age_ids:
                     raise Exception("Tech %s is shown in Age progress bar, but no age id"
                                     " can be found in other_connections" % (tech_id))
 
-                # Find the age id in the connected ids
-                connected_ids = connection.get_member("other_connected_ids").get_value()
-                age_id = connected_ids[connected_index].get_value()
+                age_id = connected_age_ids[0]
                 age_up = AgeUpgrade(tech_id, age_id, full_data_set)
                 full_data_set.tech_groups.update({age_up.get_id(): age_up})
                 full_data_set.age_upgrades.update({age_up.get_id(): age_up})
@@ -3,21 +3,62 @@
 """
 Export data from a modpack to files.
 """
+import os
+
 from openage.convert.dataformat.media_types import MediaType
+from openage.convert.palette_registry import PALETTES
 from bin.openage.convert import game_versions
 
+from ..export.media_dedup import deduplicate, link_duplicates
+from ..timings import Span
+from ...util.threading import pipeline
+
+
+# the stages of the media export, and the number of threads that run
+# each stage per CPU core. the stages, except for the file access,
+# release the GIL for most of their work.
+MEDIA_EXPORT_STAGES = (
+    ("read", 0.5),
+    ("decode", 1),
+    ("pack", 1),
+    ("encode", 1),
+    ("write", 0.5),
+)
+
 
 class ModpackExporter:
 
     @staticmethod
-    def export(modpack, assetsrc, exportdir, game_version):
+    def export(modpack, assetsrc, exportdir, game_version, palettes=PALETTES,
+               compression="default", jobs=None, stage_jobs=None,
+               timings=None):
         """
         Export a modpack to a directory.
 
+        The media files are exported by a pipeline that runs the export stages
+        of all requests concurrently (see MEDIA_EXPORT_STAGES).
+        Requests with identical source files are only converted once.
+
+        Yields progress information like driver.convert(): the number of
+        media files, followed by the name of each exported file.
+
         :param modpack: Modpack that is going to be exported.
         :type modpack: ..dataformats.modpack.Modpack
         :param exportdir: Directory wheere modpacks are stored.
         :type exportdir: ...util.fslike.path.Path
+        :param palettes: Registry of the loaded palettes, which is
+                         shared by all media export requests.
+        :type palettes: ..palette_registry.PaletteRegistry
+        :param compression: Compression preset for the media files.
+        :type compression: str
+        :param jobs: Number of CPU cores to use; all by default.
+        :type jobs: int
+        :param stage_jobs: Number of threads for individual stages,
+                           by stage name.
+        :type stage_jobs: dict
+        :param timings: Records the duration of each stage
+                        for each request, if given.
+        :type timings: ..timings.Timings
         """
         modpack_dir = exportdir.joinpath("%s" % (modpack.info.name))
 
@@ -33,8 +74,95 @@ class ModpackExporter:
         # Media files
         media_files = modpack.get_media_files()
 
+        export_requests = []
         for media_type in media_files.keys():
-            cur_export_requests = media_files[media_type]
+            export_requests.extend(media_files[media_type])
+
+        yield len(export_requests)
+
+        if not export_requests:
+            return
+
+        if jobs is None:
+            jobs = os.cpu_count()
+
+        export_requests, duplicates = deduplicate(export_requests, assetsrc,
+                                                  jobs)
+
+        if stage_jobs is None:
+            stage_jobs = {}
+
+        def span(stage, request):
+            """ measures the stage for the request """
+            return Span(timings, "export " + stage, request.source_filename,
+                        os.path.splitext(request.source_filename)[1].lower())
+
+        def read(request):
+            """ read stage """
+            with span("read", request) as stage_span:
+                data = request.read(assetsrc)
+
+                if data is None:
+                    # TODO: Filter files that do not exist out sooner
+                    return None
+
+                stage_span.bytes_in = len(data)
+
+            return request, data
+
+        def decode(item):
+            """ decode stage """
+            request, data = item
+            with span("decode", request) as stage_span:
+                stage_span.bytes_in = len(data)
+                decoded = request.decode(data)
+
+            return request, decoded
+
+        def pack(item):
+            """ pack stage """
+            request, decoded = item
+            with span("pack", request):
+                packed = request.pack(decoded, assetsrc,
+                                      game_version, palettes)
+
+            return request, packed
+
+        def encode(item):
+            """ encode stage """
+            request, packed = item
+            with span("encode", request) as stage_span:
+                encoded = request.encode(packed, compression)
+                stage_span.bytes_out = len(encoded)
+
+            return request, encoded
+
+        def write(item):
+            """ write stage """
+            request, encoded = item
+            with span("write", request) as stage_span:
+                request.write(modpack_dir, encoded)
+                stage_span.bytes_out = len(encoded)
+
+            return request.target_filename
+
+        stage_functions = {
+            "read": read,
+            "decode": decode,
+            "pack": pack,
+            "encode": encode,
+            "write": write,
+        }
+
+        stages = []
+        for stage_name, threads_per_core in MEDIA_EXPORT_STAGES:
+            stage_threads = stage_jobs.get(
+                stage_name,
+                max(1, round(jobs * threads_per_core))
+            )
+            stages.append((stage_functions[stage_name], stage_threads))
+
+        yield from pipeline(export_requests, stages)
 
-            for request in cur_export_requests:
-                request.save(assetsrc, modpack_dir, game_version)
+        # the duplicates are linked to the converted originals
+        yield from link_duplicates(duplicates, modpack_dir)
@@ -1,16 +1,29 @@
-# Copyright 2015-2019 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
 Convert a single slp file from some drs archive to a png image.
+
+In batch mode, many files are converted in one run: the palettes and
+the drs archive are only loaded once, and the files are converted
+on a thread pool.
 """
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+import glob
+import json
+import os
 from pathlib import Path
+import shlex
+from time import perf_counter
 
 from .colortable import ColorTable
 from .drs import DRS
 from .texture import Texture
 from ..util.fslike.directory import Directory
-from ..log import info
+from ..util.profiler import add_profile_arguments, profiling
+from ..log import info, warn
 
 
 def init_subparser(cli):
@@ -38,221 +51,293 @@ def init_subparser(cli):
     cli.add_argument("--mode", choices=['drs-slp', 'slp', 'smp', 'smx'],
                      help=("choose between drs-slp, slp, smp or smx; "
                            "otherwise, this is determined by the file extension"))
-    cli.add_argument("filename", help=("filename or, if inside a drs archive "
-                                       "given by --drs, the filename within "
-                                       "the drs archive"))
-    cli.add_argument("output", help="image output path name")
+    cli.add_argument("--manifest", type=argparse.FileType('r'),
+                     help=("batch mode: file with one conversion per line, "
+                           "'filename [output]'; outputs are relative "
+                           "to --output-dir"))
+    cli.add_argument("--glob", action="append", metavar="PATTERN",
+                     help=("batch mode: convert all files matching the "
+                           "pattern, in the --drs archive if given; "
+                           "may be given several times"))
+    cli.add_argument("--output-dir", default=".",
+                     help="batch mode: directory for the images")
+    cli.add_argument("--jobs", "-j", type=int, default=None,
+                     help="batch mode: number of conversion threads")
+    cli.add_argument("--report", default=None, metavar="report.json",
+                     help="batch mode: write the per-file results as JSON")
+    cli.add_argument("filename", nargs="?",
+                     help=("filename or, if inside a drs archive "
+                           "given by --drs, the filename within "
+                           "the drs archive"))
+    cli.add_argument("output", nargs="?", help="image output path name")
+
+    add_profile_arguments(cli)
 
 
 def main(args, error):
     """ CLI entry point for single file conversions """
     del error  # unused
 
-    file_path = Path(args.filename)
-    file_extension = file_path.suffix[1:].lower()
+    with profiling(args.profile, args.profile_dir):
+        if args.manifest or args.glob:
+            return convert_batch(args)
 
-    if args.mode == "slp" or (file_extension == "slp" and not args.drs):
-        if not args.palette_file:
-            raise Exception("palette-file needs to be specified")
+        if not (args.filename and args.output):
+            raise Exception("filename and output need to be specified, "
+                            "or --manifest or --glob for batch mode")
 
-        read_slp_file(args.filename, args.palette_file, args.output,
-                      player_palette=args.player_palette_file)
+        convert_file(args)
 
-    elif args.mode == "drs-slp" or (file_extension == "slp" and args.drs):
-        if not (args.drs and args.palette_index):
-            raise Exception("palette-file needs to be specified")
+    return 0
 
-        read_slp_in_drs_file(args.drs, args.filename, args.palette_index,
-                             args.output, interfac=args.interfac)
 
-    elif args.mode == "smp" or file_extension == "smp":
-        if not (args.palette_file and args.player_palette_file):
-            raise Exception("palette-file needs to be specified")
+def convert_file(args):
+    """
+    Converts the file given in args.
 
-        read_smp_file(args.filename, args.palette_file, args.player_palette_file,
-                      args.output)
+    Uses the same palettes and conversion as the batch mode.
+    """
+    file_type = get_file_type(args.filename, args.mode)
+    in_drs = args.mode == "drs-slp" or (
+        args.mode is None and file_type == "slp" and args.drs)
 
-    elif args.mode == "smx" or file_extension == "smx":
-        if not (args.palette_file and args.player_palette_file):
-            raise Exception("palette-file needs to be specified")
+    if in_drs:
+        if not args.drs:
+            raise Exception("drs needs to be specified")
 
-        read_smx_file(args.filename, args.palette_file, args.player_palette_file,
-                      args.output)
+        info("opening slp in drs '%s:%s'...", args.drs.name, args.filename)
+        source = DRS(args.drs).root[args.filename]
 
     else:
-        raise Exception("format could not be determined")
+        info("opening %s file at '%s'", file_type, args.filename)
+        source = Path(args.filename)
 
+    main_palette, player_palette = load_palettes(args)
 
-def read_slp_file(slp_path, main_palette, output_path, player_palette=None):
-    """
-    Reads a single SLP file.
-    """
-    output_file = Path(output_path)
+    with source.open("rb") as infile:
+        data = infile.read()
 
-    # open the slp
-    info("opening slp file at '%s'", Path(slp_path).name)
-    slp_file = Path(slp_path).open("rb")
+    output_file = Path(args.output)
 
-    # open palette from independent file
-    info("opening palette in palette file '%s'", main_palette.name)
-    palette_file = Path(main_palette.name).open("rb")
+    info("packing texture...")
+    convert_image(data, file_type, main_palette, player_palette,
+                  Directory(output_file.parent).root, output_file.name)
 
-    info("parsing palette data...")
-    main_palette_table = ColorTable(palette_file.read())
 
-    # import here to prevent that the __main__ depends on SLP
-    # just by importing this singlefile.py.
-    from .slp import SLP
+# result of converting one file of a batch
+BatchResult = namedtuple("BatchResult", ("source", "output", "seconds",
+                                         "error"))
 
-    # parse the slp_path image
-    info("parsing slp image...")
-    slp_image = SLP(slp_file.read())
 
-    player_palette_table = None
+def get_file_type(filename, mode=None):
+    """
+    Returns the type ("slp", "smp" or "smx") of the file
+    given by the --mode or by its extension.
+    """
+    if mode == "drs-slp":
+        return "slp"
 
-    # Player palettes need to be specified if SLP version is greater
-    # than 3.0
-    if slp_image.version in (b'3.0\x00', b'4.0X', b'4.1X'):
-        if not player_palette:
-            raise Exception("SLPs version %s require a player "
-                            "color palette" % slp_image.version)
+    if mode is not None:
+        return mode
 
-        # open player color palette from independent file
-        info("opening player color palette in palette file '%s'", player_palette.name)
-        player_palette_file = Path(player_palette.name).open("rb")
+    return Path(filename).suffix[1:].lower()
 
-        info("parsing palette data...")
-        player_palette_table = ColorTable(player_palette_file.read())
 
-    # create texture
-    info("packing texture...")
-    tex = Texture(slp_image, main_palette_table, player_palette_table)
+def load_drs_palette(interfac_file, palette_index):
+    """
+    Loads the palette with the given index from the interfac.drs archive.
+    """
+    info("parsing palette in drs '%s:%s.bina'...",
+         interfac_file.name, palette_index)
 
-    # save as png
-    tex.save(Directory(output_file.parent).root, output_file.name)
+    with DRS(interfac_file).root["%s.bina" % palette_index].open("rb") as palette_file:
+        return ColorTable(palette_file.read())
 
 
-def read_slp_in_drs_file(drs, slp_path, palette_index, output_path, interfac=None):
+def load_palettes(args):
     """
-    Reads a SLP file from a DRS archive.
+    Loads the main and player palettes.
+
+    The main palette is read from --palette-file, or
+    by --palette-index from the interfac.drs of --drs.
     """
-    output_file = Path(output_path)
+    main_palette = None
+    player_palette = None
 
-    # open from drs archive
-    drs_file = DRS(drs)
+    if args.palette_file:
+        info("parsing palette file '%s'", args.palette_file.name)
+        main_palette = ColorTable(args.palette_file.read())
 
-    info("opening slp in drs '%s:%s'...", drs.name, slp_path)
-    slp_file = drs_file.root[slp_path].open("rb")
+    elif args.drs:
+        if args.interfac:
+            main_palette = load_drs_palette(args.interfac, args.palette_index)
+        else:
+            # otherwise use the interfac.drs next to the drs.
+            interfac_path = Path(args.drs.name).with_name("interfac.drs")
+            with interfac_path.open("rb") as interfac_file:
+                main_palette = load_drs_palette(interfac_file,
+                                                args.palette_index)
 
-    if interfac:
-        # open the interface file if given
-        interfac_file = interfac
+    if args.player_palette_file:
+        info("parsing player color palette file '%s'",
+             args.player_palette_file.name)
+        player_palette = ColorTable(args.player_palette_file.read())
 
-    else:
-        # otherwise use the path of the drs.
-        interfac_file = Path(drs.name).with_name(
-            "interfac.drs").open("rb")  # pylint: disable=no-member
+    return main_palette, player_palette
 
-    # open palette
-    info("opening palette in drs '%s:%s.bina'...",
-         interfac_file.name, palette_index)
-    palette_file = DRS(
-        interfac_file).root["%s.bina" % palette_index].open("rb")
 
-    info("parsing palette data...")
-    palette = ColorTable(palette_file.read())
+def get_batch_entries(args, archive=None):
+    """
+    Yields (source, output filename) for all files of the batch.
+
+    The sources are paths in the archive, if given,
+    or else in the file system.
+    """
+    def get_source(filename):
+        """ returns the path of the source file """
+        if archive is not None:
+            return archive[filename]
 
-    # import here to prevent that the __main__ depends on SLP
-    # just by importing this singlefile.py.
-    from .slp import SLP
+        return Path(filename)
 
-    # parse the slp image
-    info("parsing slp image...")
-    slp_image = SLP(slp_file.read())
+    if args.manifest:
+        for line in args.manifest:
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
 
-    # create texture
-    info("packing texture...")
-    tex = Texture(slp_image, palette)
+            if len(fields) > 2:
+                raise Exception("invalid manifest line: %s" % line.strip())
+
+            source = get_source(fields[0])
+
+            if len(fields) == 2:
+                yield source, fields[1]
+            else:
+                yield source, Path(fields[0]).stem + ".png"
+
+    for pattern in args.glob or ():
+        if archive is not None:
+            filenames = sorted(path.name for path in archive.iterdir()
+                               if fnmatch(path.name, pattern))
+        else:
+            filenames = sorted(glob.glob(pattern, recursive=True))
 
-    # save as png
-    tex.save(Directory(output_file.parent).root, output_file.name)
+        if not filenames:
+            warn("no files match '%s'", pattern)
 
+        for filename in filenames:
+            yield get_source(filename), Path(filename).stem + ".png"
 
-def read_smp_file(smp_path, main_palette, player_palette, output_path):
+
+def convert_image(data, file_type, main_palette, player_palette,
+                  targetdir, output):
     """
-    Reads a single SMP file.
+    Converts the data of an slp, smp or smx file to a png image.
     """
-    output_file = Path(output_path)
+    if main_palette is None:
+        raise Exception("palette-file needs to be specified")
 
-    # open the smp
-    info("opening smp file at '%s'", smp_path)
-    smp_file = Path(smp_path).open("rb")
+    # import here to prevent that the __main__ depends on
+    # the image formats just by importing this singlefile.py.
+    if file_type == "slp":
+        from .slp import SLP
+        image = SLP(data)
 
-    # open main palette from independent file
-    info("opening main palette in palette file '%s'", main_palette.name)
-    main_palette_file = Path(main_palette.name).open("rb")
+        # player palettes are required since SLP version 3.0
+        needs_player = image.version in (b'3.0\x00', b'4.0X', b'4.1X')
 
-    info("parsing palette data...")
-    main_palette_table = ColorTable(main_palette_file.read())
+        if needs_player and player_palette is None:
+            raise Exception("SLPs version %s require a player "
+                            "color palette" % image.version)
 
-    # open player color palette from independent file
-    info("opening player color palette in palette file '%s'", player_palette.name)
-    player_palette_file = Path(player_palette.name).open("rb")
+    elif file_type in ("smp", "smx"):
+        if player_palette is None:
+            raise Exception("%s files require a player "
+                            "color palette" % file_type)
 
-    info("parsing palette data...")
-    player_palette_table = ColorTable(player_palette_file.read())
+        if file_type == "smp":
+            from .smp import SMP
+            image = SMP(data)
 
-    # import here to prevent that the __main__ depends on SMP
-    # just by importing this singlefile.py.
-    from .smp import SMP
+        else:
+            from .smx import SMX
+            image = SMX(data)
 
-    # parse the smp_path image
-    info("parsing smp image...")
-    smp_image = SMP(smp_file.read())
+    else:
+        raise Exception("format could not be determined")
 
-    # create texture
-    info("packing texture...")
-    tex = Texture(smp_image, main_palette_table, player_palette_table)
+    tex = Texture(image, main_palette, player_palette)
 
-    # save as png
-    tex.save(Directory(output_file.parent).root, output_file.name)
+    targetdir[output].parent.mkdirs()
+    tex.save(targetdir, output)
 
 
-def read_smx_file(smx_path, main_palette, player_palette, output_path):
+def convert_batch(args):
     """
-    Reads a single SMX (compressed SMP) file.
+    Converts all files given by --manifest and --glob.
+
+    Returns 0 if all files were converted, 1 otherwise.
     """
-    output_file = Path(output_path)
+    main_palette, player_palette = load_palettes(args)
 
-    # open the smx
-    info("opening smx file at '%s'", smx_path)
-    smx_file = Path(smx_path).open("rb")
+    archive = None
+    if args.drs:
+        info("reading drs archive '%s'...", args.drs.name)
+        archive = DRS(args.drs).root
 
-    # open main palette from independent file
-    info("opening main palette in palette file '%s'", main_palette.name)
-    main_palette_file = Path(main_palette.name).open("rb")
+    entries = list(get_batch_entries(args, archive))
 
-    info("parsing palette data...")
-    main_palette_table = ColorTable(main_palette_file.read())
+    outputs = set()
+    for _, output in entries:
+        if output in outputs:
+            raise Exception("several files would be converted to %s" % output)
+        outputs.add(output)
 
-    # open player color palette from independent file
-    info("opening player color palette in palette file '%s'", player_palette.name)
-    player_palette_file = Path(player_palette.name).open("rb")
+    targetdir = Directory(args.output_dir, create_if_missing=True).root
 
-    info("parsing palette data...")
-    player_palette_table = ColorTable(player_palette_file.read())
+    def convert_entry(entry):
+        """ converts one file and measures it """
+        source, output = entry
+        start = perf_counter()
 
-    # import here to prevent that the __main__ depends on SMP
-    # just by importing this singlefile.py.
-    from .smx import SMX
+        try:
+            with source.open("rb") as infile:
+                data = infile.read()
 
-    # parse the smx_path image
-    info("parsing smx image...")
-    smx_image = SMX(smx_file.read())
+            convert_image(data, get_file_type(source.name, args.mode),
+                          main_palette, player_palette, targetdir, output)
+            error = None
 
-    # create texture
-    info("packing texture...")
-    tex = Texture(smx_image, main_palette_table, player_palette_table)
+        except Exception as exc:  # pylint: disable=broad-except
+            error = "%s: %s" % (type(exc).__name__, exc)
+
+        if archive is not None:
+            source = source.name
+
+        return BatchResult(str(source), output, perf_counter() - start,
+                           error)
+
+    info("converting %d files...", len(entries))
+
+    results = []
+    jobs = args.jobs or os.cpu_count()
+    with ThreadPoolExecutor(jobs) as pool:
+        for result in pool.map(convert_entry, entries):
+            if result.error is None:
+                info("%s -> %s (%.3f s)", result.source, result.output,
+                     result.seconds)
+            else:
+                warn("%s failed: %s", result.source, result.error)
+
+            results.append(result)
+
+    failed = sum(1 for result in results if result.error is not None)
+    info("converted %d of %d files", len(results) - failed, len(results))
+
+    if args.report:
+        with open(args.report, "w") as outfile:
+            json.dump([result._asdict() for result in results], outfile,
+                      indent=4)
 
-    # save as png
-    tex.save(Directory(output_file.parent).root, output_file.name)
+    return 1 if failed else 0
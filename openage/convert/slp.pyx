@@ -1,7 +1,8 @@
-# Copyright 2013-2019 the openage authors. See copying.md for legal info.
+# Copyright 2013-2020 the openage authors. See copying.md for legal info.
 #
 # cython: profile=False
 
+from functools import lru_cache
 from struct import Struct, unpack_from
 
 from enum import Enum
@@ -46,6 +47,9 @@ cdef enum pixel_type:
     color_special_1     # player color outline pixel
     color_special_2     # black outline pixel
 
+# number of entries in pixel_type
+PIXEL_TYPE_COUNT = color_special_2 + 1
+
 
 # SLPs with version 4.0+ have special
 # rules for shadows
@@ -59,6 +63,52 @@ cdef struct pixel:
     uint8_t value
 
 
+# The row decoders run without the GIL.
+# These helpers re-acquire it to report errors and log messages.
+
+cdef int row_overflow_error(size_t expected_size, Py_ssize_t rowid,
+                            size_t got) except -1 with gil:
+    raise Exception(
+        "Only %d pixels should be drawn in row %d, "
+        "but we have %d already!" % (expected_size, rowid, got)
+    )
+
+
+cdef int row_size_error(size_t got, size_t pixel_count, Py_ssize_t rowid,
+                        Py_ssize_t first_cmd_offset) except -1 with gil:
+    summary = "%d/%d -> row %d, offset %d / %#x" % (
+        got, pixel_count, rowid, first_cmd_offset, first_cmd_offset)
+    txt = "got %%s pixels than expected: %s, missing: %d" % (
+        summary, abs(<Py_ssize_t>pixel_count - <Py_ssize_t>got))
+
+    raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+
+
+cdef int unknown_cmd_error(uint8_t cmd, Py_ssize_t rowid,
+                           bool shadow) except -1 with gil:
+    raise Exception(
+        "unknown slp %sdrawing command: " % ("shadow " if shadow else "") +
+        "%#x in row %d" % (cmd, rowid))
+
+
+cdef int unsupported_cmd_error(uint8_t higher_nibble) except -1 with gil:
+    if higher_nibble == 0x80:
+        raise NotImplementedError("dither not implemented")
+
+    raise NotImplementedError("extended alpha not implemented")
+
+
+cdef void render_hint(uint8_t higher_nibble) with gil:
+    if higher_nibble == 0x00:
+        spam("render hint: xfliptest")
+    elif higher_nibble == 0x10:
+        spam("render hint: !xfliptest")
+    elif higher_nibble == 0x20:
+        spam("image wants normal color table now")
+    elif higher_nibble == 0x30:
+        spam("image wants alternate color table now")
+
+
 class SLP:
     """
     Class for reading/converting the greatest image format ever: SLP.
@@ -234,20 +284,29 @@ cdef class SLPFrame:
     # stores the file offset for the first drawing command
     cdef vector[int] cmd_offsets
 
-    # palette index matrix representing the final image
-    cdef vector[vector[pixel]] pcolor
+    # pixel type and palette index planes representing the final image
+    cdef numpy.ndarray pixel_types
+    cdef numpy.ndarray pixel_values
 
     # memory pointer
     cdef const uint8_t *data_raw
 
+    # number of pixels in a row
+    cdef size_t width
+
     def __init__(self, frame_info, data):
         self.info = frame_info
 
-        if not (isinstance(data, bytes) or isinstance(data, bytearray)):
-            raise ValueError("Frame data must be some bytes object")
+        # any contiguous buffer can be used, e.g. bytes or a
+        # memoryview slice of a memory-mapped archive.
+        cdef const uint8_t[::1] data_view
+        try:
+            data_view = data
+        except (TypeError, ValueError):
+            raise ValueError("Frame data must be a contiguous bytes-like object")
 
-        # convert the bytes obj to char*
-        self.data_raw = data
+        # pointer to the data, which stays alive during the decoding
+        self.data_raw = &data_view[0]
 
         cdef size_t i
         cdef int cmd_offset
@@ -278,30 +337,52 @@ cdef class SLPFrame:
             )[0]
             self.cmd_offsets.push_back(cmd_offset)
 
-        for i in range(row_count):
-            self.pcolor.push_back(self.create_palette_color_row(i))
+        self.width = self.info.size[0]
+
+        self.pixel_types = numpy.zeros((row_count, self.width),
+                                       dtype=numpy.uint8)
+        self.pixel_values = numpy.zeros((row_count, self.width),
+                                        dtype=numpy.uint8)
+
+        cdef uint8_t[:, ::1] type_plane = self.pixel_types
+        cdef uint8_t[:, ::1] value_plane = self.pixel_values
 
-    cdef vector[pixel] create_palette_color_row(self, Py_ssize_t rowid) except +:
+        # decoding buffer for one row, reused for all rows
+        cdef vector[pixel] row_data
+        cdef size_t x
+
+        # the rows only depend on the raw data buffer,
+        # so they can be decoded without holding the GIL.
+        with nogil:
+            for i in range(row_count):
+                row_data.clear()
+                self.create_palette_color_row(row_data, i)
+
+                for x in range(self.width):
+                    type_plane[i, x] = row_data[x].type
+                    value_plane[i, x] = row_data[x].value
+
+    cdef int create_palette_color_row(self, vector[pixel] &row_data,
+                                      Py_ssize_t rowid) nogil except -1:
         """
         create palette indices (colors) for the given rowid.
         """
 
-        cdef vector[pixel] row_data
-        cdef Py_ssize_t i
+        cdef size_t i
 
-        first_cmd_offset = self.cmd_offsets[rowid]
+        cdef Py_ssize_t first_cmd_offset = self.cmd_offsets[rowid]
         cdef boundary_def bounds = self.boundaries[rowid]
-        cdef size_t pixel_count = self.info.size[0]
+        cdef size_t pixel_count = self.width
 
         # preallocate memory
         row_data.reserve(pixel_count)
 
         # row is completely transparent
         if bounds.full_row:
-            for _ in range(pixel_count):
+            for i in range(pixel_count):
                 row_data.push_back(pixel(color_transparent, 0))
 
-            return row_data
+            return 0
 
         # start drawing the left transparent space
         for i in range(bounds.left):
@@ -318,30 +399,25 @@ cdef class SLPFrame:
 
         # verify size of generated row
         if row_data.size() != pixel_count:
-            got = row_data.size()
-            summary = "%d/%d -> row %d, offset %d / %#x" % (
-                got, pixel_count, rowid, first_cmd_offset, first_cmd_offset)
-            txt = "got %%s pixels than expected: %s, missing: %d" % (
-                summary, abs(pixel_count - got))
-
-            raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+            row_size_error(row_data.size(), pixel_count,
+                           rowid, first_cmd_offset)
 
-        return row_data
+        return 0
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
-        pass
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
+        return 0
 
-    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset):
+    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset) nogil:
         """
         Fetch a byte from the slp.
         """
         return self.data_raw[offset]
 
     cdef inline cmd_pack cmd_or_next(self, uint8_t cmd,
-                                     uint8_t n, Py_ssize_t pos):
+                                     uint8_t n, Py_ssize_t pos) nogil:
         """
         to save memory, the draw amount may be encoded into
         the drawing command itself in the upper n bits.
@@ -361,8 +437,9 @@ cdef class SLPFrame:
         """
         Convert the palette index matrix to a colored image.
         """
-        return determine_rgba_matrix(self.pcolor, main_palette,
-                                     player_palette, player_number)
+        return determine_rgba_matrix(self.pixel_types, self.pixel_values,
+                                     main_palette, player_palette,
+                                     player_number)
 
     def get_hotspot(self):
         """
@@ -382,10 +459,10 @@ cdef class SLPMainFrameAoC(SLPFrame):
     def __init__(self, frame_info, data):
         super().__init__(frame_info, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         create palette indices (colors) for the drawing commands
         found for this row in the SLP frame.
@@ -403,16 +480,13 @@ cdef class SLPMainFrameAoC(SLPFrame):
         cdef uint8_t lowest_crumb
         cdef cmd_pack cpack
         cdef int pixel_count
+        cdef uint8_t color
+        cdef int i
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d, "
-                    "but we have %d already!" % (
-                        expected_size, rowid, row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -433,7 +507,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 # draw the following bytes as palette colors
 
                 pixel_count = cmd >> 2
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
 
@@ -446,7 +520,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
 
                 cpack = self.cmd_or_next(cmd, 2, dpos)
                 dpos = cpack.dpos
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x02:
@@ -457,7 +531,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
                     row_data.push_back(pixel(color_standard, color))
@@ -471,7 +545,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x06:
@@ -481,7 +555,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
 
                 cpack = self.cmd_or_next(cmd, 4, dpos)
                 dpos = cpack.dpos
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
 
@@ -497,7 +571,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 dpos += 1
                 color = self.get_byte_at(dpos)
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_standard, color))
 
             elif lower_nibble == 0x0A:
@@ -510,7 +584,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 dpos += 1
                 color = self.get_byte_at(dpos)
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_player, color))
 
             elif lower_nibble == 0x0B:
@@ -520,7 +594,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                 cpack = self.cmd_or_next(cmd, 4, dpos)
                 dpos = cpack.dpos
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_shadow, 0))
 
             elif lower_nibble == 0x0E:
@@ -530,25 +604,25 @@ cdef class SLPMainFrameAoC(SLPFrame):
                     # render hint xflip command
                     # render hint: only draw the following command,
                     # if this sprite is not flipped left to right
-                    spam("render hint: xfliptest")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x10:
                     # render h notxflip command
                     # render hint: only draw the following command,
                     # if this sprite IS flipped left to right.
-                    spam("render hint: !xfliptest")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x20:
                     # table use normal command
                     # set the transform color table to normal,
                     # for the standard drawing commands
-                    spam("image wants normal color table now")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x30:
                     # table use alternat command
                     # set the transform color table to alternate,
                     # this affects all following standard commands
-                    spam("image wants alternate color table now")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x40:
                     # outline_1 command
@@ -568,7 +642,7 @@ cdef class SLPMainFrameAoC(SLPFrame):
                     dpos += 1
                     pixel_count = self.get_byte_at(dpos)
 
-                    for _ in range(pixel_count):
+                    for i in range(pixel_count):
                         row_data.push_back(pixel(color_special_1, 0))
 
                 elif higher_nibble == 0x70:
@@ -578,27 +652,25 @@ cdef class SLPMainFrameAoC(SLPFrame):
                     dpos += 1
                     pixel_count = self.get_byte_at(dpos)
 
-                    for _ in range(pixel_count):
+                    for i in range(pixel_count):
                         row_data.push_back(pixel(color_special_2, 0))
 
                 elif higher_nibble == 0x80:
                     # dither command
-                    raise NotImplementedError("dither not implemented")
+                    unsupported_cmd_error(higher_nibble)
 
-                elif higher_nibble in (0x90, 0xA0):
+                elif higher_nibble == 0x90 or higher_nibble == 0xA0:
                     # 0x90: premultiplied alpha
                     # 0xA0: original alpha
-                    raise NotImplementedError("extended alpha not implemented")
+                    unsupported_cmd_error(higher_nibble)
 
             else:
-                raise Exception(
-                    "unknown slp drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(cmd, rowid, False)
 
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
 
 cdef class SLPMainFrameDE(SLPFrame):
@@ -609,10 +681,10 @@ cdef class SLPMainFrameDE(SLPFrame):
     def __init__(self, frame_info, data):
         super().__init__(frame_info, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         create palette indices (colors) for the drawing commands
         found for this row in the SLP frame.
@@ -630,16 +702,13 @@ cdef class SLPMainFrameDE(SLPFrame):
         cdef uint8_t lowest_crumb
         cdef cmd_pack cpack
         cdef int pixel_count
+        cdef uint8_t color
+        cdef int i
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d, "
-                    "but we have %d already!" % (
-                        expected_size, rowid, row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -660,7 +729,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 # draw the following bytes as palette colors
 
                 pixel_count = cmd >> 2
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
 
@@ -673,7 +742,7 @@ cdef class SLPMainFrameDE(SLPFrame):
 
                 cpack = self.cmd_or_next(cmd, 2, dpos)
                 dpos = cpack.dpos
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x02:
@@ -684,7 +753,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
                     row_data.push_back(pixel(color_standard, color))
@@ -698,7 +767,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x06:
@@ -708,7 +777,7 @@ cdef class SLPMainFrameDE(SLPFrame):
 
                 cpack = self.cmd_or_next(cmd, 4, dpos)
                 dpos = cpack.dpos
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
 
@@ -725,7 +794,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 dpos += 1
                 color = self.get_byte_at(dpos)
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_standard, color))
 
             elif lower_nibble == 0x0A:
@@ -738,7 +807,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 dpos += 1
                 color = self.get_byte_at(dpos)
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     # version 3.0 uses extra palettes for player colors
                     row_data.push_back(pixel(color_player_v4, color))
 
@@ -749,7 +818,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                 cpack = self.cmd_or_next(cmd, 4, dpos)
                 dpos = cpack.dpos
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_shadow, 0))
 
             elif lower_nibble == 0x0E:
@@ -759,25 +828,25 @@ cdef class SLPMainFrameDE(SLPFrame):
                     # render hint xflip command
                     # render hint: only draw the following command,
                     # if this sprite is not flipped left to right
-                    spam("render hint: xfliptest")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x10:
                     # render h notxflip command
                     # render hint: only draw the following command,
                     # if this sprite IS flipped left to right.
-                    spam("render hint: !xfliptest")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x20:
                     # table use normal command
                     # set the transform color table to normal,
                     # for the standard drawing commands
-                    spam("image wants normal color table now")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x30:
                     # table use alternat command
                     # set the transform color table to alternate,
                     # this affects all following standard commands
-                    spam("image wants alternate color table now")
+                    render_hint(higher_nibble)
 
                 elif higher_nibble == 0x40:
                     # outline_1 command
@@ -797,7 +866,7 @@ cdef class SLPMainFrameDE(SLPFrame):
                     dpos += 1
                     pixel_count = self.get_byte_at(dpos)
 
-                    for _ in range(pixel_count):
+                    for i in range(pixel_count):
                         row_data.push_back(pixel(color_special_1, 0))
 
                 elif higher_nibble == 0x70:
@@ -807,27 +876,25 @@ cdef class SLPMainFrameDE(SLPFrame):
                     dpos += 1
                     pixel_count = self.get_byte_at(dpos)
 
-                    for _ in range(pixel_count):
+                    for i in range(pixel_count):
                         row_data.push_back(pixel(color_special_2, 0))
 
                 elif higher_nibble == 0x80:
                     # dither command
-                    raise NotImplementedError("dither not implemented")
+                    unsupported_cmd_error(higher_nibble)
 
-                elif higher_nibble in (0x90, 0xA0):
+                elif higher_nibble == 0x90 or higher_nibble == 0xA0:
                     # 0x90: premultiplied alpha
                     # 0xA0: original alpha
-                    raise NotImplementedError("extended alpha not implemented")
+                    unsupported_cmd_error(higher_nibble)
 
             else:
-                raise Exception(
-                    "unknown slp drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(cmd, rowid, False)
 
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
 cdef class SLPShadowFrame(SLPFrame):
     """
@@ -837,10 +904,10 @@ cdef class SLPShadowFrame(SLPFrame):
     def __init__(self, frame_info, data):
         super().__init__(frame_info, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         create palette indices (colors) for the drawing commands
         found for this row in the SLP frame.
@@ -859,16 +926,13 @@ cdef class SLPShadowFrame(SLPFrame):
         cdef uint8_t lowest_crumb
         cdef cmd_pack cpack
         cdef int pixel_count
+        cdef uint8_t color
+        cdef int i
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d, "
-                    "but we have %d already!" % (
-                        expected_size, rowid, row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -889,7 +953,7 @@ cdef class SLPShadowFrame(SLPFrame):
                 # draw the following bytes as palette colors
 
                 pixel_count = cmd >> 2
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
 
@@ -903,7 +967,7 @@ cdef class SLPShadowFrame(SLPFrame):
 
                 cpack = self.cmd_or_next(cmd, 2, dpos)
                 dpos = cpack.dpos
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x02:
@@ -914,7 +978,7 @@ cdef class SLPShadowFrame(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     color = self.get_byte_at(dpos)
                     row_data.push_back(pixel(color_shadow_v4, color))
@@ -928,7 +992,7 @@ cdef class SLPShadowFrame(SLPFrame):
                 nextbyte = self.get_byte_at(dpos)
                 pixel_count = (higher_nibble << 4) + nextbyte
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0))
 
             elif lower_nibble == 0x07:
@@ -941,117 +1005,105 @@ cdef class SLPShadowFrame(SLPFrame):
                 dpos += 1
                 color = self.get_byte_at(dpos)
 
-                for _ in range(cpack.count):
+                for i in range(cpack.count):
                     # shadows in v4.0 draw a different color
                     row_data.push_back(pixel(color_shadow_v4, color))
 
             else:
-                raise Exception(
-                    "unknown slp shadow drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(cmd, rowid, True)
 
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef numpy.ndarray determine_rgba_matrix(vector[vector[pixel]] &image_matrix,
-                                         main_palette, player_palette,
-                                         int player_number=0):
+@lru_cache(maxsize=16)
+def rgba_lookup_table(main_palette, player_palette, int player_number):
     """
-    converts a palette index image matrix to an rgba matrix.
-    """
-
-    cdef size_t height = image_matrix.size()
-    cdef size_t width = image_matrix[0].size()
+    Creates a table that maps (pixel type, palette index) to rgba values,
+    along with a mask of the (type, index) pairs that can be resolved.
 
-    cdef numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] array_data = \
-        numpy.zeros((height, width, 4), dtype=numpy.uint8)
-
-    # micro optimization to avoid call to ColorTable.__getitem__()
-    cdef list m_lookup = main_palette.palette
-    cdef list p_lookup
-
-    # player palette for SLPs with version higher than 3.0
-    if player_palette:
-        p_lookup = player_palette.palette
-
-    cdef uint8_t r
-    cdef uint8_t g
-    cdef uint8_t b
-    cdef uint8_t a
+    The tables only depend on the palettes and the player number,
+    so they are cached.
+    """
+    m_lookup = main_palette.get_rgba_array()
+    m_size = len(m_lookup)
 
-    cdef vector[pixel] current_row
-    cdef pixel px
-    cdef pixel_type px_type
-    cdef int px_val
+    lut = numpy.zeros((PIXEL_TYPE_COUNT, 256, 4), dtype=numpy.uint8)
+    valid = numpy.zeros((PIXEL_TYPE_COUNT, 256), dtype=bool)
 
-    cdef size_t x
-    cdef size_t y
+    values = numpy.arange(256)
 
-    for y in range(height):
+    # simply look up the color index in the table
+    count = min(m_size, 256)
+    lut[color_standard, :count, :3] = m_lookup[:count, :3]
+    lut[color_standard, :, 3] = 255
+    valid[color_standard, :count] = True
 
-        current_row = image_matrix[y]
+    valid[color_transparent] = True
 
-        for x in range(width):
-            px = current_row[x]
-            px_type = px.type
-            px_val = px.value
+    lut[color_shadow, :, 3] = 100
+    valid[color_shadow] = True
 
-            if px_type == color_standard:
-                # simply look up the color index in the table
-                r, g, b = m_lookup[px_val]
-                alpha = 255
+    lut[color_shadow_v4, :, 3] = (255 - (values << 2)) & 0xFF
+    valid[color_shadow_v4] = True
 
-            elif px_type == color_transparent:
-                r, g, b, alpha = 0, 0, 0, 0
+    # player palette for SLPs with version higher than 3.0
+    if player_palette is not None:
+        p_lookup = player_palette.get_rgba_array()
+        count = min(len(p_lookup), 256)
+        lut[color_player_v4, :count, :3] = p_lookup[:count, :3]
+        valid[color_player_v4, :count] = True
+
+    # TODO: Make this 255 with new renderer
+    # mark this pixel as player color
+    lut[color_player_v4, :, 3] = 254
+
+    # get rgb base color from the color table
+    # store it the preview player color
+    # in the table: [16*player, 16*player+7]
+    player_indices = values + (16 * player_number)
+    in_range = player_indices < m_size
+
+    for px_type, alpha in ((color_player, 254),
+                           (color_special_1, 253)):
+        lut[px_type, in_range, :3] = m_lookup[player_indices[in_range], :3]
+        lut[px_type, :, 3] = alpha
+        valid[px_type] = in_range
+
+    # black outline pixel, we will probably never encounter this.
+    # palette[16 * player - 16] will be used.
+    # TODO: Make this 251 with new renderer
+    black_index = 16 * player_number - 16
+    if -m_size <= black_index < m_size:
+        for px_type in (color_special_2, color_black):
+            lut[px_type, :, :3] = m_lookup[black_index, :3]
+            lut[px_type, :, 3] = 253
+            valid[px_type] = True
+
+    return lut, valid
+
+
+def determine_rgba_matrix(pixel_types, pixel_values,
+                          main_palette, player_palette,
+                          int player_number=0):
+    """
+    converts the pixel type and palette index planes to an rgba matrix.
+    """
+    lut, valid = rgba_lookup_table(main_palette, player_palette,
+                                   player_number)
 
-            elif px_type == color_shadow:
-                r, g, b, alpha = 0, 0, 0, 100
+    resolvable = valid[pixel_types, pixel_values]
+    if not resolvable.all():
+        px_type = pixel_types[~resolvable][0]
+        px_value = pixel_values[~resolvable][0]
 
-            elif px_type == color_shadow_v4:
-                r, g, b = 0, 0, 0
-                alpha = 255 - (px_val << 2)
+        if px_type == color_player_v4 and player_palette is None:
+            raise ValueError("SLP uses player colors, "
+                             "but no player palette was given")
 
-            elif px_type == color_player_v4:
-                r, g, b = p_lookup[px_val]
-                # TODO: Make this 255 with new renderer
-                # mark this pixel as player color
-                alpha = 254
+        raise IndexError("palette index %d of pixel type %d out of range"
+                         % (px_value, px_type))
 
-            else:
-                if px_type == color_player:
-                    # TODO: Make this 255 with new renderer
-                    # mark this pixel as player color
-                    alpha = 254
-
-                elif px_type == color_special_2 or\
-                     px_type == color_black:
-                    # TODO: Make this 251 with new renderer
-                    alpha = 253  # mark this pixel as special outline
-
-                    # black outline pixel, we will probably never encounter this.
-                    #  -16 ensures palette[16+(-16)=0] will be used.
-                    px_val = -16
-
-                elif px_type == color_special_1:
-                    alpha = 253  # mark this pixel as outline
-
-                else:
-                    raise ValueError("unknown pixel type: %d" % px_type)
-
-                # get rgb base color from the color table
-                # store it the preview player color
-                # in the table: [16*player, 16*player+7]
-                r, g, b = m_lookup[px_val + (16 * player_number)]
-
-            # array_data[y, x] = (r, g, b, alpha)
-            array_data[y, x, 0] = r
-            array_data[y, x, 1] = g
-            array_data[y, x, 2] = b
-            array_data[y, x, 3] = alpha
-
-    return array_data
+    return lut[pixel_types, pixel_values]
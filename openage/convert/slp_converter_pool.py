@@ -1,14 +1,12 @@
-# Copyright 2015-2019 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
-Multiprocessing-based SLP-to-texture converter service.
-"""
+SLP-to-texture converter service.
 
-# TODO This is a temporary workaround for the fact that the SLP conversion
-#      requires the GIL, and is really slow right now.
-#      Ideally, time-intemsive parts of SLP.py should be re-written as
-#      optimized nogil Cython functions, entirely removing the need for
-#      multiprocessing.
+The SLP row decoding and palette lookup release the GIL,
+so the conversion can run on the threads of the caller.
+Worker processes are still available as an opt-in.
+"""
 
 import multiprocessing
 import os
@@ -17,23 +15,36 @@ import queue
 from threading import Lock
 
 from ..log import warn, err, get_loglevel
+from ..util.profiler import profile_process
 from ..util.system import free_memory
 
 from .slp import SLP
 from .texture import Texture
+from .timings import Span
 
 
 class SLPConverterPool:
     """
-    Multiprocessing-based pool of SLP converter processes.
+    Pool of SLP converters.
+
+    By default, the conversion is done directly in the thread that
+    calls convert(), as the expensive parts don't hold the GIL.
+    If processes is True, a pool of converter processes is spawned instead.
+
+    The conversions are recorded in timings, if given.
+    With profile, a tuple of (profiling mode, profile directory),
+    each converter process saves its profile to the directory
+    (see util.profiler.merge_profiles).
     """
-    def __init__(self, palette, jobs=None):
+    def __init__(self, palette, jobs=None, processes=False, timings=None,
+                 profile=None):
         if jobs is None:
             jobs = os.cpu_count()
 
         self.palette = palette
+        self.timings = timings
 
-        self.fake = (jobs == 1)
+        self.fake = (jobs == 1) or not processes
         if self.fake:
             # don't actually create the entire multiprocessing thing.
             # self.convert() will just do the conversion directly.
@@ -69,6 +80,7 @@ class SLPConverterPool:
             # send initial configuration to process
             inqueue.put(get_loglevel())
             inqueue.put(palette)
+            inqueue.put(profile)
 
             self.idle.put((inqueue, outqueue))
 
@@ -87,10 +99,15 @@ class SLPConverterPool:
         """
         Submits slpdata to one of the converter processes, and returns
         a Texture object (or throws an Exception).
+
+        Without converter processes, the conversion is done in the
+        calling thread.
         """
         if self.fake:
-            # convert right here, without entering the thread.
-            return Texture(SLP(slpdata), self.palette, custom_cutter=custom_cutter)
+            # convert right here, the decoding releases the GIL.
+            texture, _ = convert_slp(slpdata, self.palette, custom_cutter,
+                                     self.timings)
+            return texture
 
         if free_memory() < 2**30:
             # TODO print the warn only once
@@ -99,11 +116,17 @@ class SLPConverterPool:
             # acquire job_mutex in order to block any concurrent activity until
             # this job is done.
             with self.job_mutex:  # pylint: disable=not-context-manager
-                return Texture(SLP(slpdata), self.palette, custom_cutter=custom_cutter)
+                texture, _ = convert_slp(slpdata, self.palette,
+                                         custom_cutter, self.timings)
+                return texture
 
         # get the data queue for an idle worker process
         inqueue, outqueue = self.idle.get()
 
+        # buffers like memoryviews can't be sent to the worker process
+        if not isinstance(slpdata, bytes):
+            slpdata = bytes(slpdata)
+
         # restrict new job submission by free memory (see above)
         with self.job_mutex:  # pylint: disable=not-context-manager
             inqueue.put((slpdata, custom_cutter))
@@ -117,7 +140,12 @@ class SLPConverterPool:
             err("exception in worker process: %s", result)
             raise result
 
-        return result
+        # the worker measured the conversion
+        texture, record = result
+        if self.timings is not None:
+            self.timings.add(record)
+
+        return texture
 
     def __enter__(self):
         return self
@@ -127,6 +155,22 @@ class SLPConverterPool:
         self.close()
 
 
+def convert_slp(slpdata, palette, custom_cutter=None, timings=None):
+    """
+    Converts the SLP in slpdata to a Texture.
+
+    Returns the Texture and the Record of the conversion,
+    which is also added to timings, if given.
+    """
+    with Span(timings, "slp convert", file_type=".slp") as span:
+        span.bytes_in = len(slpdata)
+
+        texture = Texture(SLP(slpdata), palette, custom_cutter=custom_cutter)
+        span.items = len(texture.image_metadata)
+
+    return texture, span.record
+
+
 def converter_process(inqueue, outqueue):
     """
     This is the function that runs inside each individual process.
@@ -141,23 +185,25 @@ def converter_process(inqueue, outqueue):
     # receive initial configuration
     loglevel = inqueue.get()
     palette = inqueue.get()
+    profile = inqueue.get()
 
     # set the loglevel
     set_loglevel(loglevel)
 
-    # loop
-    while True:
-        work_item = inqueue.get()
-        if work_item == StopIteration:
-            return
+    mode, profile_dir = profile or (None, None)
+    with profile_process(mode, profile_dir, "worker-%d" % os.getpid()):
+        # loop
+        while True:
+            work_item = inqueue.get()
+            if work_item == StopIteration:
+                return
 
-        slpdata, custom_cutter = work_item
+            slpdata, custom_cutter = work_item
 
-        try:
-            texture = Texture(SLP(slpdata), palette, custom_cutter=custom_cutter)
-            outqueue.put(texture)
-        except BaseException as exc:
-            import traceback
-            traceback.print_exc()
+            try:
+                outqueue.put(convert_slp(slpdata, palette, custom_cutter))
+            except BaseException as exc:
+                import traceback
+                traceback.print_exc()
 
-            outqueue.put(exc)
+                outqueue.put(exc)
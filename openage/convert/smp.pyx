@@ -1,7 +1,8 @@
-# Copyright 2013-2019 the openage authors. See copying.md for legal info.
+# Copyright 2013-2020 the openage authors. See copying.md for legal info.
 #
 # cython: profile=False
 
+from functools import lru_cache
 from struct import Struct, unpack_from
 
 from enum import Enum
@@ -35,6 +36,9 @@ cdef enum pixel_type:
     color_player        # non-outline player color pixel
     color_outline       # player color outline pixel
 
+# number of entries in pixel_type
+PIXEL_TYPE_COUNT = color_outline + 1
+
 
 # One SMP pixel.
 cdef struct pixel:
@@ -45,6 +49,38 @@ cdef struct pixel:
     uint8_t damage_modifier_2   # modifier for damage (part 2)
 
 
+# The row decoders run without the GIL.
+# These helpers re-acquire it to report errors.
+
+cdef int row_overflow_error(size_t expected_size, Py_ssize_t rowid,
+                            int layer_type, size_t got) except -1 with gil:
+    raise Exception(
+        "Only %d pixels should be drawn in row %d "
+        "with layer type %d, but we have %d "
+        "already!" % (expected_size, rowid, layer_type, got)
+    )
+
+
+cdef int row_size_error(size_t got, size_t pixel_count, Py_ssize_t rowid,
+                        int layer_type,
+                        Py_ssize_t first_cmd_offset) except -1 with gil:
+    summary = "%d/%d -> row %d, layer type %d, offset %d / %#x" % (
+        got, pixel_count, rowid, layer_type,
+        first_cmd_offset, first_cmd_offset
+        )
+    txt = "got %%s pixels than expected: %s, missing: %d" % (
+        summary, abs(<Py_ssize_t>pixel_count - <Py_ssize_t>got))
+
+    raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+
+
+cdef int unknown_cmd_error(const char *layer_name, uint8_t cmd,
+                           Py_ssize_t rowid) except -1 with gil:
+    raise Exception(
+        "unknown smp %s layer drawing command: " % layer_name.decode('ascii') +
+        "%#x in row %d" % (cmd, rowid))
+
+
 class SMP:
     """
     Class for reading/converting the SMP image format (successor of SLP).
@@ -231,20 +267,35 @@ cdef class SMPLayer:
     # stores the file offset for the first drawing command
     cdef vector[int] cmd_offsets
 
-    # pixel matrix representing the final image
-    cdef vector[vector[pixel]] pcolor
+    # pixel type, palette index, palette section
+    # and damage modifier planes representing the final image
+    cdef numpy.ndarray pixel_types
+    cdef numpy.ndarray pixel_indices
+    cdef numpy.ndarray pixel_sections
+    cdef numpy.ndarray damage_modifiers
 
     # memory pointer
     cdef const uint8_t *data_raw
 
+    # number of pixels in a row
+    cdef size_t width
+
+    # 2 = normal, 4 = shadow, 8 = outline
+    cdef int layer_type
+
     def __init__(self, layer_header, data):
         self.info = layer_header
 
-        if not (isinstance(data, bytes) or isinstance(data, bytearray)):
-            raise ValueError("Layer data must be some bytes object")
+        # any contiguous buffer can be used, e.g. bytes or a
+        # memoryview slice of a memory-mapped archive.
+        cdef const uint8_t[::1] data_view
+        try:
+            data_view = data
+        except (TypeError, ValueError):
+            raise ValueError("Layer data must be a contiguous bytes-like object")
 
-        # convert the bytes obj to char*
-        self.data_raw = data
+        # pointer to the data, which stays alive during the decoding
+        self.data_raw = &data_view[0]
 
         cdef size_t i
         cdef int cmd_offset
@@ -275,30 +326,63 @@ cdef class SMPLayer:
                 data, cmd_table_position)[0] + self.info.frame_offset
             self.cmd_offsets.push_back(cmd_offset)
 
-        for i in range(row_count):
-            self.pcolor.push_back(self.create_color_row(i))
+        self.width = self.info.size[0]
+        self.layer_type = self.info.layer_type
+
+        self.pixel_types = numpy.zeros((row_count, self.width),
+                                       dtype=numpy.uint8)
+        self.pixel_indices = numpy.zeros((row_count, self.width),
+                                         dtype=numpy.uint8)
+        self.pixel_sections = numpy.zeros((row_count, self.width),
+                                          dtype=numpy.uint8)
+        self.damage_modifiers = numpy.zeros((row_count, self.width, 2),
+                                            dtype=numpy.uint8)
+
+        cdef uint8_t[:, ::1] type_plane = self.pixel_types
+        cdef uint8_t[:, ::1] index_plane = self.pixel_indices
+        cdef uint8_t[:, ::1] section_plane = self.pixel_sections
+        cdef uint8_t[:, :, ::1] damage_plane = self.damage_modifiers
 
-    cdef vector[pixel] create_color_row(self, Py_ssize_t rowid) except +:
+        # decoding buffer for one row, reused for all rows
+        cdef vector[pixel] row_data
+        cdef size_t x
+
+        # the rows only depend on the raw data buffer,
+        # so they can be decoded without holding the GIL.
+        with nogil:
+            for i in range(row_count):
+                row_data.clear()
+                self.create_color_row(row_data, i)
+
+                for x in range(self.width):
+                    type_plane[i, x] = row_data[x].type
+                    index_plane[i, x] = row_data[x].index
+                    # palettes have 1024 entries divided into 4 sections
+                    section_plane[i, x] = row_data[x].palette & 0x03
+                    damage_plane[i, x, 0] = row_data[x].damage_modifier_1
+                    damage_plane[i, x, 1] = row_data[x].damage_modifier_2
+
+    cdef int create_color_row(self, vector[pixel] &row_data,
+                              Py_ssize_t rowid) nogil except -1:
         """
         extract colors (pixels) for the given rowid.
         """
 
-        cdef vector[pixel] row_data
-        cdef Py_ssize_t i
+        cdef size_t i
 
-        first_cmd_offset = self.cmd_offsets[rowid]
+        cdef Py_ssize_t first_cmd_offset = self.cmd_offsets[rowid]
         cdef boundary_def bounds = self.boundaries[rowid]
-        cdef size_t pixel_count = self.info.size[0]
+        cdef size_t pixel_count = self.width
 
         # preallocate memory
         row_data.reserve(pixel_count)
 
         # row is completely transparent
         if bounds.full_row:
-            for _ in range(pixel_count):
+            for i in range(pixel_count):
                 row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
-            return row_data
+            return 0
 
         # start drawing the left transparent space
         for i in range(bounds.left):
@@ -315,25 +399,18 @@ cdef class SMPLayer:
 
         # verify size of generated row
         if row_data.size() != pixel_count:
-            got = row_data.size()
-            summary = "%d/%d -> row %d, layer type %d, offset %d / %#x" % (
-                got, pixel_count, rowid, self.info.layer_type,
-                first_cmd_offset, first_cmd_offset
-                )
-            txt = "got %%s pixels than expected: %s, missing: %d" % (
-                summary, abs(pixel_count - got))
-
-            raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+            row_size_error(row_data.size(), pixel_count, rowid,
+                           self.layer_type, first_cmd_offset)
 
-        return row_data
+        return 0
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
-        pass
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
+        return 0
 
-    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset):
+    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset) nogil:
         """
         Fetch a byte from the SMP.
         """
@@ -343,7 +420,9 @@ cdef class SMPLayer:
         """
         Convert the palette index matrix to a colored image.
         """
-        return determine_rgba_matrix(self.pcolor, main_palette, player_palette)
+        return determine_rgba_matrix(self.pixel_types, self.pixel_indices,
+                                     self.pixel_sections,
+                                     main_palette, player_palette)
 
     def get_hotspot(self):
         """
@@ -363,10 +442,10 @@ cdef class SMPMainLayer(SMPLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands
         found for this row in the SMP frame.
@@ -382,6 +461,8 @@ cdef class SMPMainLayer(SMPLayer):
         cdef uint8_t nextbyte
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
+        cdef int j
 
         cdef vector[uint8_t] pixel_data
         pixel_data.reserve(4)
@@ -389,15 +470,8 @@ cdef class SMPMainLayer(SMPLayer):
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid,
+                                   self.layer_type, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -420,7 +494,7 @@ cdef class SMPMainLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -431,8 +505,8 @@ cdef class SMPMainLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
-                    for _ in range(4):
+                for i in range(pixel_count):
+                    for j in range(4):
                         dpos += 1
                         pixel_data.push_back(self.get_byte_at(dpos))
 
@@ -452,8 +526,8 @@ cdef class SMPMainLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
-                    for _ in range(4):
+                for i in range(pixel_count):
+                    for j in range(4):
                         dpos += 1
                         pixel_data.push_back(self.get_byte_at(dpos))
 
@@ -466,21 +540,19 @@ cdef class SMPMainLayer(SMPLayer):
                     pixel_data.clear()
 
             else:
-                raise Exception(
-                    "unknown smp main graphics layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"main graphics", cmd, rowid)
 
             # process next command
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
     def get_damage_mask(self):
         """
         Convert the 4th pixel byte to a mask used for damaged units.
         """
-        return determine_damage_matrix(self.pcolor)
+        return determine_damage_matrix(self.damage_modifiers)
 
 
 cdef class SMPShadowLayer(SMPLayer):
@@ -491,10 +563,10 @@ cdef class SMPShadowLayer(SMPLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands
         found for this row in the SMP frame.
@@ -510,19 +582,14 @@ cdef class SMPShadowLayer(SMPLayer):
         cdef uint8_t nextbyte
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
+        cdef int j
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid,
+                                   self.layer_type, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -556,7 +623,7 @@ cdef class SMPShadowLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -567,7 +634,7 @@ cdef class SMPShadowLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
 
                     dpos += 1
                     nextbyte = self.get_byte_at(dpos)
@@ -576,15 +643,13 @@ cdef class SMPShadowLayer(SMPLayer):
                                              nextbyte, 0, 0, 0))
 
             else:
-                raise Exception(
-                    "unknown smp shadow layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"shadow", cmd, rowid)
 
             # process next command
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
 
 cdef class SMPOutlineLayer(SMPLayer):
@@ -595,10 +660,10 @@ cdef class SMPOutlineLayer(SMPLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef process_drawing_cmds(self, vector[pixel] &row_data,
-                              Py_ssize_t rowid,
-                              Py_ssize_t first_cmd_offset,
-                              size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  Py_ssize_t first_cmd_offset,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands
         found for this row in the SMP frame.
@@ -614,19 +679,14 @@ cdef class SMPOutlineLayer(SMPLayer):
         cdef uint8_t nextbyte
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
+        cdef int j
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid,
+                                   self.layer_type, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -649,7 +709,7 @@ cdef class SMPOutlineLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -660,115 +720,82 @@ cdef class SMPOutlineLayer(SMPLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # we don't know the color the game wants
                     # so we just draw index 0
                     row_data.push_back(pixel(color_outline,
                                              0, 0, 0, 0))
 
             else:
-                raise Exception(
-                    "unknown smp outline layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"outline", cmd, rowid)
 
             # process next command
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return
+        # end of row reached, the pixels were appended to row_data.
+        return 0
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef numpy.ndarray determine_rgba_matrix(vector[vector[pixel]] &image_matrix,
-                                         main_palette, player_palette):
-    """
-    converts a palette index image matrix to an rgba matrix.
+@lru_cache(maxsize=16)
+def rgba_lookup_table(main_palette, player_palette):
     """
+    Creates a table that maps (pixel type, palette section, palette index)
+    to rgba values, along with a mask of the entries that can be resolved.
 
-    cdef size_t height = image_matrix.size()
-    cdef size_t width = image_matrix[0].size()
-
-    cdef numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] array_data = \
-        numpy.zeros((height, width, 4), dtype=numpy.uint8)
-
-    # micro optimization to avoid call to ColorTable.__getitem__()
-    cdef list m_lookup = main_palette.palette
-    cdef list p_lookup = player_palette.palette
-
-    cdef uint8_t r
-    cdef uint8_t g
-    cdef uint8_t b
-    cdef uint8_t alpha
-
-    cdef vector[pixel] current_row
-    cdef pixel px
-    cdef pixel_type px_type
-    cdef uint8_t px_index
-    cdef uint8_t px_palette
-
-    cdef uint16_t palette_section
-
-    cdef size_t x
-    cdef size_t y
-
-    for y in range(height):
-
-        current_row = image_matrix[y]
-
-        for x in range(width):
-            px = current_row[x]
-            px_type = px.type
-            px_index = px.index
-            px_palette = px.palette
+    The tables only depend on the palettes, so they are cached.
+    """
+    m_lookup = main_palette.get_rgba_array()
+    p_lookup = player_palette.get_rgba_array()
 
-            if px_type == color_standard:
-                # look up the palette secition
-                # palettes have 1024 entries
-                # divided into 4 sections
-                palette_section = px_palette & 0x03
+    lut = numpy.zeros((PIXEL_TYPE_COUNT, 4, 256, 4), dtype=numpy.uint8)
+    valid = numpy.zeros((PIXEL_TYPE_COUNT, 4, 256), dtype=bool)
 
-                # the index has to be adjusted
-                # to the palette section
-                index = px_index + (palette_section * 256)
+    # look up the color index in the main graphics table.
+    # the index has to be adjusted to the palette section.
+    main_indices = numpy.arange(4 * 256).reshape(4, 256)
+    in_range = main_indices < len(m_lookup)
+    lut[color_standard, in_range, :3] = m_lookup[main_indices[in_range], :3]
 
-                # look up the color index in the
-                # main graphics table
-                r, g, b, alpha = m_lookup[index]
+    # alpha values are unused
+    # in 0x0C and 0x0B version of SMPs
+    lut[color_standard, :, :, 3] = 255
+    valid[color_standard] = in_range
 
-                # alpha values are unused
-                # in 0x0C and 0x0B version of SMPs
-                alpha = 255
+    valid[color_transparent] = True
 
-            elif px_type == color_transparent:
-                r, g, b, alpha = 0, 0, 0, 0
+    # the palette index is the shadow's alpha value
+    lut[color_shadow, :, :, 3] = numpy.arange(256)
+    valid[color_shadow] = True
 
-            elif px_type == color_shadow:
-                r, g, b, alpha = 0, 0, 0, px_index
+    # get rgb base color from the player color table
+    count = min(len(p_lookup), 256)
 
-            else:
-                if px_type == color_player:
-                    # TODO: Make this 255 with new renderer
-                    alpha = 254
+    # TODO: Make this 255 with new renderer
+    for px_type, alpha in ((color_player, 254),
+                           (color_outline, 253)):
+        lut[px_type, :, :count, :3] = p_lookup[:count, :3]
+        lut[px_type, :, :, 3] = alpha
+        valid[px_type, :, :count] = True
 
-                elif px_type == color_outline:
-                    alpha = 253
+    return lut, valid
 
-                else:
-                    raise ValueError("unknown pixel type: %d" % px_type)
 
-                # get rgb base color from the color table
-                # store it the preview player color
-                # in the table: [16*player, 16*player+7]
-                r, g, b = p_lookup[px_index]
+def determine_rgba_matrix(pixel_types, pixel_indices, pixel_sections,
+                          main_palette, player_palette):
+    """
+    converts the pixel planes to an rgba matrix.
+    """
+    lut, valid = rgba_lookup_table(main_palette, player_palette)
 
-            # array_data[y, x] = (r, g, b, alpha)
-            array_data[y, x, 0] = r
-            array_data[y, x, 1] = g
-            array_data[y, x, 2] = b
-            array_data[y, x, 3] = alpha
+    resolvable = valid[pixel_types, pixel_sections, pixel_indices]
+    if not resolvable.all():
+        raise IndexError("palette index %d (section %d) of pixel type %d "
+                         "out of range" % (
+                             pixel_indices[~resolvable][0],
+                             pixel_sections[~resolvable][0],
+                             pixel_types[~resolvable][0]))
 
-    return array_data
+    return lut[pixel_types, pixel_sections, pixel_indices]
 
 cdef (uint8_t,uint8_t) get_palette_info(pixel image_pixel):
     """
@@ -778,45 +805,16 @@ cdef (uint8_t,uint8_t) get_palette_info(pixel image_pixel):
     """
     return image_pixel.palette >> 2, image_pixel.palette & 0x03
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef numpy.ndarray determine_damage_matrix(vector[vector[pixel]] &image_matrix):
+def determine_damage_matrix(damage_modifiers):
     """
     converts the damage modifier values to an image using the RG values.
 
-    :param image_matrix: A 2-dimensional array of SMP pixels.
+    :param damage_modifiers: Plane of the two damage modifiers of each pixel.
     """
+    height, width, _ = damage_modifiers.shape
 
-    cdef size_t height = image_matrix.size()
-    cdef size_t width = image_matrix[0].size()
-
-    cdef numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] array_data = \
-        numpy.zeros((height, width, 4), dtype=numpy.uint8)
-
-    cdef uint8_t r
-    cdef uint8_t g
-    cdef uint8_t b
-    cdef uint8_t alpha
-
-    cdef vector[pixel] current_row
-    cdef pixel px
-
-    cdef size_t x
-    cdef size_t y
-
-    for y in range(height):
-
-        current_row = image_matrix[y]
-
-        for x in range(width):
-            px = current_row[x]
-
-            r, g, b, alpha = px.damage_modifier_1, px.damage_modifier_2, 0, 255
-
-            # array_data[y, x] = (r, g, b, alpha)
-            array_data[y, x, 0] = r
-            array_data[y, x, 1] = g
-            array_data[y, x, 2] = b
-            array_data[y, x, 3] = alpha
+    array_data = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    array_data[:, :, :2] = damage_modifiers
+    array_data[:, :, 3] = 255
 
     return array_data
@@ -1,7 +1,8 @@
-# Copyright 2019-2019 the openage authors. See copying.md for legal info.
+# Copyright 2019-2020 the openage authors. See copying.md for legal info.
 #
 # cython: profile=False
 
+from functools import lru_cache
 from struct import Struct, unpack_from
 
 from enum import Enum
@@ -35,6 +36,9 @@ cdef enum pixel_type:
     color_player        # non-outline player color pixel
     color_outline       # player color outline pixel
 
+# number of entries in pixel_type
+PIXEL_TYPE_COUNT = color_outline + 1
+
 
 # One uncompressed SMP pixel.
 cdef struct pixel:
@@ -45,6 +49,43 @@ cdef struct pixel:
     uint8_t damage_modifier_2   # modifier for damage (part 2)
 
 
+# Position of the decoder in the command and color tables.
+# Rows are stored consecutively, so this is carried over from row to row.
+cdef struct decode_pos:
+    Py_ssize_t cmd              # offset of the next drawing command
+    Py_ssize_t color            # offset of the next pixel data value
+    int chunk_pos               # position in the compressed chunk
+
+
+# The row decoders run without the GIL.
+# These helpers re-acquire it to report errors.
+
+cdef int row_overflow_error(size_t expected_size, Py_ssize_t rowid,
+                            size_t got) except -1 with gil:
+    raise Exception(
+        "Only %d pixels should be drawn in row %d, "
+        "but we have %d already!" % (expected_size, rowid, got)
+    )
+
+
+cdef int row_size_error(size_t got, size_t pixel_count, Py_ssize_t rowid,
+                        Py_ssize_t first_cmd_offset) except -1 with gil:
+    summary = "%d/%d -> row %d, offset %d / %#x" % (
+        got, pixel_count, rowid, first_cmd_offset, first_cmd_offset
+        )
+    txt = "got %%s pixels than expected: %s, missing: %d" % (
+        summary, abs(<Py_ssize_t>pixel_count - <Py_ssize_t>got))
+
+    raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+
+
+cdef int unknown_cmd_error(const char *layer_name, uint8_t cmd,
+                           Py_ssize_t rowid) except -1 with gil:
+    raise Exception(
+        "unknown %s layer drawing command: " % layer_name.decode('ascii') +
+        "%#x in row %d" % (cmd, rowid))
+
+
 class SMX:
     """
     Class for reading/converting compressed SMP files (delivered
@@ -83,7 +124,7 @@ class SMX:
         Read an SMX image file.
 
         :param data: File content as bytes.
-        :type data: bytes, bytearray
+        :type data: bytes, bytearray, memoryview
         """
 
         smx_header = SMX.smx_header.unpack_from(data)
@@ -269,12 +310,19 @@ cdef class SMXLayer:
     # contains (left, right, full_row) number of boundary pixels
     cdef vector[boundary_def] boundaries
 
-    # pixel matrix representing the final image
-    cdef vector[vector[pixel]] pcolor
+    # pixel type, palette index, palette section
+    # and damage modifier planes representing the final image
+    cdef numpy.ndarray pixel_types
+    cdef numpy.ndarray pixel_indices
+    cdef numpy.ndarray pixel_sections
+    cdef numpy.ndarray damage_modifiers
 
     # memory pointer
     cdef const uint8_t *data_raw
 
+    # number of pixels in a row
+    cdef size_t width
+
     def __init__(self, layer_header, data):
         """
         SMX layer definition superclass. There can be various types of
@@ -283,15 +331,20 @@ cdef class SMXLayer:
         :param layer_header: Header definition of the layer.
         :param data: File content as bytes.
         :type layer_header: SMXLayerHeader
-        :type data: bytes, bytearray
+        :type data: bytes, bytearray, memoryview
         """
         self.info = layer_header
 
-        if not (isinstance(data, bytes) or isinstance(data, bytearray)):
-            raise ValueError("Layer data must be some bytes object")
+        # any contiguous buffer can be used, e.g. bytes or a
+        # memoryview slice of a memory-mapped archive.
+        cdef const uint8_t[::1] data_view
+        try:
+            data_view = data
+        except (TypeError, ValueError):
+            raise ValueError("Layer data must be a contiguous bytes-like object")
 
-        # convert the bytes obj to char*
-        self.data_raw = data
+        # pointer to the data, which stays alive during the decoding
+        self.data_raw = &data_view[0]
 
         cdef size_t i
 
@@ -312,59 +365,83 @@ cdef class SMXLayer:
             else:
                 self.boundaries.push_back(boundary_def(left, right, False))
 
-        cdef int cmd_offset = self.info.qdl_command_table_offset
-        cdef int color_offset = self.info.qdl_color_table_offset
-        cdef int chunk_pos = 0
+        cdef decode_pos pos = decode_pos(self.info.qdl_command_table_offset,
+                                         self.info.qdl_color_table_offset,
+                                         0)
 
-        # process cmd table
-        for i in range(row_count):
-            cmd_offset, color_offset, chunk_pos, row_data = \
-                self.create_color_row(i, cmd_offset, color_offset, chunk_pos)
+        self.width = self.info.size[0]
 
-            self.pcolor.push_back(row_data)
+        self.pixel_types = numpy.zeros((row_count, self.width),
+                                       dtype=numpy.uint8)
+        self.pixel_indices = numpy.zeros((row_count, self.width),
+                                         dtype=numpy.uint8)
+        self.pixel_sections = numpy.zeros((row_count, self.width),
+                                          dtype=numpy.uint8)
+        self.damage_modifiers = numpy.zeros((row_count, self.width, 2),
+                                            dtype=numpy.uint8)
 
-    cdef tuple create_color_row(self, Py_ssize_t rowid,
-                                int cmd_offset, int color_offset,
-                                int chunk_pos) except +:
+        cdef uint8_t[:, ::1] type_plane = self.pixel_types
+        cdef uint8_t[:, ::1] index_plane = self.pixel_indices
+        cdef uint8_t[:, ::1] section_plane = self.pixel_sections
+        cdef uint8_t[:, :, ::1] damage_plane = self.damage_modifiers
+
+        # decoding buffer for one row, reused for all rows
+        cdef vector[pixel] row_data
+        cdef size_t x
+
+        # the rows only depend on the raw data buffer,
+        # so they can be decoded without holding the GIL.
+        with nogil:
+            for i in range(row_count):
+                row_data.clear()
+                self.create_color_row(row_data, i, pos)
+
+                for x in range(self.width):
+                    type_plane[i, x] = row_data[x].type
+                    index_plane[i, x] = row_data[x].index
+                    # palettes have 1024 entries divided into 4 sections
+                    section_plane[i, x] = row_data[x].palette & 0x03
+                    damage_plane[i, x, 0] = row_data[x].damage_modifier_1
+                    damage_plane[i, x, 1] = row_data[x].damage_modifier_2
+
+    cdef int create_color_row(self, vector[pixel] &row_data,
+                              Py_ssize_t rowid,
+                              decode_pos &pos) nogil except -1:
         """
         Extract colors (pixels) for the given rowid.
 
+        :param row_data: Pixel data is appended to this array.
         :param rowid: Index of the current row in the layer.
-        :param cmd_offset: Offset of the command table of the layer.
-        :param color_offset: Offset of the color table of the layer.
-        :param chunk_pos: Current position in the compressed chunk.
+        :param pos: Current offsets in the command and color tables
+                    and position in the compressed chunk. Advanced
+                    to the start of the next row.
         """
 
-        cdef vector[pixel] row_data
-        cdef Py_ssize_t i
+        cdef size_t i
 
-        cdef int first_cmd_offset = cmd_offset
-        cdef int first_color_offset = color_offset
+        cdef Py_ssize_t first_cmd_offset = pos.cmd
         cdef boundary_def bounds = self.boundaries[rowid]
-        cdef size_t pixel_count = self.info.size[0]
+        cdef size_t pixel_count = self.width
 
         # preallocate memory
         row_data.reserve(pixel_count)
 
         # row is completely transparent
         if bounds.full_row:
-            for _ in range(pixel_count):
+            for i in range(pixel_count):
                 row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
-            return cmd_offset, color_offset, chunk_pos, row_data
+            return 0
 
         # start drawing the left transparent space
         for i in range(bounds.left):
             row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
         # process the drawing commands for this row.
-        next_cmd_offset, next_color_offset, chunk_pos, row_data = \
-            self.process_drawing_cmds(row_data,
-                                      rowid,
-                                      first_cmd_offset,
-                                      first_color_offset,
-                                      chunk_pos,
-                                      pixel_count - bounds.right)
+        self.process_drawing_cmds(row_data,
+                                  rowid,
+                                  pos,
+                                  pixel_count - bounds.right)
 
         # finish by filling up the right transparent space
         for i in range(bounds.right):
@@ -372,38 +449,29 @@ cdef class SMXLayer:
 
         # verify size of generated row
         if row_data.size() != pixel_count:
-            got = row_data.size()
-            summary = "%d/%d -> row %d, layer type %d, offset %d / %#x" % (
-                got, pixel_count, rowid, self.info.layer_type,
-                first_cmd_offset, first_cmd_offset
-                )
-            txt = "got %%s pixels than expected: %s, missing: %d" % (
-                summary, abs(pixel_count - got))
-
-            raise Exception(txt % ("LESS" if got < pixel_count else "MORE"))
+            row_size_error(row_data.size(), pixel_count,
+                           rowid, first_cmd_offset)
 
-        return next_cmd_offset, next_color_offset, chunk_pos, row_data
+        return 0
 
-    cdef tuple process_drawing_cmds(self, vector[pixel] &row_data,
-                                    Py_ssize_t rowid,
-                                    Py_ssize_t first_cmd_offset,
-                                    Py_ssize_t first_color_offset,
-                                    int chunk_pos,
-                                    size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  decode_pos &pos,
+                                  size_t expected_size) nogil except -1:
         """
         Extracts pixel data from the layer data. Every layer type uses
         its own implementation for better optimization.
 
         :param row_data: Pixel data is appended to this array.
         :param rowid: Index of the current row in the layer.
-        :param first_cmd_offset: Offset of the first command of the current row.
-        :param first_color_offset: Offset of the first pixel data value of the current row.
-        :param chunk_pos: Current position in the compressed chunk.
+        :param pos: Offsets of the first command and the first pixel data
+                    value of the current row, and the current position in
+                    the compressed chunk. Updated for the next row.
         :param expected_size: Expected length of row_data after encountering the EOR command.
         """
-        pass
+        return 0
 
-    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset):
+    cdef inline uint8_t get_byte_at(self, Py_ssize_t offset) nogil:
         """
         Fetch a byte from the SMX.
 
@@ -423,7 +491,9 @@ cdef class SMXLayer:
         :return: Array of RGBA values.
         :rtype: numpy.ndarray
         """
-        return determine_rgba_matrix(self.pcolor, main_palette, player_palette)
+        return determine_rgba_matrix(self.pixel_types, self.pixel_indices,
+                                     self.pixel_sections,
+                                     main_palette, player_palette)
 
     def get_hotspot(self):
         """
@@ -455,24 +525,22 @@ cdef class SMXMainLayer8to5(SMXLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef tuple process_drawing_cmds(self, vector[pixel] &row_data,
-                                    Py_ssize_t rowid,
-                                    Py_ssize_t first_cmd_offset,
-                                    Py_ssize_t first_color_offset,
-                                    int chunk_pos,
-                                    size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  decode_pos &pos,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands that were
         compressed with 8to5 compression.
         """
         # position in the command array, we start at the first command of this row
-        cdef Py_ssize_t dpos_cmd = first_cmd_offset
+        cdef Py_ssize_t dpos_cmd = pos.cmd
 
         # Position in the pixel data array
-        cdef Py_ssize_t dpos_color = first_color_offset
+        cdef Py_ssize_t dpos_color = pos.color
 
         # Position in the compression chunk.
-        cdef bool odd = chunk_pos
+        cdef bool odd = pos.chunk_pos
         cdef int px_dpos # For loop iterator
 
         # is the end of the current row reached?
@@ -481,6 +549,7 @@ cdef class SMXMainLayer8to5(SMXLayer):
         cdef uint8_t cmd
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
         cdef vector[uint8_t] pixel_data
         pixel_data.reserve(4)
 
@@ -499,15 +568,7 @@ cdef class SMXMainLayer8to5(SMXLayer):
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos_cmd)
@@ -529,7 +590,7 @@ cdef class SMXMainLayer8to5(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -543,7 +604,7 @@ cdef class SMXMainLayer8to5(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # Start fetching pixel data
                     if odd:
                         # Odd indices require manual extraction of each of the 4 values
@@ -600,7 +661,7 @@ cdef class SMXMainLayer8to5(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # Start fetching pixel data
                     if odd:
                         # Odd indices require manual extraction of each of the 4 values
@@ -647,14 +708,16 @@ cdef class SMXMainLayer8to5(SMXLayer):
                     pixel_data.clear()
 
             else:
-                raise Exception(
-                    "unknown smx main graphics layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"smx main graphics", cmd, rowid)
 
             # Process next command
             dpos_cmd += 1
 
-        return dpos_cmd, dpos_color, odd, row_data
+        pos.cmd = dpos_cmd
+        pos.color = dpos_color
+        pos.chunk_pos = odd
+
+        return 0
 
 
 cdef class SMXMainLayer4plus1(SMXLayer):
@@ -665,24 +728,22 @@ cdef class SMXMainLayer4plus1(SMXLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef tuple process_drawing_cmds(self, vector[pixel] &row_data,
-                                    Py_ssize_t rowid,
-                                    Py_ssize_t first_cmd_offset,
-                                    Py_ssize_t first_color_offset,
-                                    int chunk_pos,
-                                    size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  decode_pos &pos,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands that were
         compressed with 4plus1 compression.
         """
         # position in the data blob, we start at the first command of this row
-        cdef Py_ssize_t dpos_cmd = first_cmd_offset
+        cdef Py_ssize_t dpos_cmd = pos.cmd
 
         # Position in the pixel data array
-        cdef Py_ssize_t dpos_color = first_color_offset
+        cdef Py_ssize_t dpos_color = pos.color
 
         # Position in the compression chunk
-        cdef uint8_t dpos_chunk = chunk_pos
+        cdef uint8_t dpos_chunk = pos.chunk_pos
 
         # is the end of the current row reached?
         cdef bool eor = False
@@ -690,21 +751,14 @@ cdef class SMXMainLayer4plus1(SMXLayer):
         cdef uint8_t cmd
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
         cdef uint8_t palette_section_block
         cdef uint8_t palette_section
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos_cmd)
@@ -726,7 +780,7 @@ cdef class SMXMainLayer4plus1(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -741,7 +795,7 @@ cdef class SMXMainLayer4plus1(SMXLayer):
 
                 palette_section_block = self.get_byte_at(dpos_color + (4 - dpos_chunk))
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # Start fetching pixel data
                     palette_section = (palette_section_block >> (2 * dpos_chunk)) & 0x03
                     row_data.push_back(pixel(color_standard,
@@ -769,7 +823,7 @@ cdef class SMXMainLayer4plus1(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # Start fetching pixel data
                     palette_section = (palette_section_block >> (2 * dpos_chunk)) & 0x03
                     row_data.push_back(pixel(color_player,
@@ -788,14 +842,16 @@ cdef class SMXMainLayer4plus1(SMXLayer):
                         palette_section_block = self.get_byte_at(dpos_color + 4)
 
             else:
-                raise Exception(
-                    "unknown smx main graphics layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"smx main graphics", cmd, rowid)
 
             # Process next command
             dpos_cmd += 1
 
-        return dpos_cmd, dpos_color, dpos_chunk, row_data
+        pos.cmd = dpos_cmd
+        pos.color = dpos_color
+        pos.chunk_pos = dpos_chunk
+
+        return 0
 
 
 cdef class SMXShadowLayer(SMXLayer):
@@ -806,18 +862,16 @@ cdef class SMXShadowLayer(SMXLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef tuple process_drawing_cmds(self, vector[pixel] &row_data,
-                                    Py_ssize_t rowid,
-                                    Py_ssize_t first_cmd_offset,
-                                    Py_ssize_t first_color_offset,
-                                    int chunk_pos,
-                                    size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  decode_pos &pos,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands
         found for this row in the SMX layer.
         """
         # position in the data blob, we start at the first command of this row
-        cdef Py_ssize_t dpos = first_cmd_offset
+        cdef Py_ssize_t dpos = pos.cmd
 
         # is the end of the current row reached?
         cdef bool eor = False
@@ -826,19 +880,12 @@ cdef class SMXShadowLayer(SMXLayer):
         cdef uint8_t nextbyte
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -871,7 +918,7 @@ cdef class SMXShadowLayer(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -882,7 +929,7 @@ cdef class SMXShadowLayer(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     dpos += 1
                     nextbyte = self.get_byte_at(dpos)
 
@@ -890,15 +937,16 @@ cdef class SMXShadowLayer(SMXLayer):
                                              nextbyte, 0, 0, 0))
 
             else:
-                raise Exception(
-                    "unknown smp shadow layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"smp shadow", cmd, rowid)
 
             # process next command
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return dpos, dpos, chunk_pos, row_data
+        # end of row reached, the pixels were appended to row_data.
+        pos.cmd = dpos
+        pos.color = dpos
+
+        return 0
 
 
 cdef class SMXOutlineLayer(SMXLayer):
@@ -909,18 +957,16 @@ cdef class SMXOutlineLayer(SMXLayer):
     def __init__(self, layer_header, data):
         super().__init__(layer_header, data)
 
-    cdef tuple process_drawing_cmds(self, vector[pixel] &row_data,
-                                    Py_ssize_t rowid,
-                                    Py_ssize_t first_cmd_offset,
-                                    Py_ssize_t first_color_offset,
-                                    int chunk_pos,
-                                    size_t expected_size):
+    cdef int process_drawing_cmds(self, vector[pixel] &row_data,
+                                  Py_ssize_t rowid,
+                                  decode_pos &pos,
+                                  size_t expected_size) nogil except -1:
         """
         extract colors (pixels) for the drawing commands
         found for this row in the SMX layer.
         """
         # position in the data blob, we start at the first command of this row
-        cdef Py_ssize_t dpos = first_cmd_offset
+        cdef Py_ssize_t dpos = pos.cmd
 
         # is the end of the current row reached?
         cdef bool eor = False
@@ -929,19 +975,12 @@ cdef class SMXOutlineLayer(SMXLayer):
         cdef uint8_t nextbyte
         cdef uint8_t lower_crumb
         cdef int pixel_count
+        cdef int i
 
         # work through commands till end of row.
         while not eor:
             if row_data.size() > expected_size:
-                raise Exception(
-                    "Only %d pixels should be drawn in row %d "
-                    "with layer type %d, but we have %d "
-                    "already!" % (
-                        expected_size, rowid,
-                        self.info.layer_type,
-                        row_data.size()
-                    )
-                )
+                row_overflow_error(expected_size, rowid, row_data.size())
 
             # fetch drawing instruction
             cmd = self.get_byte_at(dpos)
@@ -965,7 +1004,7 @@ cdef class SMXOutlineLayer(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     row_data.push_back(pixel(color_transparent, 0, 0, 0, 0))
 
             elif lower_crumb == 0b00000001:
@@ -976,161 +1015,108 @@ cdef class SMXOutlineLayer(SMXLayer):
 
                 pixel_count = (cmd >> 2) + 1
 
-                for _ in range(pixel_count):
+                for i in range(pixel_count):
                     # we don't know the color the game wants
                     # so we just draw index 0
                     row_data.push_back(pixel(color_outline,
                                              0, 0, 0, 0))
 
             else:
-                raise Exception(
-                    "unknown smp outline layer drawing command: " +
-                    "%#x in row %d" % (cmd, rowid))
+                unknown_cmd_error(b"smp outline", cmd, rowid)
 
             # process next command
             dpos += 1
 
-        # end of row reached, return the created pixel array.
-        return dpos, dpos, chunk_pos, row_data
+        # end of row reached, the pixels were appended to row_data.
+        pos.cmd = dpos
+        pos.color = dpos
 
+        return 0
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef numpy.ndarray determine_rgba_matrix(vector[vector[pixel]] &image_matrix,
-                                         main_palette, player_palette):
+
+@lru_cache(maxsize=16)
+def rgba_lookup_table(main_palette, player_palette):
     """
-    converts a palette index image matrix to an rgba matrix.
+    Creates a table that maps (pixel type, palette section, palette index)
+    to rgba values, along with a mask of the entries that can be resolved.
+
+    The tables only depend on the palettes, so they are cached.
 
-    :param image_matrix: A 2-dimensional array of SMP pixels.
     :param main_palette: Color palette used for normal pixels in the sprite.
     :param player_palette: Color palette used for player color pixels in the sprite.
+    :type main_palette: .colortable.ColorTable
+    :type player_palette: .colortable.ColorTable
     """
+    m_lookup = main_palette.get_rgba_array()
+    p_lookup = player_palette.get_rgba_array()
 
-    cdef size_t height = image_matrix.size()
-    cdef size_t width = image_matrix[0].size()
-
-    cdef numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] array_data = \
-        numpy.zeros((height, width, 4), dtype=numpy.uint8)
-
-    # micro optimization to avoid call to ColorTable.__getitem__()
-    cdef list m_lookup = main_palette.palette
-    cdef list p_lookup = player_palette.palette
-
-    cdef uint8_t r
-    cdef uint8_t g
-    cdef uint8_t b
-    cdef uint8_t alpha
-
-    cdef vector[pixel] current_row
-    cdef pixel px
-    cdef pixel_type px_type
-    cdef uint8_t px_index
-    cdef uint8_t px_palette
-
-    cdef uint16_t palette_section
+    lut = numpy.zeros((PIXEL_TYPE_COUNT, 4, 256, 4), dtype=numpy.uint8)
+    valid = numpy.zeros((PIXEL_TYPE_COUNT, 4, 256), dtype=bool)
 
-    cdef size_t x
-    cdef size_t y
+    # look up the color index in the main graphics table.
+    # the index has to be adjusted to the palette section.
+    main_indices = numpy.arange(4 * 256).reshape(4, 256)
+    in_range = main_indices < len(m_lookup)
+    lut[color_standard, in_range, :3] = m_lookup[main_indices[in_range], :3]
 
-    for y in range(height):
+    # alpha values are unused
+    # in 0x0C and 0x0B version of SMPs
+    lut[color_standard, :, :, 3] = 255
+    valid[color_standard] = in_range
 
-        current_row = image_matrix[y]
+    valid[color_transparent] = True
 
-        for x in range(width):
-            px = current_row[x]
+    # the palette index is the shadow's alpha value
+    lut[color_shadow, :, :, 3] = numpy.arange(256)
+    valid[color_shadow] = True
 
-            px_type = px.type
-            px_index = px.index
-            px_palette = px.palette
+    # get rgb base color from the player color table
+    count = min(len(p_lookup), 256)
 
-            if px_type == color_standard:
-                # look up the palette secition
-                # palettes have 1024 entries
-                # divided into 4 sections
-                palette_section = px_palette
+    # TODO: Make this 255 with new renderer
+    for px_type, alpha in ((color_player, 254),
+                           (color_outline, 253)):
+        lut[px_type, :, :count, :3] = p_lookup[:count, :3]
+        lut[px_type, :, :, 3] = alpha
+        valid[px_type, :, :count] = True
 
-                # the index has to be adjusted
-                # to the palette section
-                index = px_index + (palette_section * 256)
+    return lut, valid
 
-                # look up the color index in the
-                # main graphics table
-                r, g, b, alpha = m_lookup[index]
 
-                # alpha values are unused
-                # in 0x0C and 0x0B version of SMPs
-                alpha = 255
-
-            elif px_type == color_transparent:
-                r, g, b, alpha = 0, 0, 0, 0
-
-            elif px_type == color_shadow:
-                r, g, b, alpha = 0, 0, 0, px_index
-
-            else:
-                if px_type == color_player:
-                    # TODO: Make this 255 with new renderer
-                    alpha = 254
-
-                elif px_type == color_outline:
-                    alpha = 253
-
-                else:
-                    raise ValueError("unknown pixel type: %d" % px_type)
+def determine_rgba_matrix(pixel_types, pixel_indices, pixel_sections,
+                          main_palette, player_palette):
+    """
+    converts the pixel planes to an rgba matrix.
 
-                # get rgb base color from the color table
-                # store it the preview player color
-                # in the table: [16*player, 16*player+7]
-                r, g, b = p_lookup[px_index]
+    :param pixel_types: Plane of pixel types.
+    :param pixel_indices: Plane of palette indices in a palette section.
+    :param pixel_sections: Plane of palette sections.
+    :param main_palette: Color palette used for normal pixels in the sprite.
+    :param player_palette: Color palette used for player color pixels in the sprite.
+    """
+    lut, valid = rgba_lookup_table(main_palette, player_palette)
 
-            # array_data[y, x] = (r, g, b, alpha)
-            array_data[y, x, 0] = r
-            array_data[y, x, 1] = g
-            array_data[y, x, 2] = b
-            array_data[y, x, 3] = alpha
+    resolvable = valid[pixel_types, pixel_sections, pixel_indices]
+    if not resolvable.all():
+        raise IndexError("palette index %d (section %d) of pixel type %d "
+                         "out of range" % (
+                             pixel_indices[~resolvable][0],
+                             pixel_sections[~resolvable][0],
+                             pixel_types[~resolvable][0]))
 
-    return array_data
+    return lut[pixel_types, pixel_sections, pixel_indices]
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef numpy.ndarray determine_damage_matrix(vector[vector[pixel]] &image_matrix):
+def determine_damage_matrix(damage_modifiers):
     """
     converts the damage modifier values to an image using the RG values.
 
-    :param image_matrix: A 2-dimensional array of SMP pixels.
+    :param damage_modifiers: Plane of the two damage modifiers of each pixel.
     """
+    height, width, _ = damage_modifiers.shape
 
-    cdef size_t height = image_matrix.size()
-    cdef size_t width = image_matrix[0].size()
-
-    cdef numpy.ndarray[numpy.uint8_t, ndim=3, mode="c"] array_data = \
-        numpy.zeros((height, width, 4), dtype=numpy.uint8)
-
-    cdef uint8_t r
-    cdef uint8_t g
-    cdef uint8_t b
-    cdef uint8_t alpha
-
-    cdef vector[pixel] current_row
-    cdef pixel px
-
-    cdef size_t x
-    cdef size_t y
-
-    for y in range(height):
-
-        current_row = image_matrix[y]
-
-        for x in range(width):
-            px = current_row[x]
-
-            r, g, b, alpha = px.damage_modifier_1, px.damage_modifier_2, 0, 255
-
-            # array_data[y, x] = (r, g, b, alpha)
-            array_data[y, x, 0] = r
-            array_data[y, x, 1] = g
-            array_data[y, x, 2] = b
-            array_data[y, x, 3] = alpha
+    array_data = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    array_data[:, :, :2] = damage_modifiers
+    array_data[:, :, 3] = 255
 
     return array_data
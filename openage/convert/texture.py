@@ -1,4 +1,4 @@
-# Copyright 2014-2019 the openage authors. See copying.md for legal info.
+# Copyright 2014-2020 the openage authors. See copying.md for legal info.
 
 """ Routines for texture generation etc """
 
@@ -9,7 +9,8 @@ import numpy
 
 from PIL import Image
 
-from .binpack import RowPacker, ColumnPacker, BinaryTreePacker, BestPacker
+from .binpack import (RowPacker, ColumnPacker, SkylinePacker, BestPacker,
+                      CachingPacker, PackingCache)
 from .blendomatic import BlendingMode
 from .dataformat import genie_structure
 from .export import struct_definition, data_formatter
@@ -21,6 +22,10 @@ from ..log import spam
 from ..util.fslike.path import Path
 
 
+# packings of earlier textures, reused for frames with the same sizes
+PACKING_CACHE = PackingCache()
+
+
 def subtexture_meta(tx, ty, hx, hy, cx, cy):
     """
     generate a dict that contains the meta information for
@@ -187,11 +192,16 @@ class Texture(genie_structure.GenieStructure):
         else:
             return [subtex]
 
-    def save(self, targetdir, filename, meta_formats=None):
+    def save(self, targetdir, filename, meta_formats=None,
+             compression="default"):
         """
         Store the image data into the target directory path,
         with given filename="dir/out.png"
         If metaformats are requested, export e.g. as "dir/out.docx".
+        compression selects the png compression preset
+        ("fast", "default" or "max").
+
+        Returns the names of all written files, relative to targetdir.
         """
         if not isinstance(targetdir, Path):
             raise ValueError("util.fslike Path expected as targetdir")
@@ -207,32 +217,29 @@ class Texture(genie_structure.GenieStructure):
             raise ValueError("Filename invalid, a texture must be saved"
                              "as 'filename.png', not '%s'" % (filename))
 
-        # without the dot
-        ext = ext[1:]
-
-        # ASDF: Remove the shoddy PNG file location mess
-        # TODO: The png conversion should return a bytearray and
-        #       let Python handle writing it. To do that libpng
-        #       must write to a buffer that is returned.
-        # ------------------------------------------------------------------------------
-        assetdir = targetdir.fsobj.obj.fsobj.obj.fsobj.path.decode("utf-8") + "/"
-        convertdir = assetdir + targetdir.fsobj.obj.fsobj.obj.parts[0].decode("utf-8") + "/"
-        for part in targetdir.parts:
-            convertdir = convertdir + part.decode("utf-8") + "/"
-        targetstr = convertdir + filename
-
-        with targetdir[filename].open("wb") as imagefile:
-            pass
-
-        from .png import png_create
-        png_create.save(targetstr, self.image_data.data)
-        # ------------------------------------------------------------------------------
+        # the old image may be hardlinked to a media cache entry
+        with targetdir[filename].open_new() as imagefile:
+            imagefile.write(self.encode_png(compression))
 
         if meta_formats:
             # generate formatted texture metadata
             formatter = data_formatter.DataFormatter()
             formatter.add_data(self.dump(basename))
-            formatter.export(targetdir, meta_formats)
+            return [filename] + formatter.export(targetdir, meta_formats)
+
+        return [filename]
+
+    def encode_png(self, compression="default"):
+        """
+        Returns the image data encoded as png file content.
+        compression selects the png compression preset
+        ("fast", "default" or "max").
+        """
+        from .png import png_create
+
+        # the encoding releases the GIL,
+        # so textures can be encoded concurrently.
+        return png_create.save(self.image_data.data, compression)
 
     def dump(self, filename):
         """
@@ -259,11 +266,14 @@ def merge_frames(frames):
     if len(frames) == 0:
         raise Exception("cannot create texture with empty input frame list")
 
-    packer = BestPacker([BinaryTreePacker(margin=MARGIN, aspect_ratio=1),
-                         BinaryTreePacker(margin=MARGIN,
-                                          aspect_ratio=TERRAIN_ASPECT_RATIO),
-                         RowPacker(margin=MARGIN),
-                         ColumnPacker(margin=MARGIN)])
+    packer = CachingPacker(
+        BestPacker([SkylinePacker(margin=MARGIN, aspect_ratio=1),
+                    SkylinePacker(margin=MARGIN,
+                                  aspect_ratio=TERRAIN_ASPECT_RATIO),
+                    RowPacker(margin=MARGIN),
+                    ColumnPacker(margin=MARGIN)]),
+        PACKING_CACHE
+    )
 
     packer.pack(frames)
 
@@ -0,0 +1,247 @@
+# Copyright 2020-2020 the openage authors. See copying.md for legal info.
+
+"""
+Timing instrumentation for the conversion.
+
+The converter measures its stages with spans:
+
+    with timings.span("media", filename, ".slp") as span:
+        span.bytes_in = len(data)
+        ...
+
+The durations, byte counts and item counts of the spans are summed up
+per stage and per file type, and the spans of individual files are
+kept for finding the slowest files. Worker processes can't access the
+Timings object, they send Records to the parent process instead.
+"""
+
+from collections import namedtuple, OrderedDict
+import heapq
+import json
+from threading import Lock
+from time import perf_counter
+
+
+# the measurement of a finished span
+Record = namedtuple("Record", ("stage", "seconds", "bytes_in", "bytes_out",
+                               "items", "name", "file_type"))
+
+
+class Span:
+    """
+    Measures the duration of a with block.
+
+    The processed amounts can be set while the block runs. When the block
+    is left, the Record is added to timings, if there is one.
+    """
+
+    __slots__ = ('timings', 'stage', 'name', 'file_type',
+                 'bytes_in', 'bytes_out', 'items', 'start', 'record')
+
+    def __init__(self, timings, stage, name=None, file_type=None):
+        self.timings = timings
+        self.stage = stage
+        self.name = name
+        self.file_type = file_type
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.items = 1
+
+        self.start = None
+        self.record = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del exc_type, exc_value, traceback  # unused
+
+        self.record = Record(self.stage, perf_counter() - self.start,
+                             self.bytes_in, self.bytes_out, self.items,
+                             self.name, self.file_type)
+
+        if self.timings is not None:
+            self.timings.add(self.record)
+
+
+class StageTotal:
+    """
+    Sum of the records of a stage or file type.
+    """
+
+    __slots__ = ('count', 'seconds', 'bytes_in', 'bytes_out', 'items')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.items = 0
+
+    def add(self, record):
+        """
+        Adds the amounts of the record.
+        """
+        self.count += 1
+        self.seconds += record.seconds
+        self.bytes_in += record.bytes_in
+        self.bytes_out += record.bytes_out
+        self.items += record.items
+
+    def get_report(self):
+        """
+        Returns the totals and throughputs as dict.
+        """
+        report = OrderedDict((
+            ("count", self.count),
+            ("seconds", self.seconds),
+            ("bytes_in", self.bytes_in),
+            ("bytes_out", self.bytes_out),
+            ("items", self.items),
+            ("mb_in_per_s", None),
+            ("items_per_s", None),
+        ))
+
+        if self.seconds > 0:
+            report["mb_in_per_s"] = self.bytes_in / self.seconds / 1e6
+            report["items_per_s"] = self.items / self.seconds
+
+        return report
+
+
+class Timings:
+    """
+    Collects the records of the spans of a conversion.
+    Spans can be used from several threads.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.lock = Lock()
+
+        # stage -> StageTotal
+        self.stages = OrderedDict()
+
+        # (stage, file type) -> StageTotal
+        self.file_types = OrderedDict()
+
+        # records of the spans that have a file name
+        self.files = []
+
+    def span(self, stage, name=None, file_type=None):
+        """
+        Returns a Span that is recorded when its with block is left.
+
+        :param stage: Name of the measured stage.
+        :param name: File name, for spans of a single file.
+        :param file_type: Kind of the file, e.g. its suffix.
+        """
+        return Span(self, stage, name, file_type)
+
+    def add(self, record):
+        """
+        Adds the Record of a span, e.g. one that was
+        measured in a worker process.
+        """
+        with self.lock:
+            total = self.stages.get(record.stage)
+            if total is None:
+                total = self.stages[record.stage] = StageTotal()
+            total.add(record)
+
+            if record.file_type is not None:
+                key = (record.stage, record.file_type)
+                total = self.file_types.get(key)
+                if total is None:
+                    total = self.file_types[key] = StageTotal()
+                total.add(record)
+
+            if record.name is not None:
+                self.files.append(record)
+
+    def get_slowest_files(self, count=20):
+        """
+        Returns the records of the count slowest files.
+        """
+        with self.lock:
+            return heapq.nlargest(count, self.files,
+                                  key=lambda record: record.seconds)
+
+    def get_report(self, count=20):
+        """
+        Returns the collected timings as dict,
+        with the count slowest files.
+        """
+        with self.lock:
+            stages = OrderedDict((stage, total.get_report())
+                                 for stage, total in self.stages.items())
+
+            file_types = OrderedDict()
+            for (stage, file_type), total in self.file_types.items():
+                file_types.setdefault(stage, OrderedDict())[file_type] = \
+                    total.get_report()
+
+        return OrderedDict((
+            ("total_seconds", perf_counter() - self.start),
+            ("stages", stages),
+            ("file_types", file_types),
+            ("slowest_files", [record._asdict()
+                               for record in self.get_slowest_files(count)]),
+        ))
+
+    def save(self, filename, count=20):
+        """
+        Writes the report to a JSON file.
+        """
+        with open(filename, "w") as outfile:
+            json.dump(self.get_report(count), outfile, indent=4)
+
+    def format_slowest_files(self, count=20):
+        """
+        Returns the table of the count slowest files.
+        """
+        lines = ["%10s  %-10s %-8s  %s" % ("seconds", "stage", "type", "file")]
+
+        for record in self.get_slowest_files(count):
+            lines.append("%10.4f  %-10s %-8s  %s" % (
+                record.seconds, record.stage, record.file_type or "",
+                record.name))
+
+        return "\n".join(lines)
+
+
+def test():
+    """
+    Sums up spans and records like the converter does.
+    """
+    from ..testing.testing import assert_value, assert_raises
+
+    timings = Timings()
+
+    for name, size in (("a.slp", 100), ("b.slp", 300), ("c.wav", 50)):
+        with timings.span("media", name, name[-4:]) as span:
+            span.bytes_in = size
+            span.bytes_out = size // 2
+
+    # a record from a worker process
+    with Span(None, "slp convert", file_type=".slp") as span:
+        span.items = 8
+    timings.add(span.record)
+
+    # failed spans are recorded, too
+    with assert_raises(ValueError):
+        with timings.span("palette"):
+            raise ValueError("broken palette")
+
+    report = timings.get_report(count=2)
+
+    assert_value(list(report["stages"]), ["media", "slp convert", "palette"])
+    assert_value(report["stages"]["media"]["count"], 3)
+    assert_value(report["stages"]["media"]["bytes_in"], 450)
+    assert_value(report["stages"]["slp convert"]["items"], 8)
+    assert_value(report["file_types"]["media"][".slp"]["bytes_out"], 200)
+    assert_value(list(report["file_types"]), ["media", "slp convert"])
+    assert_value(len(report["slowest_files"]), 2)
+    assert_value(len(timings.format_slowest_files().splitlines()), 4)
@@ -15,10 +15,15 @@ Python does not enforce static types, so be careful
 import re
 
 from enum import Enum
+from io import StringIO
 from openage.util.ordered_set import OrderedSet
 
 INDENT = "    "
 
+# nyan grammar for identifiers and fqons
+NAME_PATTERN = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*")
+FQON_PATTERN = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*('.'[a-zA-Z_][a-zA-Z0-9_]*)*")
+
 
 class NyanObject:
     """
@@ -56,8 +61,18 @@ class NyanObject:
         # Set of children
         self._children = OrderedSet()
 
+        # all ancestors of the object, computed on first use
+        self._ancestors = None
+
         self._sanity_check()
 
+        # member lookup indexes:
+        # name -> member, (name, origin) -> inherited member
+        self._member_index = {}
+        self._inherited_index = {}
+        for member in self._members:
+            self._member_index.setdefault(member.get_name(), member)
+
         if len(self._parents) > 0:
             self._process_inheritance()
 
@@ -88,6 +103,7 @@ class NyanObject:
             raise Exception("added member must have <NyanMember> type")
 
         self._members.add(new_member)
+        self._member_index.setdefault(new_member.get_name(), new_member)
 
         # Update child objects
         for child in self._children:
@@ -114,6 +130,9 @@ class NyanObject:
 
         self._children.add(new_child)
 
+        # the ancestry of the child is determined anew on its next use
+        new_child.clear_ancestor_cache()
+
         # Pass members and inherited members to the child object
         for member in self._members:
             # Create a new member with self as parent and origin
@@ -145,6 +164,32 @@ class NyanObject:
             )
             new_child.update_inheritance(inherited_member)
 
+    def clear_ancestor_cache(self):
+        """
+        Invalidates the cached ancestors of the object and its children.
+        """
+        if self._ancestors is None:
+            return
+
+        self._ancestors = None
+
+        for child in self._children:
+            child.clear_ancestor_cache()
+
+    def get_ancestors(self):
+        """
+        Returns the set of all ancestors of the nyan object.
+        """
+        if self._ancestors is None:
+            ancestors = set()
+            for parent in self._parents:
+                ancestors.add(parent)
+                ancestors.update(parent.get_ancestors())
+
+            self._ancestors = ancestors
+
+        return self._ancestors
+
     def get_fqon(self):
         """
         Returns the fqon of the nyan object.
@@ -163,17 +208,16 @@ class NyanObject:
         None if there is no member with that name.
         """
         if origin and origin is not self:
-            for inherited_member in self._inherited_members:
-                if origin == inherited_member.get_origin():
-                    if inherited_member.get_name() == member_name:
-                        return inherited_member
+            inherited_member = self._inherited_index.get((member_name, origin))
+            if inherited_member is not None:
+                return inherited_member
 
             raise Exception("%s has no member '%s' with origin '%s'"
                             % (self, member_name, origin))
-        else:
-            for member in self._members:
-                if member.get_name() == member_name:
-                    return member
+
+        member = self._member_index.get(member_name)
+        if member is not None:
+            return member
 
         raise Exception("%s has no member '%s'" % (self, member_name))
 
@@ -188,15 +232,7 @@ class NyanObject:
         Returns True if the given nyan object is an ancestor
         of this nyan object.
         """
-        for parent in self._parents:
-            if parent is nyan_object:
-                return True
-
-        for parent in self._parents:
-            if parent.has_ancestor(nyan_object):
-                return True
-
-        return False
+        return nyan_object in self.get_ancestors()
 
     def is_abstract(self):
         """
@@ -223,10 +259,9 @@ class NyanObject:
             raise Exception("%s: 'new_fqon' must be a string"
                             % (self.__repr__()))
 
-        elif not re.fullmatch(r"[a-zA-Z_][a-zA-Z0-9_]*('.'[a-zA-Z_][a-zA-Z0-9_]*)*",
-                              self.name):
+        elif not FQON_PATTERN.fullmatch(self.name):
             raise Exception("%s: new fqon '%s' is not well formed"
-                            % (self.__repr__(). new_fqon))
+                            % (self.__repr__(), new_fqon))
 
         else:
             self._fqon = new_fqon
@@ -251,6 +286,9 @@ class NyanObject:
             raise Exception("added member must have <InheritedNyanMember> type")
 
         self._inherited_members.add(new_inherited_member)
+        self._inherited_index.setdefault((new_inherited_member.get_name(),
+                                          new_inherited_member.get_origin()),
+                                         new_inherited_member)
 
         # Update child objects
         for child in self._children:
@@ -272,83 +310,74 @@ class NyanObject:
         """
         Returns the string representation of the object.
         """
+        output = StringIO()
+        self.write(output, indent_depth)
+
+        return output.getvalue()
+
+    def write(self, outfile, indent_depth=0):
+        """
+        Writes the string representation of the object
+        to the text file-like object outfile.
+        """
         # Header
-        output_str = "%s" % (self.get_name())
+        outfile.write(self.get_name())
 
-        output_str += self._prepare_inheritance_content()
+        self._write_inheritance_content(outfile)
 
         # Members
-        output_str += self._prepare_object_content(indent_depth)
+        self._write_object_content(outfile, indent_depth)
 
-        return output_str
-
-    def _prepare_object_content(self, indent_depth):
+    def _write_object_content(self, outfile, indent_depth):
         """
-        Returns a string containing the nyan object's content
-        (members, nested objects).
+        Writes the nyan object's content (members, nested objects).
 
-        Subroutine of dump().
+        Subroutine of write().
         """
-        output_str = ""
+        member_indent = (indent_depth + 1) * INDENT
         empty = True
 
         if len(self._inherited_members) > 0:
             for inherited_member in self._inherited_members:
                 if inherited_member.has_value():
                     empty = False
-                    output_str += "%s%s\n" % ((indent_depth + 1) * INDENT,
-                                              inherited_member.dump())
+                    outfile.write("%s%s\n" % (member_indent,
+                                              inherited_member.dump()))
             if not empty:
-                output_str += "\n"
+                outfile.write("\n")
 
         if len(self._members) > 0:
             empty = False
             for member in self._members:
                 if self.is_patch():
                     # Patches do not need the type definition
-                    output_str += "%s%s\n" % ((indent_depth + 1) * INDENT,
-                                              member.dump_short())
+                    outfile.write("%s%s\n" % (member_indent,
+                                              member.dump_short()))
                 else:
-                    output_str += "%s%s\n" % ((indent_depth + 1) * INDENT,
-                                              member.dump())
+                    outfile.write("%s%s\n" % (member_indent,
+                                              member.dump()))
 
-            output_str += "\n"
+            outfile.write("\n")
 
         # Nested objects
         if len(self._nested_objects) > 0:
             empty = False
             for nested_object in self._nested_objects:
-                output_str += "%s%s" % ((indent_depth + 1) * INDENT,
-                                        nested_object.dump(
-                                            indent_depth + 1
-                ))
-
-            output_str += ""
+                outfile.write(member_indent)
+                nested_object.write(outfile, indent_depth + 1)
 
         # Empty objects need a 'pass' line
         if empty:
-            output_str += "%spass\n\n" % ((indent_depth + 1) * INDENT)
-
-        return output_str
+            outfile.write("%spass\n\n" % (member_indent))
 
-    def _prepare_inheritance_content(self):
+    def _write_inheritance_content(self, outfile):
         """
-        Returns a string containing the nyan object's inheritance set
-        in the header.
+        Writes the nyan object's inheritance set in the header.
 
-        Subroutine of dump().
+        Subroutine of write().
         """
-        output_str = "("
-
-        if len(self._parents) > 0:
-            for parent in self._parents:
-                output_str += "%s, " % (parent.get_name())
-
-            output_str = output_str[:-2]
-
-        output_str += "):\n"
-
-        return output_str
+        outfile.write("(%s):\n" % ", ".join(parent.get_name()
+                                            for parent in self._parents))
 
     def _process_inheritance(self):
         """
@@ -367,7 +396,7 @@ class NyanObject:
             raise Exception("%s: 'name' must be a string" % (self.__repr__()))
 
         # self.name must conform to nyan grammar rules
-        if not re.fullmatch(r"[a-zA-Z_][a-zA-Z0-9_]*", self.name):
+        if not NAME_PATTERN.fullmatch(self.name):
             raise Exception("%s: 'name' is not well-formed" %
                             (self.__repr__()))
 
@@ -430,32 +459,31 @@ class NyanPatch(NyanObject):
         """
         return True
 
-    def dump(self, indent_depth=0):
+    def write(self, outfile, indent_depth=0):
         """
-        Returns the string representation of the object.
+        Writes the string representation of the patch
+        to the text file-like object outfile.
         """
         # Header
-        output_str = "%s%s<%s>" % (indent_depth * INDENT,
-                                   self.get_name(),
-                                   self.get_target().get_name())
+        outfile.write("%s%s<%s>" % (indent_depth * INDENT,
+                                    self.get_name(),
+                                    self.get_target().get_name()))
 
         if len(self._add_inheritance) > 0:
-            output_str += "["
+            new_parents = []
 
-            for new_inheritance in self._add_inheritance:
-                if new_inheritance[0] == "FRONT":
-                    output_str += "+%s, " % (new_inheritance.get_name())
-                elif new_inheritance[0] == "BACK":
-                    output_str += "%s+, " % (new_inheritance.get_name())
+            for mode, new_inheritance in self._add_inheritance:
+                if mode == "FRONT":
+                    new_parents.append("+%s" % (new_inheritance.get_name()))
+                elif mode == "BACK":
+                    new_parents.append("%s+" % (new_inheritance.get_name()))
 
-            output_str = output_str[:-2] + "]"
+            outfile.write("[%s]" % ", ".join(new_parents))
 
-        output_str += super()._prepare_inheritance_content()
+        self._write_inheritance_content(outfile)
 
         # Members
-        output_str += super()._prepare_object_content(indent_depth)
-
-        return output_str
+        self._write_object_content(outfile, indent_depth)
 
     def _sanity_check(self):
         """
@@ -669,7 +697,7 @@ class NyanMember:
                             % (self.__repr__()))
 
         # self.name must conform to nyan grammar rules
-        if not re.fullmatch(r"[a-zA-Z_][a-zA-Z0-9_]*", self.name[0]):
+        if not NAME_PATTERN.fullmatch(self.name[0]):
             raise Exception("%s: 'name' is not well-formed"
                             % (self.__repr__()))
 
@@ -839,23 +867,16 @@ class NyanMember:
                                                  self.value)
 
         elif self._member_type in (MemberType.SET, MemberType.ORDEREDSET):
-            output_str = ""
-
             if self._member_type is MemberType.ORDEREDSET:
-                output_str += "o"
+                prefix = "o"
 
-            output_str += "{"
-
-            if len(self.value) > 0:
-                for val in self.value:
-                    output_str += "%s, " % self._get_primitive_value_str(
-                        self._set_type,
-                        val
-                    )
-
-                return output_str[:-2] + "}"
+            else:
+                prefix = ""
 
-            return output_str + "}"
+            return "%s{%s}" % (prefix, ", ".join(
+                self._get_primitive_value_str(self._set_type, val)
+                for val in self.value
+            ))
 
         elif isinstance(self._member_type, NyanObject):
             return self.value.get_name()
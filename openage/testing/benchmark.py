@@ -1,15 +1,9 @@
-# Copyright 2017-2017 the openage authors. See copying.md for legal info.
+# Copyright 2017-2020 the openage authors. See copying.md for legal info.
 
 """ Benchmarking tools for the tests. """
 
 from timeit import timeit
 from sys import stdout
-from time import sleep
-
-
-def benchmark_test_function():
-    """ Simple function to call in for benchmarking. """
-    sleep(0.1)
 
 
 def benchmark(func):
@@ -1,4 +1,4 @@
-# Copyright 2015-2018 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """ Lists of all possible tests; enter your tests here. """
 
@@ -27,6 +27,16 @@ def tests_py():
     yield ("openage.cabextract.test.test", "test CAB archive extraction",
            lambda env: env["has_assets"])
     yield "openage.convert.changelog.test"
+    yield ("openage.convert.dataformat.member_diff.test",
+           "compact diffs of value members")
+    yield ("openage.convert.gamedata.gamespec_cache.test",
+           "store and load the columnar gamespec cache")
+    yield ("openage.convert.media_cache.test",
+           "replace hardlinked media cache outputs")
+    yield ("openage.convert.processor.aoc.entity_pool.test",
+           "create raw API objects on a process pool")
+    yield ("openage.convert.timings.test",
+           "sum up the timings of the conversion stages")
     yield "openage.cppinterface.exctranslate_tests.cpp_to_py"
     yield ("openage.cppinterface.exctranslate_tests.cpp_to_py_bounce",
            "translates the exception back and forth a few times")
@@ -34,7 +44,10 @@ def tests_py():
            "tests the interface for C++'s util::Enum class")
     yield ("openage.util.fslike.test.test",
            "test the filesystem abstraction subsystem")
+    yield ("openage.util.profiler.test",
+           "merge the profiles of several processes")
     yield "openage.util.threading.test_concurrent_chain"
+    yield "openage.util.threading.test_pipeline"
 
 
 def demos_py():
@@ -46,6 +59,8 @@ def demos_py():
            "translates a C++ exception and its causes to python")
     yield ("openage.log.tests.demo",
            "demonstrates the translation of Python log messages")
+    yield ("openage.convert.benchmark.stages.report",
+           "benchmarks the converter on synthetic assets, as JSON report")
     yield ("openage.convert.opus.demo.convert",
            "encodes an opus file from a wave file")
     yield ("openage.event.demo.curvepong",
@@ -60,9 +75,20 @@ def benchmark_py():
     methods.
     """
 
-    # TODO Add a real benchmark here, and remove this one
-    yield ("openage.testing.benchmark.benchmark_test_function",
-           "Benchmark yourself")
+    yield ("openage.convert.benchmark.stages.benchmark_parse",
+           "read synthetic DRS and CAB archives and a data file")
+    yield ("openage.convert.benchmark.stages.benchmark_decode",
+           "decode synthetic SLP, SMP and SMX sprites")
+    yield ("openage.convert.benchmark.stages.benchmark_palette",
+           "resolve the colors of synthetic sprites")
+    yield ("openage.convert.benchmark.stages.benchmark_pack",
+           "pack the frames of a synthetic sprite")
+    yield ("openage.convert.benchmark.stages.benchmark_png",
+           "encode synthetic sprite frames to PNG")
+    yield ("openage.convert.benchmark.stages.benchmark_opus",
+           "encode a synthetic sound to opus")
+    yield ("openage.convert.benchmark.stages.benchmark_nyan",
+           "write synthetic nyan objects")
 
 
 def tests_cpp():
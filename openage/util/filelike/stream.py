@@ -1,9 +1,10 @@
-# Copyright 2017-2017 the openage authors. See copying.md for legal info.
+# Copyright 2017-2020 the openage authors. See copying.md for legal info.
 
 """
 Provides FileLikeObject for binary stream interaction.
 """
 
+from ..context import DummyGuard
 from ..math import INF, clamp
 
 from .readonly import PosSavingReadOnlyFileLikeObject
@@ -113,15 +114,24 @@ class StreamFragment(PosSavingReadOnlyFileLikeObject):
 
     @param size
         The size of the stream fragment (in bytes).
+
+    @param lock
+        If given, the seek() and read() calls on the stream are guarded
+        by this lock, so fragments can be read from multiple threads.
     """
 
-    def __init__(self, stream, start, size):
+    def __init__(self, stream, start, size, lock=None):
         super().__init__()
 
         self.stream = stream
         self.start = start
         self.size = size
 
+        if lock is None:
+            self.lock = DummyGuard()
+        else:
+            self.lock = lock
+
         if size < 0:
             raise ValueError("size must be positive")
 
@@ -134,8 +144,9 @@ class StreamFragment(PosSavingReadOnlyFileLikeObject):
         if not size:
             return b""
 
-        self.stream.seek(self.start + self.pos)
-        data = self.stream.read(size)
+        with self.lock:
+            self.stream.seek(self.start + self.pos)
+            data = self.stream.read(size)
 
         if len(data) != size:
             raise EOFError("unexpected EOF in stream when attempting to read "
@@ -150,3 +161,59 @@ class StreamFragment(PosSavingReadOnlyFileLikeObject):
     def close(self):
         self.closed = True
         del self.stream
+
+
+class BufferFragment(PosSavingReadOnlyFileLikeObject):
+    """
+    Represents a part of a buffer (e.g. a memory-mapped file)
+    as read-only file-like object.
+
+    As there's no shared stream position, any number of fragments
+    can be read concurrently.
+
+    Constructor arguments:
+
+    @param buf
+        The buffer; anything that memoryview() accepts.
+
+    @param start
+        The first position of the buffer that is used in this object.
+
+    @param size
+        The size of the buffer fragment (in bytes).
+    """
+
+    def __init__(self, buf, start, size):
+        super().__init__()
+
+        if size < 0:
+            raise ValueError("size must be positive")
+
+        self.view = memoryview(buf)[start:start + size]
+
+        if len(self.view) != size:
+            raise EOFError("buffer fragment exceeds the buffer size")
+
+    def read(self, size=-1):
+        if size < 0:
+            size = INF
+
+        size = clamp(size, 0, len(self.view) - self.pos)
+
+        data = self.view[self.pos:self.pos + size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def getbuffer(self):
+        """
+        Returns the whole fragment as memoryview, without copying it.
+        Like io.BytesIO.getbuffer(), this ignores the seek position.
+        """
+        return self.view
+
+    def get_size(self):
+        return len(self.view)
+
+    def close(self):
+        self.closed = True
+        del self.view
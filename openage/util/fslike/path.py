@@ -1,4 +1,4 @@
-# Copyright 2015-2018 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
 Provides Path, which is analogous to pathlib.Path,
@@ -139,6 +139,18 @@ class Path:
         """ open with mode='wb' """
         return self.fsobj.open_w(self.parts)
 
+    def open_new(self):
+        """
+        open a new file with mode='wb'.
+
+        An existing file is removed first instead of being truncated,
+        so other hardlinks to it keep their content.
+        """
+        if self.is_file():
+            self.unlink()
+
+        return self.fsobj.open_w(self.parts)
+
     def _get_native_path(self):
         """
         return the native path (usable by your kernel) of this path,
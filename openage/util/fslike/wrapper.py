@@ -1,4 +1,4 @@
-# Copyright 2015-2017 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
 Provides
@@ -197,6 +197,14 @@ class GuardedFile(FileLikeObject):
         with self.guard:
             return self.obj.get_size()
 
+    def getbuffer(self):
+        """
+        Returns the content of the wrapped file as memoryview,
+        if the file supports that (see BufferFragment.getbuffer()).
+        """
+        with self.guard:
+            return self.obj.getbuffer()
+
     def __repr__(self):
         with self.guard:
             return "GuardedFile({}, {})".format(
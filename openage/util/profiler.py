@@ -1,12 +1,27 @@
-# Copyright 2017-2018 the openage authors. See copying.md for legal info.
+# Copyright 2017-2020 the openage authors. See copying.md for legal info.
 
 """
 Profiling utilities
+
+Besides the Profiler for quick measurements, whole program runs can be
+profiled with cProfile in all threads or by sampling the call stacks
+of all threads.
+Each process writes its own profile; merge_profiles() combines them
+into one report and a collapsed-stack file for flamegraph tools.
 """
 
+from collections import Counter
+from contextlib import contextmanager
 import cProfile
-import pstats
 import io
+import os
+import pstats
+import sys
+import threading
+from threading import (Event, Lock, Thread, enumerate as enumerate_threads,
+                       get_ident)
+
+from ..log import info
 
 
 class Profiler:
@@ -60,6 +75,12 @@ class Profiler:
         self.profile_stats.print_stats()
         return self.profile_stats.stream.getvalue()
 
+    def dump(self, filename):
+        """
+        Save the collected data as .pstats file.
+        """
+        self.profile.dump_stats(filename)
+
     def enable(self):
         """
         Begins profiling calls.
@@ -71,3 +92,481 @@ class Profiler:
         Stop profiling calls.
         """
         self.profile.disable()
+
+
+class ThreadProfiler:
+    """
+    Profiles the calling thread and all threads that are started while
+    the profiler is enabled with cProfile, e.g. the threads of the
+    conversion pools. Usage like Profiler.
+
+    cProfile only sees the thread that enables it, so every new thread
+    enables its own cProfile.Profile; their stats are merged by dump().
+    Threads that already run when profiling starts are not profiled.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = Lock()
+
+    def __enter__(self):
+        """
+        Start profiling.
+        """
+        self.enable()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop profiling.
+        """
+        self.disable()
+
+    def enable(self):
+        """
+        Profiles the calling thread and installs the hook
+        that profiles the new threads.
+        """
+        if sys.version_info < (3, 12):
+            threading.setprofile(self.profile_thread)
+
+        # since python 3.12, cProfile uses sys.monitoring,
+        # which reports the calls of all threads.
+        self.profile_thread()
+
+    def disable(self):
+        """
+        Stops profiling the calling thread and new threads.
+        The profiles of threads that still run are finished by dump().
+        """
+        threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def profile_thread(self, *_):
+        """
+        Enables a new cProfile.Profile for the calling thread.
+        Called by threading for the first event of each new thread.
+        """
+        profile = cProfile.Profile()
+
+        with self.lock:
+            self.profiles.append(profile)
+
+        profile.enable()
+
+    def dump(self, filename):
+        """
+        Save the merged data of all threads as .pstats file.
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                # the thread didn't call anything
+                continue
+
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+        if stats is None:
+            # keep the file loadable by merge_profiles()
+            stats = pstats.Stats(profiles[0])
+
+        stats.dump_stats(filename)
+
+
+class SamplingProfiler:
+    """
+    Samples the call stacks of all threads of the process.
+
+    Unlike cProfile, this hardly slows the program down and records
+    whole stacks, but short functions may be missed. The samples are
+    counted by stack, in the collapsed format of flamegraph.pl.
+    The sampling thread needs the GIL, so while pure Python code runs,
+    the samples are taken less often than every interval.
+    Usage like Profiler.
+    """
+
+    def __init__(self, interval=0.005):
+        # seconds between two samples
+        self.interval = interval
+
+        # collapsed stack -> number of samples
+        self.stacks = Counter()
+
+        self.stop_event = None
+        self.thread = None
+
+    def __enter__(self):
+        """
+        Start sampling.
+        """
+        self.enable()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Stop sampling.
+        """
+        self.disable()
+
+    def enable(self):
+        """
+        Starts the sampling thread.
+        """
+        self.stop_event = Event()
+        self.thread = Thread(target=self.sample, name="sampling profiler",
+                             daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        """
+        Stops the sampling thread.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def sample(self):
+        """
+        Records the stacks until disable() is called.
+        """
+        own_id = get_ident()
+
+        while not self.stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name
+                            for thread in enumerate_threads()}
+
+            # pylint: disable=protected-access
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(format_function(code.co_filename,
+                                                 code.co_firstlineno,
+                                                 code.co_name))
+                    frame = frame.f_back
+
+                stack.append(thread_names.get(thread_id, "thread"))
+                stack.reverse()
+                self.stacks[";".join(stack)] += 1
+
+    def report(self, count=40):
+        """
+        Returns the functions with the most samples.
+        """
+        return format_collapsed(self.stacks, count)
+
+    def dump(self, filename):
+        """
+        Save the samples as .collapsed file.
+        """
+        with open(filename, "w") as outfile:
+            write_collapsed(self.stacks, outfile)
+
+
+# profiling mode -> (profiler class, suffix of the profile files)
+PROFILERS = {
+    "cprofile": (ThreadProfiler, ".pstats"),
+    "sample": (SamplingProfiler, ".collapsed"),
+}
+
+
+def format_function(filename, line, name):
+    """
+    Returns the name of a function for the collapsed stacks.
+    """
+    if filename == "~":
+        # built-in function
+        return name.replace(";", ":")
+
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+
+def collapse_stats(stats, min_fraction=1e-5, max_depth=64):
+    """
+    Estimates the collapsed stacks of cProfile stats.
+
+    cProfile only knows the callers of each function, so the time of
+    a function is split between the stacks in proportion to the time
+    of the calls from each caller. Recursion is cut off, as well as
+    stacks with less than min_fraction of the total time.
+
+    Returns a Counter of collapsed stack -> microseconds.
+    """
+    # function -> {callee: cumulative time of the calls}
+    callees = {}
+    roots = []
+
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        # calls from frames that started before the profiling have no
+        # caller, only the recursive calls of such functions are known
+        if not callers.keys() - {func}:
+            roots.append(func)
+
+        for caller, call_stats in callers.items():
+            callees.setdefault(caller, {})[func] = call_stats[3]
+
+    stacks = Counter()
+    total = sum(stats.stats[func][3] for func in roots)
+    min_time = total * min_fraction
+
+    def walk(func, stack, functions, time):
+        """ distributes time among func and its callees """
+        _, _, own_time, cumulative_time, _ = stats.stats[func]
+        if cumulative_time <= 0:
+            return
+
+        stack = stack + [format_function(*func)]
+        functions = functions | {func}
+        scale = min(1.0, time / cumulative_time)
+
+        own = round(own_time * scale * 1e6)
+        if own > 0:
+            stacks[";".join(stack)] += own
+
+        if len(stack) >= max_depth:
+            return
+
+        for callee, callee_time in callees.get(func, {}).items():
+            callee_time *= scale
+            if callee not in functions and callee_time >= min_time:
+                walk(callee, stack, functions, callee_time)
+
+    for func in roots:
+        walk(func, [], frozenset(), stats.stats[func][3])
+
+    return stacks
+
+
+def read_collapsed(filename, stacks=None):
+    """
+    Adds the stacks of a .collapsed file to stacks.
+    """
+    if stacks is None:
+        stacks = Counter()
+
+    with open(filename) as infile:
+        for line in infile:
+            stack, _, value = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] += int(value)
+
+    return stacks
+
+
+def write_collapsed(stacks, outfile):
+    """
+    Writes the stacks as lines of "frame;frame;frame value".
+    """
+    for stack, value in sorted(stacks.items()):
+        outfile.write("%s %d\n" % (stack, value))
+
+
+def format_collapsed(stacks, count=40):
+    """
+    Returns a table of the functions with the highest
+    own and total share of the stacks.
+    """
+    own = Counter()
+    total = Counter()
+
+    for stack, value in stacks.items():
+        functions = stack.split(";")
+        own[functions[-1]] += value
+
+        # count recursive functions only once
+        for function in set(functions):
+            total[function] += value
+
+    overall = sum(stacks.values()) or 1
+
+    lines = ["%7s %7s  %s" % ("own %", "total %", "function")]
+    for function, value in own.most_common(count):
+        lines.append("%7.2f %7.2f  %s" % (100 * value / overall,
+                                          100 * total[function] / overall,
+                                          function))
+
+    return "\n".join(lines)
+
+
+def get_process_dir(directory):
+    """
+    Returns the directory for the profiles of the single processes.
+    """
+    return os.path.join(directory, "processes")
+
+
+def merge_profiles(mode, directory):
+    """
+    Merges the profiles of all processes in the directory into:
+        profile.collapsed: stacks for flamegraph tools
+        profile.txt: report of the most expensive functions
+        profile.pstats: merged stats, only for cprofile
+
+    Returns the path of the report.
+    """
+    suffix = PROFILERS[mode][1]
+    process_dir = get_process_dir(directory)
+
+    filenames = sorted(os.path.join(process_dir, filename)
+                       for filename in os.listdir(process_dir)
+                       if filename.endswith(suffix))
+
+    if not filenames:
+        raise Exception("no profiles found in %s" % process_dir)
+
+    report_path = os.path.join(directory, "profile.txt")
+
+    if mode == "cprofile":
+        report = io.StringIO()
+        stats = pstats.Stats(*filenames, stream=report)
+        stats.dump_stats(os.path.join(directory, "profile.pstats"))
+        stats.sort_stats("cumulative").print_stats(60)
+        stacks = collapse_stats(stats)
+
+        with open(report_path, "w") as outfile:
+            outfile.write(report.getvalue())
+
+    else:
+        stacks = Counter()
+        for filename in filenames:
+            read_collapsed(filename, stacks)
+
+        with open(report_path, "w") as outfile:
+            outfile.write(format_collapsed(stacks))
+            outfile.write("\n")
+
+    with open(os.path.join(directory, "profile.collapsed"), "w") as outfile:
+        write_collapsed(stacks, outfile)
+
+    return report_path
+
+
+def clear_profiles(directory):
+    """
+    Removes the process profiles of earlier runs from the directory.
+    """
+    process_dir = get_process_dir(directory)
+    os.makedirs(process_dir, exist_ok=True)
+
+    for filename in os.listdir(process_dir):
+        if filename.endswith(tuple(suffix for _, suffix in PROFILERS.values())):
+            os.remove(os.path.join(process_dir, filename))
+
+
+@contextmanager
+def profile_process(mode, directory, name):
+    """
+    Profiles the with block and saves the profile as
+    the one of the process with the given name.
+
+    Does nothing if mode is None.
+    """
+    if mode is None:
+        yield
+        return
+
+    profiler_type, suffix = PROFILERS[mode]
+    profiler = profiler_type()
+
+    try:
+        with profiler:
+            yield
+
+    finally:
+        # the profile of a failed run is the most interesting one
+        profiler.dump(os.path.join(get_process_dir(directory), name + suffix))
+
+
+@contextmanager
+def profiling(mode, directory):
+    """
+    Profiles the main process in the with block, then merges its
+    profile with the ones the other processes saved in the meantime.
+
+    Does nothing if mode is None.
+    """
+    if mode is None:
+        yield
+        return
+
+    clear_profiles(directory)
+
+    try:
+        with profile_process(mode, directory, "main"):
+            yield
+
+    finally:
+        report_path = merge_profiles(mode, directory)
+        info("profile report: %s", report_path)
+
+
+def add_profile_arguments(cli):
+    """
+    Adds the --profile options to an argparse parser.
+    """
+    cli.add_argument(
+        "--profile", nargs="?", choices=sorted(PROFILERS), const="cprofile",
+        default=None,
+        help=("profile the run with cProfile in all threads (default) or "
+              "by sampling the call stacks (--profile=sample); the "
+              "profiles are merged in --profile-dir"))
+
+    cli.add_argument(
+        "--profile-dir", default="openage-profile",
+        help=("directory for the profiles, the merged report and the "
+              "collapsed stacks for flamegraphs"))
+
+
+def test():
+    """
+    Merges the profiles of two runs in each mode.
+    """
+    from tempfile import TemporaryDirectory
+    from ..testing.testing import assert_value
+
+    def fibonacci(num):
+        """ something to profile """
+        return num if num < 2 else fibonacci(num - 1) + fibonacci(num - 2)
+
+    with TemporaryDirectory() as directory:
+        clear_profiles(directory)
+
+        for name in ("main", "worker-1"):
+            with profile_process("cprofile", directory, name):
+                fibonacci(15)
+
+        merge_profiles("cprofile", directory)
+
+        stats = pstats.Stats(os.path.join(directory, "profile.pstats"))
+        calls = [stat[1] for func, stat in stats.stats.items()
+                 if func[2] == "fibonacci"]
+        assert_value(calls, [2 * 1973])
+
+        stacks = read_collapsed(os.path.join(directory, "profile.collapsed"))
+        assert_value(any("fibonacci" in stack for stack in stacks), True)
+
+        with open(os.path.join(get_process_dir(directory),
+                               "worker-1.collapsed"), "w") as outfile:
+            write_collapsed({"MainThread;run;fibonacci": 3}, outfile)
+
+        with open(os.path.join(get_process_dir(directory),
+                               "worker-2.collapsed"), "w") as outfile:
+            write_collapsed({"MainThread;run;fibonacci": 2,
+                             "MainThread;run": 5}, outfile)
+
+        merge_profiles("sample", directory)
+
+        stacks = read_collapsed(os.path.join(directory, "profile.collapsed"))
+        assert_value(stacks, {"MainThread;run;fibonacci": 5,
+                              "MainThread;run": 5})
+
+        clear_profiles(directory)
+        assert_value(os.listdir(get_process_dir(directory)), [])
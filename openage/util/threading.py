@@ -1,4 +1,4 @@
-# Copyright 2015-2017 the openage authors. See copying.md for legal info.
+# Copyright 2015-2020 the openage authors. See copying.md for legal info.
 
 """
 Threading utilities.
@@ -8,7 +8,8 @@ from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import itertools
 import os
-from queue import Queue
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
 
 
 def concurrent_chain(generators, jobs=None):
@@ -111,6 +112,132 @@ def generator_to_queue(generator, queue):
         queue.put((GeneratorEvent.EXCEPTION, exc))
 
 
+def pipeline(items, stages, queue_size=None):
+    """
+    Passes the items through a chain of stages that run concurrently.
+
+    stages is a list of (function, jobs) tuples: each stage has jobs threads
+    that call function(item) on the results of the previous stage.
+    If function returns None, the item is dropped.
+
+    The queues between the stages are bounded (by default, to twice
+    the number of threads of the following stage), so a slow stage throttles
+    the stages before it instead of piling up their results in memory.
+
+    Yields the results of the last stage, in no particular order.
+
+    When a stage raises an exception, the whole pipeline is stopped and
+    the exception is raised.
+    """
+    stopped = Event()
+    errors = []
+
+    queues = []
+    for _, jobs in stages:
+        queues.append(Queue(queue_size or 2 * jobs))
+    queues.append(Queue(queue_size or 2))
+
+    def put(target_queue, item):
+        """ puts the item to the queue, unless the pipeline was stopped. """
+        while not stopped.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def get(source_queue):
+        """ gets an item from the queue, unless the pipeline was stopped. """
+        while not stopped.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except Empty:
+                pass
+
+        return PipelineEvent.STOP
+
+    def feed():
+        """ puts all items into the first queue. """
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+
+        except BaseException as exc:
+            errors.append(exc)
+            stopped.set()
+            return
+
+        put(queues[0], PipelineEvent.STOP)
+
+    def work(function, source_queue, target_queue, running):
+        """ runs function on the items of one stage. """
+        try:
+            while True:
+                item = get(source_queue)
+                if item is PipelineEvent.STOP:
+                    # let the other threads of this stage see it, too.
+                    put(source_queue, item)
+                    break
+
+                result = function(item)
+                if result is not None:
+                    if not put(target_queue, result):
+                        break
+
+        except BaseException as exc:
+            errors.append(exc)
+            stopped.set()
+
+        finally:
+            with running[1]:
+                running[0] -= 1
+                last = running[0] == 0
+
+            # the last thread of the stage ends the next stage.
+            if last:
+                put(target_queue, PipelineEvent.STOP)
+
+    threads = [Thread(target=feed)]
+    for idx, (function, jobs) in enumerate(stages):
+        # [number of running threads, lock]
+        running = [jobs, Lock()]
+        for _ in range(jobs):
+            threads.append(Thread(
+                target=work,
+                args=(function, queues[idx], queues[idx + 1], running)
+            ))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            result = get(queues[-1])
+            if result is PipelineEvent.STOP:
+                break
+
+            yield result
+
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+class PipelineEvent(Enum):
+    """
+    For use by pipeline.
+    Marks the end of the items in a queue.
+    """
+    STOP = 0
+
+
 def test_concurrent_chain():
     """ Tests concurrent_chain """
     from ..testing.testing import assert_value, assert_raises, result
@@ -132,3 +259,42 @@ def test_concurrent_chain():
     chain = concurrent_chain([range(10), range(20), errorgen(), range(30)], 2)
     with assert_raises(ValueError):
         result(list(chain))
+
+
+def test_pipeline():
+    """ Tests pipeline """
+    from ..testing.testing import assert_value, assert_raises, result
+
+    def double(item):
+        """ Test stage """
+        return 2 * item
+
+    def drop_odd(item):
+        """ Test stage that drops some items """
+        if item % 2:
+            return None
+        return item
+
+    def fail(item):
+        """ Test stage that raises an exception """
+        if item == 10:
+            raise ValueError()
+        return item
+
+    assert_value(list(pipeline([], [(double, 2)])), [])
+
+    assert_value(
+        sorted(pipeline(range(100), [(double, 3), (double, 1), (double, 4)])),
+        [8 * item for item in range(100)]
+    )
+
+    assert_value(
+        sorted(pipeline(range(10), [(drop_odd, 2), (double, 2)], 1)),
+        [0, 4, 8, 12, 16]
+    )
+
+    with assert_raises(ValueError):
+        result(list(pipeline(range(100), [(double, 2), (fail, 2)])))
+
+    with assert_raises(ValueError):
+        result(list(pipeline(range(100), [(fail, 2), (double, 2)], 1)))